@@ -0,0 +1,26 @@
+import os
+import threading
+
+# gunicorn は起動ディレクトリの gunicorn.conf.py を自動で読み込む（Procfile の設定と併用）
+
+# LLM の応答待ちでワーカーが塞がらないよう、スレッドワーカー（gthread）で動かす
+# 1ワーカーあたり GUNICORN_THREADS 件のリクエストを同時に処理する（-w 4 なら既定で最大256件）
+# GUNICORN_WORKER_CLASS=sync で従来の1リクエスト1ワーカーに戻せる
+worker_class = os.environ.get('GUNICORN_WORKER_CLASS', 'gthread')
+threads = int(os.environ.get('GUNICORN_THREADS', '64'))
+
+
+def post_worker_init(worker):
+    # EXPORT_WARMUP=1 で出力処理（matplotlib・reportlab 等）をバックグラウンドで読み込む
+    # EXPORT_WARMUP=pool の場合は数式描画用のプロセスプールも起動しておく
+    mode = os.environ.get('EXPORT_WARMUP', '0').lower()
+    if mode in ('', '0', 'false', 'no', 'off'):
+        return
+    from src.routes.math_problem import warm_up_export_stack
+
+    threading.Thread(
+        target=warm_up_export_stack,
+        kwargs={'start_pool': mode == 'pool'},
+        name='export-warmup',
+        daemon=True,
+    ).start()
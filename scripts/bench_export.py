@@ -0,0 +1,298 @@
+#!/usr/bin/env python
+"""Benchmark the export and rendering hot paths on synthetic worksheets.
+
+Each benchmark runs in its own subprocess so that peak RSS is attributable
+to it. Results are written as JSON; pass --compare with an earlier result
+file to print the change between commits.
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import resource
+import statistics
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+# Set dummy key if not provided
+os.environ.setdefault("OPENAI_API_KEY", "dummy-key")
+os.environ.setdefault("LLM_BACKEND", "fake")
+
+ROOT = Path(__file__).resolve().parents[1]
+if str(ROOT) not in sys.path:
+    sys.path.insert(0, str(ROOT))
+
+BENCHMARKS = (
+    "generate_math_assets", "split_text_with_math", "parse_generated_problems", "dedup_problems",
+    "export_pdf", "export_word",
+)
+
+SENTENCES = [
+    "次の式の値を求めよ。",
+    "ただし、定数は実数とする。",
+    "グラフの頂点の座標を答えよ。",
+    "以下の条件を満たす値をすべて求めよ。",
+    "途中の計算も示すこと。",
+]
+
+
+def make_expression(rng, problem_idx, formula_idx):
+    a, b, c = rng.randint(2, 9), rng.randint(1, 20), problem_idx + formula_idx + 1
+    templates = [
+        f"x^2 - {a + b}x + {a * b} = 0",
+        f"\\frac{{{a}}}{{{b}}} + \\frac{{{c}}}{{{a + c}}}",
+        f"\\sqrt{{{a * c}}} \\times \\sqrt{{{b}}}",
+        f"\\int_0^{{{a}}} ({b}x^2 + {c}) \\, dx",
+        f"\\sum_{{k=1}}^{{{c}}} k^{{{a % 3 + 1}}}",
+        f"y = {a}(x - {b})^2 + {c}",
+        f"\\sin \\theta = \\frac{{{a}}}{{{a + b}}}",
+    ]
+    return templates[(problem_idx * 3 + formula_idx) % len(templates)]
+
+
+def make_worksheet(problems, formulas, seed=0):
+    """Return (problems_list, raw model output) for a synthetic worksheet."""
+    rng = random.Random(seed)
+    items = []
+    blocks = []
+    for idx in range(1, problems + 1):
+        parts = []
+        for formula_idx in range(formulas):
+            expression = make_expression(rng, idx, formula_idx)
+            sentence = rng.choice(SENTENCES)
+            # 3つに1つはディスプレイ数式にする
+            if formula_idx % 3 == 2:
+                parts.append(f"{sentence}\n\\[ {expression} \\]")
+            else:
+                parts.append(f"{sentence} \\( {expression} \\)")
+        problem = "\n".join(parts)
+        answer = f"\\( x = {idx} \\)"
+        explanation = f"与式を整理すると \\[ {make_expression(rng, idx, formulas)} \\] となる。したがって \\( x = {idx} \\) である。"
+        items.append({"number": idx, "title": None, "problem": problem, "answer": answer, "explanation": explanation})
+        blocks.append(f"【問題{idx}】\n{problem}\n【解答{idx}】\n{answer}\n【解説{idx}】\n{explanation}")
+    return items, "\n\n".join(blocks)
+
+
+def peak_rss_mb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux は KiB、macOS はバイト単位
+    return round(peak / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+
+def percentile(samples, pct):
+    ordered = sorted(samples)
+    if not ordered:
+        return 0.0
+    index = min(len(ordered) - 1, max(0, int(round(pct / 100 * len(ordered))) - 1))
+    return ordered[index]
+
+
+def time_calls(func, args_list, warmup):
+    for args in args_list[:warmup]:
+        func(*args)
+    samples = []
+    start = time.perf_counter()
+    for args in args_list:
+        call_start = time.perf_counter()
+        func(*args)
+        samples.append(time.perf_counter() - call_start)
+    return samples, time.perf_counter() - start
+
+
+def summarize(samples, total, items):
+    return {
+        "calls": len(samples),
+        "items": items,
+        "total_s": round(total, 4),
+        "throughput_per_s": round(items / total, 2) if total else None,
+        "p50_ms": round(percentile(samples, 50) * 1000, 3),
+        "p99_ms": round(percentile(samples, 99) * 1000, 3),
+        "mean_ms": round(statistics.fmean(samples) * 1000, 3) if samples else 0.0,
+    }
+
+
+def run_benchmark(name, args):
+    problems_list, raw_output = make_worksheet(args.problems, args.formulas, seed=args.seed)
+
+    if name == "generate_math_assets":
+        from src.services.export_render import collect_math_expressions, generate_math_assets, math_asset_cache
+
+        texts = [item[field] for item in problems_list for field in ("problem", "answer", "explanation")]
+        expressions = collect_math_expressions(texts)
+
+        def render(expression):
+            if not args.warm:
+                math_asset_cache.clear()
+            generate_math_assets(expression)
+
+        samples, total = time_calls(render, [(expr,) for expr in expressions] * args.iterations, args.warmup)
+        return summarize(samples, total, len(samples))
+
+    if name == "split_text_with_math":
+        from src.services.math_text import split_text_with_math
+
+        texts = [(item[field],) for item in problems_list for field in ("problem", "answer", "explanation")]
+        samples, total = time_calls(split_text_with_math, texts * args.iterations, args.warmup)
+        return summarize(samples, total, len(samples))
+
+    if name == "parse_generated_problems":
+        from src.routes.math_problem import parse_generated_problems
+
+        samples, total = time_calls(parse_generated_problems, [(raw_output,)] * args.iterations, args.warmup)
+        return summarize(samples, total, len(samples) * args.problems)
+
+    if name == "dedup_problems":
+        from src.services.problem_dedup import ProblemDeduplicator
+
+        # 別の seed のワークシートで索引を埋めてから、1セット分の照合（セット内 + 過去の問題）を計測する
+        deduplicator = ProblemDeduplicator(capacity=args.dedup_index)
+        seed = args.seed + 1
+        while deduplicator.recent.size < args.dedup_index:
+            indexed, _ = make_worksheet(min(1000, args.dedup_index - deduplicator.recent.size), args.formulas, seed=seed)
+            deduplicator.remember(deduplicator.signatures([item["problem"] for item in indexed]))
+            seed += 1
+
+        samples, total = time_calls(deduplicator.find_duplicates, [(problems_list,)] * args.iterations, args.warmup)
+        result = summarize(samples, total, len(samples) * args.problems)
+        result["indexed"] = deduplicator.recent.size
+        result["per_problem_ms"] = round(result["mean_ms"] / args.problems, 4)
+        return result
+
+    return run_export_benchmark(name, args, problems_list)
+
+
+def run_export_benchmark(name, args, problems_list):
+    # export_pdf / export_word はルート経由で計測する（JSONの受け取りからレスポンス生成まで）
+    from flask import Flask
+    from src.routes.math_problem import math_bp
+    from src.services.export_render import math_asset_cache
+
+    app = Flask(__name__)
+    app.register_blueprint(math_bp, url_prefix="/api")
+    client = app.test_client()
+    url = "/api/export-pdf" if name == "export_pdf" else "/api/export-word"
+    payload = {
+        "metadata": {"grade": "中3", "unit": "二次方程式", "difficulty": "Level 2"},
+        "problems": problems_list,
+    }
+
+    def export():
+        if not args.warm:
+            math_asset_cache.clear()
+        response = client.post(url, json=payload)
+        if response.status_code != 200:
+            raise RuntimeError(f"{url} returned {response.status_code}: {response.get_data(as_text=True)[:200]}")
+        response.get_data()
+
+    samples, total = time_calls(export, [()] * args.iterations, args.warmup)
+    result = summarize(samples, total, len(samples) * args.problems)
+    return result
+
+
+def run_in_subprocess(name, args):
+    command = [
+        sys.executable, str(Path(__file__).resolve()), "--only", name,
+        "--problems", str(args.problems), "--formulas", str(args.formulas),
+        "--iterations", str(args.iterations), "--warmup", str(args.warmup), "--seed", str(args.seed),
+        "--dedup-index", str(args.dedup_index),
+    ]
+    if args.warm:
+        command.append("--warm")
+    completed = subprocess.run(command, capture_output=True, text=True)
+    if completed.returncode != 0:
+        return {"error": (completed.stderr or completed.stdout).strip().splitlines()[-1:]}
+    # 描画側の print が混ざるので最終行のJSONだけを読む
+    return json.loads(completed.stdout.strip().splitlines()[-1])
+
+
+def git_revision():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_table(results, baseline=None):
+    print(f"{'benchmark':<26} {'items/s':>10} {'p50 ms':>10} {'p99 ms':>10} {'peak RSS':>10}")
+    for name, result in results.items():
+        if "error" in result:
+            print(f"{name:<26} error: {result['error']}")
+            continue
+        line = (f"{name:<26} {result['throughput_per_s']:>10} {result['p50_ms']:>10} "
+                f"{result['p99_ms']:>10} {result['peak_rss_mb']:>8}MB")
+        previous = (baseline or {}).get(name)
+        if previous and previous.get("p50_ms"):
+            change = (result["p50_ms"] - previous["p50_ms"]) / previous["p50_ms"] * 100
+            line += f"  p50 {change:+.1f}% vs baseline"
+        print(line)
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Benchmark math rendering, parsing and PDF/Word export.")
+    parser.add_argument("--problems", type=int, default=20, help="Problems per synthetic worksheet (default: 20)")
+    parser.add_argument("--formulas", type=int, default=3, help="Formulas per problem (default: 3)")
+    parser.add_argument("--iterations", type=int, default=5, help="Repetitions of each benchmark (default: 5)")
+    parser.add_argument("--warmup", type=int, default=1, help="Untimed warm-up calls (default: 1)")
+    parser.add_argument("--seed", type=int, default=0, help="Seed for the synthetic worksheet")
+    parser.add_argument("--warm", action="store_true", help="Keep the math asset cache between calls")
+    parser.add_argument("--dedup-index", type=int, default=100_000,
+                        help="Problems indexed before timing dedup_problems (default: 100000)")
+    parser.add_argument("--benchmarks", default=",".join(BENCHMARKS), help="Comma-separated subset to run")
+    parser.add_argument("--output", help="Write results to this JSON file")
+    parser.add_argument("--compare", help="Earlier JSON result to compare against")
+    parser.add_argument("--only", choices=BENCHMARKS, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.only:
+        result = run_benchmark(args.only, args)
+        result["peak_rss_mb"] = peak_rss_mb()
+        print(json.dumps(result))
+        return 0
+
+    names = [name.strip() for name in args.benchmarks.split(",") if name.strip()]
+    unknown = [name for name in names if name not in BENCHMARKS]
+    if unknown:
+        parser.error(f"unknown benchmarks: {', '.join(unknown)}")
+
+    results = {}
+    for name in names:
+        print(f"running {name} ...", file=sys.stderr)
+        results[name] = run_in_subprocess(name, args)
+
+    report = {
+        "revision": git_revision(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "params": {
+            "problems": args.problems,
+            "formulas": args.formulas,
+            "iterations": args.iterations,
+            "warmup": args.warmup,
+            "seed": args.seed,
+            "dedup_index": args.dedup_index,
+            "warm_cache": args.warm,
+        },
+        "results": results,
+    }
+
+    baseline = None
+    if args.compare:
+        with open(args.compare, "r", encoding="utf-8") as f:
+            baseline = json.load(f).get("results")
+    print_table(results, baseline)
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"results written to {args.output}")
+    return 1 if any("error" in result for result in results.values()) else 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+"""Check that PDF/Word export survives math that mathtext cannot parse.
+
+Unparseable expressions (e.g. \\dfrac, which the prompt template suggests)
+must come out as escaped LaTeX text while the rest of the document still
+renders. Runs the batch prerender both in-process and through the worker
+pool, then exports through the Flask routes.
+"""
+import io
+import os
+import sys
+import zipfile
+from pathlib import Path
+
+os.environ.setdefault("OPENAI_API_KEY", "dummy-key")
+
+ROOT = Path(__file__).resolve().parents[1]
+if str(ROOT) not in sys.path:
+    sys.path.insert(0, str(ROOT))
+
+from flask import Flask
+
+from src.routes.math_problem import math_bp
+from src.services import export_render
+from src.services.export_render import generate_math_assets, math_asset_cache, render_math_batch
+
+UNPARSEABLE = [r"\pm\dfrac{\sqrt2}{2}", r"\frac{1}{", r"\left( x", r"\begin{cases}a\end{cases}"]
+PARSEABLE = [r"x^2 - 5x + 6 = 0", r"\frac{1}{2}", r"\sqrt{2}", r"x = 2, 3"]
+
+
+def check(condition, message):
+    if not condition:
+        raise AssertionError(message)
+    print(f"ok: {message}")
+
+
+def check_assets():
+    for expression in UNPARSEABLE:
+        check(generate_math_assets(expression) is None, f"generate_math_assets returns None for {expression!r}")
+    check(generate_math_assets(PARSEABLE[0]) is not None, "parseable math still renders")
+
+
+def check_batch(batch_min):
+    math_asset_cache.clear()
+    export_render.MATH_RENDER_BATCH_MIN = batch_min
+    expressions = [f"{expression} + {index}" for index in range(4) for expression in PARSEABLE] + UNPARSEABLE
+    rendered = render_math_batch(expressions)
+    check(rendered == len(expressions), f"render_math_batch (batch_min={batch_min}) keeps going past bad math")
+    check(math_asset_cache.stats()["entries"] == len(expressions) - len(UNPARSEABLE), "only renderable math is cached")
+
+
+def check_export():
+    app = Flask(__name__)
+    app.register_blueprint(math_bp, url_prefix="/api")
+    client = app.test_client()
+    payload = {
+        "metadata": {"grade": "中3", "unit": "二次方程式", "difficulty": "Level 2"},
+        "problems": [
+            {
+                "problem": f"次の式を計算せよ。 ${bad}$ と ${good}$",
+                "answer": f"$${bad}$$",
+                "explanation": f"${good}$ を使う。",
+            }
+            for bad, good in zip(UNPARSEABLE, PARSEABLE)
+        ],
+    }
+    response = client.post("/api/export-pdf", json=payload)
+    check(response.status_code == 200 and response.data.startswith(b"%PDF"), "PDF export succeeds with bad math")
+
+    response = client.post("/api/export-word", json=payload)
+    check(response.status_code == 200, "Word export succeeds with bad math")
+    with zipfile.ZipFile(io.BytesIO(response.data)) as archive:
+        document_xml = archive.read("word/document.xml").decode("utf-8")
+    # \dfrac is converted to OMML; the others fail both OMML and mathtext
+    check(r"\left( x" in document_xml, "Word output keeps unrenderable LaTeX as text")
+
+
+def main() -> int:
+    check_assets()
+    check_batch(batch_min=10 ** 6)
+    if export_render.MATH_RENDER_WORKERS > 0:
+        check_batch(batch_min=1)
+    check_export()
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
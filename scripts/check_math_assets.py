@@ -9,21 +9,23 @@ from pathlib import Path
 os.environ.setdefault('OPENAI_API_KEY', 'dummy-key')
 
 ROOT = Path(__file__).resolve().parents[1]
-SRC_DIR = ROOT / "src"
-if str(SRC_DIR) not in sys.path:
-    sys.path.insert(0, str(SRC_DIR))
+if str(ROOT) not in sys.path:
+    sys.path.insert(0, str(ROOT))
 
-from routes.math_problem import generate_math_assets
+from src.services.export_render import generate_math_assets, math_asset_cache
 
 
 def main() -> int:
-    parser = argparse.ArgumentParser(description="Inspect PNG/SVG math asset generation.")
+    parser = argparse.ArgumentParser(description="Inspect PNG/vector math asset generation.")
     parser.add_argument("--expression", required=True, help="LaTeX expression to render (without surrounding $)")
     parser.add_argument("--display", action="store_true", help="Render expression in display mode")
     parser.add_argument("--dpi", type=int, default=300, help="DPI used for rendering (default: 300)")
+    parser.add_argument("--repeat", type=int, default=1, help="Render the expression N times to exercise the asset cache")
     args = parser.parse_args()
 
-    assets = generate_math_assets(args.expression, display=args.display, dpi=args.dpi)
+    assets = None
+    for _ in range(max(1, args.repeat)):
+        assets = generate_math_assets(args.expression, display=args.display, dpi=args.dpi)
     if not assets:
         print("No assets were generated.")
         return 1
@@ -32,11 +34,13 @@ def main() -> int:
     print(f"PNG size: {width_pt:.2f}pt x {height_pt:.2f}pt")
     print(f"PNG bytes: {len(png_buffer.getvalue())}")
     if drawing is None:
-        print("SVG drawing: not generated (falling back to PNG)")
+        print("Vector drawing: not generated (falling back to PNG)")
     else:
-        print("SVG drawing: available")
+        print("Vector drawing: available")
         print(f"  drawing width: {getattr(drawing, 'width', 'unknown')} pt")
         print(f"  drawing height: {getattr(drawing, 'height', 'unknown')} pt")
+    stats = math_asset_cache.stats()
+    print(f"Cache: {stats['hits']} hits, {stats['disk_hits']} disk hits, {stats['misses']} misses")
     return 0
 
 
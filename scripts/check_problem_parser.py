@@ -0,0 +1,173 @@
+#!/usr/bin/env python
+"""Check parse_generated_problems against the golden corpus and benchmark it.
+
+The golden corpus (scripts/fixtures/problem_parser_golden.json) was recorded
+from the original regex-per-call parser. The legacy implementation is kept
+below so the benchmark can report the speedup on large outputs.
+"""
+import argparse
+import json
+import os
+import re
+import sys
+import time
+from pathlib import Path
+
+os.environ.setdefault("OPENAI_API_KEY", "dummy-key")
+
+ROOT = Path(__file__).resolve().parents[1]
+if str(ROOT) not in sys.path:
+    sys.path.insert(0, str(ROOT))
+
+from src.routes.math_problem import parse_generated_problems
+
+GOLDEN_PATH = ROOT / "scripts" / "fixtures" / "problem_parser_golden.json"
+
+
+def legacy_normalize_latex_spacing(text):
+    if not text:
+        return text
+    text = str(text)
+
+    def _collapse_display(match):
+        inner = ' '.join(match.group(1).strip().split())
+        return r'\[' + inner + r'\]'
+
+    text = re.sub(r'\\\[\s*(.*?)\s*\\\]', _collapse_display, text, flags=re.S)
+
+    def _collapse_inline(match):
+        inner = ' '.join(match.group(1).strip().split())
+        return r'\(' + inner + r'\)'
+
+    text = re.sub(r'\\\(\s*(.*?)\s*\\\)', _collapse_inline, text, flags=re.S)
+    text = re.sub(r'\\\s+([\\()\\[\\]])', lambda m: '\\' + m.group(1), text)
+    text = re.sub(r'\\\s+([A-Za-z]+)', r'\\\1', text)
+    return text
+
+
+def legacy_strip_step_markers(text):
+    if not text:
+        return text
+    filtered_lines = []
+    for line in str(text).splitlines():
+        stripped = line.strip()
+        if stripped.startswith('主要ステップ') or stripped.startswith('最終解'):
+            continue
+        filtered_lines.append(line)
+    return '\n'.join(filtered_lines).strip()
+
+
+def legacy_parse_generated_problems(raw_text):
+    if not raw_text:
+        return []
+    text = str(raw_text).strip()
+    if not text:
+        return []
+    problem_pattern = re.compile(r'(?:^|\n)\s*(?:【\s*)?問題\s*(\d+)\s*(?:】|[:：]|[.)．])', re.IGNORECASE)
+    matches = list(problem_pattern.finditer(text))
+    if not matches:
+        return []
+    problems = []
+    answer_pattern = re.compile(r'(?:【\s*解答\s*(\d+)\s*】|解答\s*(\d+)\s*(?:[:：]|[.)．]))', re.IGNORECASE)
+    explanation_pattern = re.compile(r'(?:【\s*解説\s*(\d+)\s*】|解説\s*(\d+)\s*(?:[:：]|[.)．]))', re.IGNORECASE)
+    for idx, match in enumerate(matches):
+        number = int(match.group(1)) if match.group(1) else idx + 1
+        end_idx = matches[idx + 1].start() if idx + 1 < len(matches) else len(text)
+        block = text[match.end():end_idx].strip()
+        answer_body = None
+        explanation_body = None
+        problem_body = block
+        answer_match = answer_pattern.search(block)
+        if answer_match:
+            problem_body = block[:answer_match.start()].strip()
+            remainder = block[answer_match.end():].strip()
+            explanation_match = explanation_pattern.search(remainder)
+            if explanation_match:
+                answer_body = remainder[:explanation_match.start()].strip() or None
+                explanation_body = remainder[explanation_match.end():].strip() or None
+            else:
+                answer_body = remainder or None
+        else:
+            explanation_match = explanation_pattern.search(block)
+            if explanation_match:
+                problem_body = block[:explanation_match.start()].strip()
+                explanation_body = block[explanation_match.end():].strip() or None
+        title = None
+        title_match = re.match(r'^(?:タイトル|題名)[:：]\s*(.*)$', problem_body)
+        if title_match:
+            title = title_match.group(1).strip()
+            problem_body = problem_body[title_match.end():].strip()
+        problem_body = legacy_normalize_latex_spacing(problem_body) if problem_body else None
+        answer_body = legacy_normalize_latex_spacing(answer_body) if answer_body else None
+        explanation_body = legacy_normalize_latex_spacing(explanation_body) if explanation_body else None
+        problem_body = legacy_strip_step_markers(problem_body) if problem_body else None
+        answer_body = legacy_strip_step_markers(answer_body) if answer_body else None
+        explanation_body = legacy_strip_step_markers(explanation_body) if explanation_body else None
+        problems.append({
+            'number': number,
+            'title': title,
+            'problem': problem_body or None,
+            'answer': answer_body,
+            'explanation': explanation_body,
+        })
+    return problems
+
+
+def synthetic_output(count):
+    blocks = []
+    for idx in range(1, count + 1):
+        blocks.append(
+            f"【問題{idx}】\n次の方程式を解け。 \\( x^2 - {idx + 3}x + {idx * 2} = 0 \\)\n"
+            f"【解答{idx}】\n\\(x = {idx}\\), \\(x = 2\\)\n"
+            f"【解説{idx}】\n左辺を因数分解すると $$ (x - {idx})(x - 2) = 0 $$ となる。\n"
+            f"したがって \\( x = {idx} \\) または \\( x = 2 \\) である。"
+        )
+    return "\n\n".join(blocks)
+
+
+def check_golden():
+    cases = json.loads(GOLDEN_PATH.read_text(encoding="utf-8"))
+    failures = 0
+    for case in cases:
+        actual = parse_generated_problems(case["input"])
+        if actual != case["expected"]:
+            failures += 1
+            print(f"FAIL {case['name']}")
+            print(f"  expected: {case['expected']}")
+            print(f"  actual:   {actual}")
+    print(f"golden corpus: {len(cases) - failures}/{len(cases)} cases match")
+    return failures
+
+
+def bench(func, text, repeat):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(text)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Golden-output check and microbenchmark for parse_generated_problems.")
+    parser.add_argument("--bench", action="store_true", help="Also run the microbenchmark")
+    parser.add_argument("--sizes", default="3,30,300", help="Comma-separated problem counts to benchmark (default: 3,30,300)")
+    parser.add_argument("--repeat", type=int, default=20, help="Repetitions per size; the best time is reported (default: 20)")
+    args = parser.parse_args()
+
+    failures = check_golden()
+    if args.bench:
+        print(f"\n{'problems':>8} {'chars':>8} {'legacy':>10} {'current':>10} {'speedup':>8}")
+        for size in [int(value) for value in args.sizes.split(",") if value.strip()]:
+            text = synthetic_output(size)
+            if legacy_parse_generated_problems(text) != parse_generated_problems(text):
+                print(f"output mismatch for {size} problems")
+                failures += 1
+            legacy = bench(legacy_parse_generated_problems, text, args.repeat)
+            current = bench(parse_generated_problems, text, args.repeat)
+            print(f"{size:>8} {len(text):>8} {legacy * 1000:>8.2f}ms {current * 1000:>8.2f}ms {legacy / current:>7.2f}x")
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
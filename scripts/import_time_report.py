@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+"""Report how long it takes to import the app (or any module) in a fresh interpreter."""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parents[1]
+HEAVY_MODULES = ("matplotlib", "reportlab", "docx", "PIL", "numpy", "svglib")
+
+
+def run_import(module, importtime=False):
+    env = dict(os.environ)
+    env.setdefault("OPENAI_API_KEY", "dummy-key")
+    code = (
+        "import sys, time\n"
+        "start = time.perf_counter()\n"
+        f"import {module}\n"
+        "elapsed = time.perf_counter() - start\n"
+        f"heavy = [name for name in {HEAVY_MODULES!r} if name in sys.modules]\n"
+        "print(f'{elapsed:.6f}')\n"
+        "print(','.join(heavy))\n"
+    )
+    command = [sys.executable]
+    if importtime:
+        command += ["-X", "importtime"]
+    command += ["-c", code]
+    result = subprocess.run(command, cwd=ROOT, env=env, capture_output=True, text=True)
+    if result.returncode != 0:
+        raise RuntimeError(result.stderr.strip().splitlines()[-1] if result.stderr else "import failed")
+    lines = result.stdout.strip().splitlines()
+    heavy = [name for name in lines[-1].split(",") if name] if len(lines) > 1 else []
+    return float(lines[-2] if len(lines) > 1 else lines[-1]), heavy, result.stderr
+
+
+def parse_importtime(stderr):
+    rows = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        try:
+            self_us, cumulative_us, name = line[len("import time:"):].split("|")
+            rows.append((int(cumulative_us), int(self_us), name.rstrip()))
+        except ValueError:
+            continue
+    return rows
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Measure cold import time of the Flask app.")
+    parser.add_argument("--module", default="src.main", help="Module to import (default: src.main)")
+    parser.add_argument("--repeat", type=int, default=3, help="Fresh interpreters to average over (default: 3)")
+    parser.add_argument("--top", type=int, default=15, help="Top-level imports to list by cumulative time (default: 15)")
+    args = parser.parse_args()
+
+    timings = []
+    heavy = []
+    for _ in range(max(1, args.repeat)):
+        elapsed, heavy, _ = run_import(args.module)
+        timings.append(elapsed)
+    _, _, stderr = run_import(args.module, importtime=True)
+
+    print(f"import {args.module}: median {statistics.median(timings) * 1000:.1f}ms over {len(timings)} runs")
+    print(f"heavy modules loaded: {', '.join(heavy) if heavy else 'none'}")
+    # Keep the most expensive import of each top-level package.
+    packages = {}
+    for cumulative_us, self_us, name in parse_importtime(stderr):
+        package = name.strip().split(".")[0]
+        if package not in packages or cumulative_us > packages[package][0]:
+            packages[package] = (cumulative_us, name.strip())
+    rows = sorted(packages.values(), reverse=True)
+    print(f"\n{'cumulative':>12}  package (outermost import)")
+    for cumulative_us, name in rows[:args.top]:
+        print(f"{cumulative_us / 1000:>10.1f}ms  {name}")
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+"""Drive the analyze -> generate flow concurrently against a running server.
+
+Start the server with LLM_BACKEND=fake (optionally LLM_FAKE_LATENCY_MS and
+LLM_FAKE_RESPONSES) to measure server-side overhead without calling OpenAI.
+
+Each flow sends a different problem so that request coalescing, the analysis
+cache and duplicate-problem detection do not collapse the load into a single
+request. Pass --same-problem to measure those paths instead.
+"""
+import argparse
+import statistics
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+SAMPLE_PROBLEM = "次の方程式を解け。 $x^2 - 5x + 6 = 0$"
+
+
+def sample_problem(index):
+    # Roots (2 + index, 3 + 2 * index) give a distinct equation per flow
+    first, second = 2 + index, 3 + 2 * index
+    return f"次の方程式を解け。 $x^2 - {first + second}x + {first * second} = 0$"
+
+
+def run_flow(base_url, problem, count, timeout):
+    timings = {}
+    session = requests.Session()
+
+    start = time.perf_counter()
+    response = session.post(f"{base_url}/api/analyze", json={"problem_text": problem, "bypass_cache": True}, timeout=timeout)
+    response.raise_for_status()
+    timings["analyze"] = time.perf_counter() - start
+    analysis = response.json()["analysis"]
+
+    start = time.perf_counter()
+    response = session.post(
+        f"{base_url}/api/generate",
+        json={"analysis": analysis, "original_problem": problem, "count": count},
+        timeout=timeout,
+    )
+    response.raise_for_status()
+    timings["generate"] = time.perf_counter() - start
+    return timings
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(fraction * (len(ordered) - 1)))))
+    return ordered[index]
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Concurrent load test for the analyze/generate endpoints.")
+    parser.add_argument("--base-url", default="http://127.0.0.1:5001", help="Server base URL (default: http://127.0.0.1:5001)")
+    parser.add_argument("--requests", type=int, default=50, help="Number of analyze+generate flows to run (default: 50)")
+    parser.add_argument("--concurrency", type=int, default=8, help="Concurrent clients (default: 8)")
+    parser.add_argument("--count", type=int, default=3, help="Problems requested per generation (default: 3)")
+    parser.add_argument("--timeout", type=float, default=120, help="Per-request timeout in seconds (default: 120)")
+    parser.add_argument("--same-problem", action="store_true", help="Send the same problem in every flow (exercises coalescing and dedup)")
+    args = parser.parse_args()
+
+    results = {"analyze": [], "generate": []}
+    errors = 0
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        futures = [
+            executor.submit(
+                run_flow,
+                args.base_url.rstrip("/"),
+                SAMPLE_PROBLEM if args.same_problem else sample_problem(index),
+                args.count,
+                args.timeout,
+            )
+            for index in range(args.requests)
+        ]
+        for future in futures:
+            try:
+                timings = future.result()
+            except Exception as exc:
+                errors += 1
+                print(f"request failed: {exc}")
+                continue
+            for name, value in timings.items():
+                results[name].append(value)
+    elapsed = time.perf_counter() - start
+
+    print(f"flows: {args.requests}  concurrency: {args.concurrency}  errors: {errors}  wall: {elapsed:.2f}s")
+    print(f"throughput: {(args.requests - errors) / elapsed:.2f} flows/s")
+    for name, values in results.items():
+        if not values:
+            continue
+        print(
+            f"{name:>9}: p50 {percentile(values, 0.5) * 1000:.1f}ms"
+            f"  p99 {percentile(values, 0.99) * 1000:.1f}ms"
+            f"  mean {statistics.mean(values) * 1000:.1f}ms"
+        )
+    return 1 if errors else 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+"""Write .gz (and .br when the brotli package is installed) copies of compressible files under src/static."""
+import argparse
+import gzip
+import os
+import sys
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parents[1]
+COMPRESSIBLE_SUFFIXES = (".js", ".css", ".html", ".svg", ".json", ".ttf", ".otf", ".eot", ".ico", ".map", ".txt")
+MIN_SIZE = 1024
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+def compress_file(path, force=False):
+    data = path.read_bytes()
+    written = []
+    variants = [(".gz", lambda raw: gzip.compress(raw, compresslevel=9, mtime=0))]
+    if brotli is not None:
+        variants.append((".br", lambda raw: brotli.compress(raw, quality=11)))
+    for suffix, compress in variants:
+        target = path.with_name(path.name + suffix)
+        if not force and target.exists() and target.stat().st_mtime >= path.stat().st_mtime:
+            continue
+        compressed = compress(data)
+        # 小さくならないものは置かない（配信時は元のファイルを使う）
+        if len(compressed) >= len(data) * 0.9:
+            if target.exists():
+                target.unlink()
+            continue
+        target.write_bytes(compressed)
+        written.append((target, len(data), len(compressed)))
+    return written
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--static-dir", default=str(ROOT / "src" / "static"), help="Static folder (default: src/static)")
+    parser.add_argument("--force", action="store_true", help="Recompress files even if the variants are up to date")
+    args = parser.parse_args()
+
+    static_dir = Path(args.static_dir)
+    if not static_dir.is_dir():
+        print(f"static folder not found: {static_dir}", file=sys.stderr)
+        return 1
+    if brotli is None:
+        print("brotli is not installed; writing gzip variants only")
+
+    total_before = total_after = 0
+    for dirpath, _, filenames in os.walk(static_dir):
+        for filename in sorted(filenames):
+            path = Path(dirpath) / filename
+            if path.suffix.lower() not in COMPRESSIBLE_SUFFIXES or path.stat().st_size < MIN_SIZE:
+                continue
+            for target, before, after in compress_file(path, force=args.force):
+                total_before += before
+                total_after += after
+                print(f"{target.relative_to(static_dir)}: {before} -> {after} bytes")
+    if total_before:
+        print(f"total: {total_before} -> {total_after} bytes")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
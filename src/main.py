@@ -6,11 +6,13 @@ import sys
 # DON'T CHANGE THIS !!!
 sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
 
-from flask import Flask, send_from_directory
+from flask import Flask, request
 from flask_cors import CORS
 from src.models.user import db
 from src.routes.user import user_bp
 from src.routes.math_problem import math_bp
+from src.services.problem_bank import init_problem_bank_index
+from src.services.static_files import StaticIndex
 
 app = Flask(__name__, static_folder=os.path.join(os.path.dirname(__file__), 'static'))
 app.config['SECRET_KEY'] = 'asdf#FGSgvasgf$5$WGT'
@@ -21,12 +23,28 @@ CORS(app)
 app.register_blueprint(user_bp, url_prefix='/api')
 app.register_blueprint(math_bp, url_prefix='/api')
 
-# uncomment if you need to use database
-# app.config['SQLALCHEMY_DATABASE_URI'] = f"sqlite:///{os.path.join(os.path.dirname(__file__), 'database', 'app.db')}"
-# app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-# db.init_app(app)
-# with app.app_context():
-#     db.create_all()
+# 解析キャッシュなどを保存するデータベース（DATABASE_URL で変更可能）
+database_dir = os.path.join(os.path.dirname(__file__), 'database')
+os.makedirs(database_dir, exist_ok=True)
+app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('DATABASE_URL') or f"sqlite:///{os.path.join(database_dir, 'app.db')}"
+app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {'connect_args': {'timeout': 15}} if app.config['SQLALCHEMY_DATABASE_URI'].startswith('sqlite') else {}
+db.init_app(app)
+with app.app_context():
+    try:
+        db.create_all()
+        if db.engine.dialect.name == 'sqlite':
+            # 複数ワーカーからの読み書きが互いに待たないよう WAL モードにする
+            with db.engine.connect() as conn:
+                conn.exec_driver_sql('PRAGMA journal_mode=WAL')
+        init_problem_bank_index()
+    except Exception as e:
+        # 他のワーカーが同時にテーブルを作成した場合など
+        print(f"データベースの初期化に失敗しました: {e}")
+
+# 静的ファイルは起動時に一覧を作っておく（ファイルを差し替えたら再起動する。デバッグ時は見つからなければ作り直す）
+static_index = StaticIndex(app.static_folder)
+
 
 @app.route('/', defaults={'path': ''})
 @app.route('/<path:path>')
@@ -35,14 +53,16 @@ def serve(path):
     if static_folder_path is None:
             return "Static folder not configured", 404
 
-    if path != "" and os.path.exists(os.path.join(static_folder_path, path)):
-        return send_from_directory(static_folder_path, path)
-    else:
-        index_path = os.path.join(static_folder_path, 'index.html')
-        if os.path.exists(index_path):
-            return send_from_directory(static_folder_path, 'index.html')
-        else:
+    static_file = static_index.get(path) if path != "" else None
+    if static_file is None and path != "" and app.debug:
+        static_index.refresh()
+        static_file = static_index.get(path)
+    if static_file is None:
+        # SPA のルーティング用に、ファイルがなければ index.html を返す
+        static_file = static_index.get('index.html')
+        if static_file is None:
             return "index.html not found", 404
+    return static_index.send(static_file, request.headers.get('Accept-Encoding'))
 
 
 if __name__ == '__main__':
@@ -0,0 +1,26 @@
+from src.models.user import db
+
+class AnalysisCacheEntry(db.Model):
+    __tablename__ = 'analysis_cache'
+
+    cache_key = db.Column(db.String(64), primary_key=True)
+    template_version = db.Column(db.String(64), nullable=False)
+    model = db.Column(db.String(64), nullable=False)
+    analysis_json = db.Column(db.Text, nullable=False)
+    raw_response = db.Column(db.Text, nullable=False, default='')
+    created_at = db.Column(db.Float, nullable=False, index=True)
+    last_used_at = db.Column(db.Float, nullable=False, index=True)
+    hit_count = db.Column(db.Integer, nullable=False, default=0)
+
+    def __repr__(self):
+        return f'<AnalysisCacheEntry {self.cache_key[:12]}>'
+
+    def to_dict(self):
+        return {
+            'cache_key': self.cache_key,
+            'template_version': self.template_version,
+            'model': self.model,
+            'created_at': self.created_at,
+            'last_used_at': self.last_used_at,
+            'hit_count': self.hit_count,
+        }
@@ -0,0 +1,48 @@
+from src.models.user import db
+
+class BankProblem(db.Model):
+    __tablename__ = 'problem_bank'
+    __table_args__ = (
+        db.Index('ix_problem_bank_grade_unit_difficulty', 'grade', 'unit', 'difficulty'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    content_hash = db.Column(db.String(64), unique=True, nullable=False)
+    grade = db.Column(db.String(32), nullable=False, default='', index=True)
+    unit = db.Column(db.String(128), nullable=False, default='', index=True)
+    difficulty = db.Column(db.String(64), nullable=False, default='', index=True)
+    title = db.Column(db.Text)
+    problem = db.Column(db.Text, nullable=False)
+    answer = db.Column(db.Text)
+    explanation = db.Column(db.Text)
+    template_version = db.Column(db.String(64))
+    created_at = db.Column(db.Float, nullable=False)
+    served_count = db.Column(db.Integer, nullable=False, default=0)
+    last_served_at = db.Column(db.Float, nullable=False, default=0, index=True)
+
+    def __repr__(self):
+        return f'<BankProblem {self.id} {self.unit}>'
+
+    def to_problem(self, number):
+        # parse_generated_problems と同じ形で返す
+        return {
+            'number': number,
+            'title': self.title,
+            'problem': self.problem,
+            'answer': self.answer,
+            'explanation': self.explanation,
+        }
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'grade': self.grade,
+            'unit': self.unit,
+            'difficulty': self.difficulty,
+            'title': self.title,
+            'problem': self.problem,
+            'answer': self.answer,
+            'explanation': self.explanation,
+            'created_at': self.created_at,
+            'served_count': self.served_count,
+        }
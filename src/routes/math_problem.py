@@ -1,258 +1,146 @@
 import os
 import base64
-import io
 import json
 import re
+import threading
+import time
 import traceback
-from flask import Blueprint, request, jsonify, send_file
-from openai import OpenAI, APIConnectionError
-from PIL import Image as PILImage
-import requests
-from reportlab.lib.pagesizes import A4
-from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer, PageBreak, Image as RLImage, KeepTogether
-from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
-from xml.sax.saxutils import escape
-from reportlab.lib.units import inch
-from reportlab.pdfbase import pdfmetrics
-from reportlab.graphics import renderPDF
-from reportlab.pdfbase.cidfonts import UnicodeCIDFont
-from docx import Document
-from docx.shared import Inches, Pt
-import matplotlib
-from matplotlib import rcParams
-matplotlib.use('Agg')
-rcParams['mathtext.fontset'] = 'stix'
-rcParams['font.family'] = 'STIXGeneral'
-rcParams['mathtext.default'] = 'regular'
-from matplotlib.mathtext import math_to_image
-from matplotlib.font_manager import FontProperties
-
-try:
-    from svglib.svglib import svg2rlg
-except ImportError:
-    svg2rlg = None
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from flask import Blueprint, Response, current_app, request, jsonify, send_file, stream_with_context
+from openai import APIConnectionError
+
+from src.services.llm_backend import LLMBusyError, create_llm_client
+from src.services.math_text import normalize_latex_spacing, strip_step_markers
+from src.services.export_jobs import create_job_store_from_env, create_job_runner_from_env
+from src.services.metrics import (
+    current_timings,
+    finish_request,
+    record_coalesced,
+    record_duplicate_problem,
+    record_llm_usage,
+    registry,
+    server_timing_enabled,
+    span,
+    start_request,
+    track_background,
+)
+from src.services.analysis_cache import (
+    analysis_cache_enabled,
+    get_cached_analysis,
+    make_analysis_cache_key,
+    store_cached_analysis,
+)
+from src.services.problem_bank import (
+    normalize_bank_mode,
+    problem_bank_enabled,
+    search_bank_problems,
+    store_problems,
+    take_bank_problems,
+)
+from src.services.request_coalescing import create_coalescer_from_env, make_request_key
+from src.services.prompt_templates import (
+    ANALYSIS_RESPONSE_FORMAT,
+    GENERATION_RESPONSE_FORMAT,
+    PromptTemplateManager,
+    build_analysis_messages,
+    build_generation_messages,
+    json_output_enabled,
+)
 
 math_bp = Blueprint('math', __name__)
 
-DEFAULT_FONT_NAME = 'HeiseiKakuGo-W5'
-try:
-    pdfmetrics.registerFont(UnicodeCIDFont(DEFAULT_FONT_NAME))
-except Exception:
-    DEFAULT_FONT_NAME = 'Helvetica'
-# OpenAI クライアントの初期化
-client = OpenAI()
 
-def load_prompt_template():
-    template_path = os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(__file__))), 'prompt_template.txt')
-    with open(template_path, 'r', encoding='utf-8') as f:
-        return f.read()
-
-
-MATH_PATTERN = re.compile(
-    r'(?<!\\)(?:\$\$.*?(?<!\\)\$\$|\$(?!\s).*?(?<!\\)\$|\\\(.*?(?<!\\)\\\)|\\\[.*?(?<!\\)\\\])',
-    re.DOTALL,
-)
+@math_bp.before_request
+def start_request_timings():
+    start_request(request.endpoint)
 
 
+@math_bp.after_request
+def finish_request_timings(response):
+    timings = current_timings()
+    if timings is None:
+        return response
+    if server_timing_enabled():
+        response.headers['Server-Timing'] = timings.server_timing()
+    # ストリーミング応答は最後のチャンクを送り終えた時点で計測を終える
+    method, status = request.method, response.status_code
+    response.call_on_close(lambda: finish_request(timings, method, status))
+    return response
 
+# 非同期出力ジョブ（EXPORT_JOB_DIR / EXPORT_JOB_TTL / EXPORT_JOB_MAX / EXPORT_JOB_WORKERS で設定）
+export_job_store = create_job_store_from_env()
+export_job_runner = create_job_runner_from_env(export_job_store)
 
-def split_text_with_math(value):
-    segments = []
-    if not value:
-        return segments
-    last = 0
-    for match in MATH_PATTERN.finditer(value):
-        start_idx, end_idx = match.span()
-        if start_idx > last:
-            segments.append(('text', value[last:start_idx], False))
-        expr = match.group()
-        display = False
-        content = expr
-        if expr.startswith('$$') and expr.endswith('$$'):
-            content = expr[2:-2]
-            display = True
-        elif expr.startswith('$') and expr.endswith('$'):
-            content = expr[1:-1]
-            display = False
-        elif expr.startswith(r'\[') and expr.endswith(r'\]'):
-            content = expr[2:-2]
-            display = True
-        elif expr.startswith(r'\(') and expr.endswith(r'\)'):
-            content = expr[2:-2]
-            display = False
-        content = content.strip()
-        if content:
-            segments.append(('math', content, display))
-        last = end_idx
-    if last < len(value):
-        segments.append(('text', value[last:], False))
-    return segments
-
-
-
-
-
-def generate_math_assets(latex_expression, display=False, dpi=300):
-    expression = latex_expression.strip()
-    if expression.startswith('$$') and expression.endswith('$$') and len(expression) > 4:
-        expression = expression[2:-2].strip()
-    elif expression.startswith('$') and expression.endswith('$') and len(expression) > 2:
-        expression = expression[1:-1].strip()
-    if expression.startswith('\\(') and expression.endswith('\\)') and len(expression) > 4:
-        expression = expression[2:-2].strip()
-    if expression.startswith('\\[') and expression.endswith('\\]') and len(expression) > 4:
-        expression = expression[2:-2].strip()
-    if not expression:
-        return None
-    font_size = 16
-    prop = FontProperties(size=font_size, family='STIXGeneral')
-    math_string = f'$' + expression + '$'
-
-    png_buffer = io.BytesIO()
-    math_to_image(math_string, png_buffer, dpi=dpi, format='png', prop=prop, color='black')
-    png_buffer.seek(0)
-    with PILImage.open(png_buffer) as img:
-        width_px, height_px = img.size
-    png_buffer.seek(0)
-    width_points = width_px * 72 / dpi
-    height_points = height_px * 72 / dpi
-
-    drawing = None
-    if svg2rlg is not None:
-        svg_buffer = io.BytesIO()
-        try:
-            math_to_image(math_string, svg_buffer, dpi=dpi, format='svg', prop=prop, color='black')
-            svg_buffer.seek(0)
-            drawing = svg2rlg(svg_buffer)
-            if getattr(drawing, 'width', 0) and getattr(drawing, 'height', 0):
-                scale_x = width_points / drawing.width
-                scale_y = height_points / drawing.height
-                scale = min(scale_x, scale_y)
-                drawing.scale(scale, scale)
-                drawing.width *= scale
-                drawing.height *= scale
-                drawing.hAlign = 'LEFT'
-            else:
-                drawing = None
-        except Exception:
-            drawing = None
-        finally:
-            svg_buffer.close()
-    return png_buffer, width_points, height_points, drawing
-
-def render_math_to_image(latex_expression, display=False, dpi=300):
-    assets = generate_math_assets(latex_expression, display=display, dpi=dpi)
-    if not assets:
-        return None
-    png_buffer, width_points, height_points, _ = assets
-    png_buffer.seek(0)
-    return png_buffer, width_points, height_points
+_export_renderer = None
+_export_renderer_lock = threading.Lock()
 
 
+def load_export_renderer():
+    # matplotlib・reportlab・python-docx は最初の出力時に読み込む（解析・生成だけのワーカーは読み込まない）
+    global _export_renderer
+    if _export_renderer is None:
+        with _export_renderer_lock:
+            if _export_renderer is None:
+                from src.services import export_render
+                _export_renderer = export_render
+    return _export_renderer
 
 
+def warm_up_export_stack(start_pool=False):
+    try:
+        load_export_renderer().warm_up(start_pool=start_pool)
+    except Exception as e:
+        print(f"出力処理のウォームアップに失敗しました: {e}")
 
 
+# LLM クライアントの初期化（LLM_BACKEND=fake でオフラインの負荷試験用バックエンド）
+client = create_llm_client()
+ANALYSIS_MODEL = "gpt-4.1-mini"
+# 解析プロンプトの本文（src/services/prompt_templates.py の ANALYSIS_*）を変更したら上げる
+ANALYSIS_PROMPT_VERSION = '2'
 
+# prompt_template.txt はプロセスごとに一度だけ読み込み、更新されたときだけ読み直す
+prompt_templates = PromptTemplateManager()
 
+# 同じ内容の解析・類題生成が同時に来たらLLMの呼び出しを1回にまとめる（LLM_COALESCE / LLM_COALESCE_DIR / LLM_COALESCE_WAIT）
+llm_requests = create_coalescer_from_env()
 
 
+def _env_number(name, default):
+    try:
+        return type(default)(os.environ.get(name, default))
+    except (TypeError, ValueError):
+        return default
 
 
-def normalize_latex_spacing(text):
-    if not text:
-        return text
-    text = str(text)
+# 生成された問題のほぼ同じ問題を検出する（PROBLEM_DEDUP=flag（既定）で印を付けるだけ / drop で除いて不足分だけ生成し直す / off）
+_problem_dedup = None
+_problem_dedup_lock = threading.Lock()
+PROBLEM_DEDUP_RETRIES = max(0, _env_number('PROBLEM_DEDUP_RETRIES', 1))
 
-    def _collapse_display(match):
-        inner = match.group(1).strip()
-        inner = ' '.join(inner.split())
-        return r'\[' + inner + r'\]'
+# 問題数が多い類題生成は GENERATION_SHARD_SIZE 問ずつに分けて並行して呼び出す
+GENERATION_SHARD_SIZE = max(1, _env_number('GENERATION_SHARD_SIZE', 5))
+GENERATION_SHARD_CONCURRENCY = max(1, _env_number('GENERATION_SHARD_CONCURRENCY', 8))
+GENERATION_MAX_CONTINUATIONS = max(0, _env_number('GENERATION_MAX_CONTINUATIONS', 2))
+GENERATION_CONTINUE_PROMPT = '出力が途中で切れています。直前の出力の続きから、同じ形式で最後まで出力してください。'
 
-    text = re.sub(r'\\\[\s*(.*?)\s*\\\]', _collapse_display, text, flags=re.S)
+def coalesce_llm_request(key, func):
+    if llm_requests is None:
+        return func(), None
+    result, shared = llm_requests.run(key, func)
+    if shared:
+        record_coalesced(shared)
+    return result, shared
 
-    def _collapse_inline(match):
-        inner = match.group(1).strip()
-        inner = ' '.join(inner.split())
-        return r'\(' + inner + r'\)'
 
-    text = re.sub(r'\\\(\s*(.*?)\s*\\\)', _collapse_inline, text, flags=re.S)
+def load_prompt_template():
+    return prompt_templates.get()
 
-    text = re.sub(r'\\\s+([\\()\\[\\]])', lambda m: '\\' + m.group(1), text)
-    text = re.sub(r'\\\s+([A-Za-z]+)', r'\\\1', text)
-    return text
 
-def append_text_with_math_to_story(story, text, style):
-    if text is None:
-        return
-    text = strip_step_markers(text)
-    lines = str(text).splitlines() or ['']
-    for line in lines:
-        line = normalize_latex_spacing(line)
-        segments = split_text_with_math(line)
-        if not segments:
-            story.append(Spacer(1, 6))
-            continue
-        flow_items = []
-        for kind, value, display in segments:
-            if kind == 'text':
-                clean_text = value.strip()
-                if clean_text:
-                    flow_items.append(Paragraph(escape(clean_text), style))
-            elif kind == 'math':
-                assets = generate_math_assets(value, display=display)
-                if assets:
-                    png_buffer, width_pt, height_pt, drawing = assets
-                    if drawing is not None:
-                        print('[debug] using vector drawing for PDF')
-                        flow_items.append(renderPDF.GraphicsFlowable(drawing))
-                    else:
-                        print('[debug] falling back to PNG for PDF')
-                        png_buffer.seek(0)
-                        flow_items.append(RLImage(png_buffer, width=width_pt, height=height_pt))
-                else:
-                    print('[debug] no assets generated for expression')
-        if flow_items:
-            story.append(KeepTogether(flow_items))
-            story.append(Spacer(1, 6))
-
-
-def add_paragraph_with_math(document, text, style_name=None):
-    if text is None:
-        return
-    text = strip_step_markers(text)
-    lines = str(text).splitlines() or ['']
-    for line in lines:
-        line = normalize_latex_spacing(line)
-        segments = split_text_with_math(line)
-        if not segments:
-            continue
-        paragraph = document.add_paragraph()
-        if style_name:
-            paragraph.style = style_name
-        for kind, value, display in segments:
-            if kind == 'text':
-                clean_text = value.strip()
-                if clean_text:
-                    paragraph.add_run(clean_text)
-            elif kind == 'math':
-                rendered = render_math_to_image(value, display=display)
-                if rendered:
-                    img_buffer, width_pt, height_pt = rendered
-                    if display:
-                        paragraph.alignment = 1
-                    run = paragraph.add_run()
-                    run.add_picture(img_buffer, width=Pt(width_pt * 0.9))
-def strip_step_markers(text):
+def normalize_problem_text(text):
     if not text:
-        return text
-    filtered_lines = []
-    for line in str(text).splitlines():
-        stripped = line.strip()
-        if stripped.startswith('主要ステップ') or stripped.startswith('最終解'):
-            continue
-        filtered_lines.append(line)
-    return '\n'.join(filtered_lines).strip()
+        return ''
+    return ' '.join(normalize_latex_spacing(str(text)).split())
 
 
 def parse_structured_sections(raw_text):
@@ -341,10 +229,61 @@ def parse_analysis_output(raw_text, problem_text):
     return parsed
 
 
+PROBLEM_HEADER_PATTERN = re.compile(
+    r'(?:^|\n)\s*(?:【\s*)?問題\s*(\d+)\s*(?:】|[:：]|[.)．])',
+    re.IGNORECASE,
+)
+ANSWER_PATTERN = re.compile(
+    r'(?:【\s*解答\s*(\d+)\s*】|解答\s*(\d+)\s*(?:[:：]|[.)．]))',
+    re.IGNORECASE,
+)
+EXPLANATION_PATTERN = re.compile(
+    r'(?:【\s*解説\s*(\d+)\s*】|解説\s*(\d+)\s*(?:[:：]|[.)．]))',
+    re.IGNORECASE,
+)
+TITLE_PATTERN = re.compile(r'^(?:タイトル|題名)[:：]\s*(.*)$')
 
 
-
-
+def _clean_problem_field(body):
+    if not body:
+        return None
+    return strip_step_markers(normalize_latex_spacing(body))
+
+
+def _parse_problem_block(number, block):
+    answer_body = None
+    explanation_body = None
+    problem_body = block
+
+    answer_match = ANSWER_PATTERN.search(block)
+    if answer_match:
+        problem_body = block[:answer_match.start()].strip()
+        remainder = block[answer_match.end():].strip()
+        explanation_match = EXPLANATION_PATTERN.search(remainder)
+        if explanation_match:
+            answer_body = remainder[:explanation_match.start()].strip() or None
+            explanation_body = remainder[explanation_match.end():].strip() or None
+        else:
+            answer_body = remainder or None
+    else:
+        explanation_match = EXPLANATION_PATTERN.search(block)
+        if explanation_match:
+            problem_body = block[:explanation_match.start()].strip()
+            explanation_body = block[explanation_match.end():].strip() or None
+
+    title = None
+    title_match = TITLE_PATTERN.match(problem_body)
+    if title_match:
+        title = title_match.group(1).strip()
+        problem_body = problem_body[title_match.end():].strip()
+
+    return {
+        'number': number,
+        'title': title,
+        'problem': _clean_problem_field(problem_body) or None,
+        'answer': _clean_problem_field(answer_body),
+        'explanation': _clean_problem_field(explanation_body),
+    }
 
 
 def parse_generated_problems(raw_text):
@@ -354,74 +293,119 @@ def parse_generated_problems(raw_text):
     if not text:
         return []
 
-    problem_pattern = re.compile(
-        r'(?:^|\n)\s*(?:【\s*)?問題\s*(\d+)\s*(?:】|[:：]|[.)．])',
-        re.IGNORECASE,
-    )
-    matches = list(problem_pattern.finditer(text))
+    matches = list(PROBLEM_HEADER_PATTERN.finditer(text))
     if not matches:
         return []
 
     problems = []
-    answer_pattern = re.compile(
-        r'(?:【\s*解答\s*(\d+)\s*】|解答\s*(\d+)\s*(?:[:：]|[.)．]))',
-        re.IGNORECASE,
-    )
-    explanation_pattern = re.compile(
-        r'(?:【\s*解説\s*(\d+)\s*】|解説\s*(\d+)\s*(?:[:：]|[.)．]))',
-        re.IGNORECASE,
-    )
-
     for idx, match in enumerate(matches):
         number = int(match.group(1)) if match.group(1) else idx + 1
         start_idx = match.end()
         end_idx = matches[idx + 1].start() if idx + 1 < len(matches) else len(text)
         block = text[start_idx:end_idx].strip()
+        problems.append(_parse_problem_block(number, block))
 
-        answer_body = None
-        explanation_body = None
-        problem_body = block
-
-        answer_match = answer_pattern.search(block)
-        if answer_match:
-            problem_body = block[:answer_match.start()].strip()
-            remainder = block[answer_match.end():].strip()
-            explanation_match = explanation_pattern.search(remainder)
-            if explanation_match:
-                answer_body = remainder[:explanation_match.start()].strip() or None
-                explanation_body = remainder[explanation_match.end():].strip() or None
-            else:
-                answer_body = remainder or None
-        else:
-            explanation_match = explanation_pattern.search(block)
-            if explanation_match:
-                problem_body = block[:explanation_match.start()].strip()
-                explanation_body = block[explanation_match.end():].strip() or None
-
-        title = None
-        title_match = re.match(r'^(?:タイトル|題名)[:：]\s*(.*)$', problem_body)
-        if title_match:
-            title = title_match.group(1).strip()
-            problem_body = problem_body[title_match.end():].strip()
-
-        problem_body = normalize_latex_spacing(problem_body) if problem_body else None
-        answer_body = normalize_latex_spacing(answer_body) if answer_body else None
-        explanation_body = normalize_latex_spacing(explanation_body) if explanation_body else None
+    return problems
 
-        problem_body = strip_step_markers(problem_body) if problem_body else None
-        answer_body = strip_step_markers(answer_body) if answer_body else None
-        explanation_body = strip_step_markers(explanation_body) if explanation_body else None
 
+def parse_generated_problems_json(raw_text):
+    # JSON 出力モード（{"problems": [...]}）の応答を読む。JSON として読めなければ None を返す
+    try:
+        payload = json.loads(raw_text)
+    except (TypeError, ValueError):
+        return None
+    if isinstance(payload, dict):
+        payload = payload.get('problems')
+    if not isinstance(payload, list):
+        return None
+    problems = []
+    for item in payload:
+        if not isinstance(item, dict):
+            continue
+        problem_body = _clean_problem_field(str(item.get('problem') or '').strip())
+        if not problem_body:
+            continue
         problems.append({
-            'number': number,
-            'title': title,
-            'problem': problem_body or None,
-            'answer': answer_body,
-            'explanation': explanation_body,
+            'number': len(problems) + 1,
+            'title': str(item.get('title') or '').strip() or None,
+            'problem': problem_body,
+            'answer': _clean_problem_field(str(item.get('answer') or '').strip()),
+            'explanation': _clean_problem_field(str(item.get('explanation') or '').strip()),
         })
-
     return problems
 
+
+def json_problem_items(raw_text):
+    # JSON 出力モードの応答から問題オブジェクトを取り出す。途中で切れた出力からは閉じている問題だけを取り出す
+    try:
+        payload = json.loads(raw_text)
+        if isinstance(payload, dict):
+            payload = payload.get('problems')
+        return [item for item in payload if isinstance(item, dict)] if isinstance(payload, list) else []
+    except (TypeError, ValueError):
+        pass
+    text = str(raw_text or '')
+    key = text.find('"problems"')
+    position = text.find('[', key) if key >= 0 else -1
+    if position < 0:
+        return []
+    decoder = json.JSONDecoder()
+    items = []
+    position += 1
+    while True:
+        while position < len(text) and text[position] in ' \t\r\n,':
+            position += 1
+        try:
+            item, position = decoder.raw_decode(text, position)
+        except ValueError:
+            break
+        if isinstance(item, dict):
+            items.append(item)
+    return items
+
+
+def parse_generated_output(raw_text, json_output=False):
+    # JSON で読めなかった場合は、従来の【問題n】形式として読む
+    if json_output:
+        problems = parse_generated_problems_json(raw_text)
+        if problems is not None:
+            return problems
+        print("JSON形式で読み取れなかったため、類題生成の出力を従来の形式として読み取ります")
+    return parse_generated_problems(raw_text)
+
+
+class ProblemStreamParser:
+    """ストリーミング出力を受け取り、次の【問題n】見出しが届いた時点で直前の問題を確定させる"""
+
+    def __init__(self):
+        self.buffer = ''
+        self.emitted = 0
+
+    def feed(self, chunk):
+        self.buffer += chunk or ''
+        matches = list(PROBLEM_HEADER_PATTERN.finditer(self.buffer))
+        # 最後の見出し以降はまだ続きが届く可能性があるため確定しない
+        return self._emit(matches, len(matches) - 1)
+
+    def close(self):
+        text = self.buffer.rstrip()
+        matches = list(PROBLEM_HEADER_PATTERN.finditer(text))
+        return self._emit(matches, len(matches), text)
+
+    def _emit(self, matches, complete_count, text=None):
+        text = self.buffer if text is None else text
+        problems = []
+        while self.emitted < complete_count:
+            idx = self.emitted
+            match = matches[idx]
+            number = int(match.group(1)) if match.group(1) else idx + 1
+            end_idx = matches[idx + 1].start() if idx + 1 < len(matches) else len(text)
+            block = text[match.end():end_idx].strip()
+            problems.append(_parse_problem_block(number, block))
+            self.emitted += 1
+        return problems
+
+
 def build_problems_text(items):
     if not items:
         return ''
@@ -456,6 +440,96 @@ def normalize_problems_text(raw_text):
     return strip_step_markers('\n'.join(lines))
 
 
+PROMPT_TEMPLATE_ERROR = 'プロンプトテンプレートの読み込みに失敗しました'
+API_CONNECTION_ERROR = 'OpenAI APIへの接続に失敗しました。ネットワーク環境とAPIキーを確認してください。'
+LLM_BUSY_ERROR = '混雑しているため処理できませんでした。しばらくしてから再度お試しください。'
+
+
+class RequestFailed(Exception):
+    """エラーメッセージとステータスコードをルートへ返すための例外"""
+
+    def __init__(self, message, status):
+        super().__init__(message)
+        self.message = message
+        self.status = status
+
+
+def load_prompt_template_or_fail():
+    try:
+        with span('prompt'):
+            return load_prompt_template()
+    except Exception as e:
+        print(f"プロンプトテンプレート読み込みエラー: {e}")
+        raise RequestFailed(PROMPT_TEMPLATE_ERROR, 500)
+
+
+def run_analysis(problem_text, bypass_cache=False):
+    prompt_template = load_prompt_template_or_fail()
+
+    # 同じ例題（空白・LaTeX表記の揺れは正規化）の再解析はキャッシュから返す
+    use_cache = analysis_cache_enabled()
+    json_output = json_output_enabled()
+    cache_version = f'{prompt_template.version}:{ANALYSIS_PROMPT_VERSION}' + (':json' if json_output else '')
+    cache_key = make_analysis_cache_key(normalize_problem_text(problem_text), cache_version, ANALYSIS_MODEL)
+    if use_cache and not bypass_cache:
+        with span('cache'):
+            cached = get_cached_analysis(cache_key)
+        if cached is not None:
+            analysis_data, analysis_raw = cached
+            analysis_data['problem_text'] = problem_text
+            analysis_data['original_problem'] = problem_text
+            return {
+                'success': True,
+                'analysis': analysis_data,
+                'original_problem': problem_text,
+                'raw_response': analysis_raw,
+                'template_version': prompt_template.version,
+                'cached': True,
+            }
+
+    with span('prompt'):
+        analysis_messages = build_analysis_messages(prompt_template, problem_text, json_output=json_output)
+    # JSON 出力モードでは解析結果を JSON スキーマで縛る（parse_analysis_output は JSON を先に試す）
+    options = {'response_format': ANALYSIS_RESPONSE_FORMAT} if json_output else {}
+
+    def call_llm():
+        response = client.chat.completions.create(
+            model=ANALYSIS_MODEL,
+            messages=analysis_messages,
+            request_kind='analyze',
+            max_tokens=500,
+            temperature=0.3,
+            **options
+        )
+        record_llm_usage('analyze', response.usage)
+        return (response.choices[0].message.content or '').strip()
+
+    try:
+        with span('llm'):
+            analysis_raw, shared = coalesce_llm_request(f'analyze:{cache_key}', call_llm)
+    except APIConnectionError:
+        raise RequestFailed(API_CONNECTION_ERROR, 503)
+    except LLMBusyError:
+        raise RequestFailed(LLM_BUSY_ERROR, 503)
+
+    with span('parse'):
+        analysis_data = parse_analysis_output(analysis_raw, problem_text)
+    analysis_data.setdefault('problem_text', problem_text)
+    analysis_data.setdefault('original_problem', problem_text)
+
+    # 相乗りした場合は先に呼び出したリクエストが保存する
+    if use_cache and analysis_raw and not shared:
+        with span('cache'):
+            store_cached_analysis(cache_key, cache_version, ANALYSIS_MODEL, analysis_data, analysis_raw)
+
+    return {
+        'success': True,
+        'analysis': analysis_data,
+        'original_problem': problem_text,
+        'raw_response': analysis_raw,
+        'template_version': prompt_template.version,
+        'cached': False,
+    }
 
 
 @math_bp.route('/analyze', methods=['POST'])
@@ -470,58 +544,360 @@ def analyze_problem():
             return jsonify({'error': '問題文が入力されていません'}), 400
 
         try:
-            prompt_template = load_prompt_template()
-        except Exception as e:
-            print(f"プロンプトテンプレート読み込みエラー: {e}")
-            return jsonify({'error': 'プロンプトテンプレートの読み込みに失敗しました'}), 500
+            result = run_analysis(problem_text, bypass_cache=data.get('bypass_cache') or data.get('no_cache'))
+        except RequestFailed as e:
+            return jsonify({'error': e.message}), e.status
+
+        with span('serialize'):
+            return jsonify(result)
+
+    except Exception as e:
+        print(f"例題解析エラー: {e}")
+        traceback.print_exc()
+        return jsonify({'error': f'解析中にエラーが発生しました: {str(e)}'}), 500
+
+
+def prepare_generation_request(data):
+    analysis_data = data.get('analysis') or {}
+    original_problem = (data.get('original_problem') or analysis_data.get('problem_text') or '').strip()
+    if not original_problem:
+        return None
 
-        analysis_prompt = f"""
-{prompt_template}
+    difficulty = data.get('difficulty') or analysis_data.get('difficulty') or 'Level 3'
+    count_raw = data.get('count') or analysis_data.get('count') or 3
+    try:
+        count = max(1, int(count_raw))
+    except (TypeError, ValueError):
+        count = 3
+
+    return {
+        'analysis': analysis_data,
+        'original_problem': original_problem,
+        'difficulty': difficulty,
+        'count': count,
+        'solution_method': data.get('solution_method') or data.get('solution_hint') or '',
+        'analysis_summary': data.get('analysis_summary') or analysis_data.get('summary') or '',
+        # off: 毎回LLMで生成 / prefer: 問題バンクから出題し、足りない分だけ生成 / only: 問題バンクのみ
+        'bank_mode': normalize_bank_mode(data.get('bank')),
+    }
+
+
+def build_generation_prompt(generation_request):
+    # 例題・解析情報など毎回変わる部分だけを組み立てる（テンプレートと出力形式は build_generation_messages で先頭に置く）
+    analysis_data = generation_request['analysis']
+    original_problem = generation_request['original_problem']
+    count = generation_request['count']
+    solution_method = generation_request['solution_method']
+    analysis_summary = generation_request['analysis_summary']
+
+    context_lines = []
+    if analysis_data.get('grade'):
+        context_lines.append(f"学年: {analysis_data['grade']}")
+    if analysis_data.get('unit'):
+        context_lines.append(f"単元: {analysis_data['unit']}")
+    if analysis_data.get('difficulty'):
+        context_lines.append(f"解析難易度: {analysis_data['difficulty']}")
+    if analysis_summary:
+        context_lines.append(f"要約: {analysis_summary}")
+    if analysis_data.get('justification'):
+        context_lines.append(f"推定根拠: {analysis_data['justification']}")
+    if solution_method:
+        context_lines.append(f"解法指定: {solution_method}")
+
+    context_text = '\n'.join(context_lines) or '追加情報なし'
+
+    generation_prompt = f"""以下の例題と解析情報をもとに、新しい数学の類題を{count}問作成してください。
 
-以下の例題を解析してください。解答は求めず、次の項目だけを順番を変えずに日本語で出力してください。
+解析情報:
+{context_text}
 
 例題：
-{problem_text}
-
-出力形式（見出し名を変更しないこと）：
-学年: [中1/中2/中3/数I/数A/数II/数B/数III/数C]
-単元: [具体的な単元名]
-難易度: [Level 1 (基礎) 〜 Level 5 (難関) などの表記]
-推定根拠: [簡潔な説明]
-要約: [解法の要点を1〜2文で]
-次のステップ: [学習者への次の学習提案]
+{original_problem}
 """
 
-        try:
-            response = client.chat.completions.create(
-                model="gpt-4.1-mini",
-                messages=[
-                    {"role": "system", "content": "あなたは数学教育の専門家です。"},
-                    {"role": "user", "content": analysis_prompt}
-                ],
-                max_tokens=500,
-                temperature=0.3
-            )
-        except APIConnectionError:
-            return jsonify({'error': 'OpenAI APIへの接続に失敗しました。ネットワーク環境とAPIキーを確認してください。'}), 503
+    if analysis_summary:
+        generation_prompt += '\n各問題の解説には学習の要点を1文以上含めてください。'
+    shard = generation_request.get('shard')
+    if shard:
+        index, shards, total = shard
+        generation_prompt += (
+            f'\n全{total}問を{shards}回に分けて作成しており、これは{index}回目です。'
+            '他の回と問題が重ならないよう、数値や設定を変えてください。'
+        )
+    return generation_prompt
 
-        analysis_raw = (response.choices[0].message.content or '').strip()
-        analysis_data = parse_analysis_output(analysis_raw, problem_text)
-        analysis_data.setdefault('problem_text', problem_text)
-        analysis_data.setdefault('original_problem', problem_text)
 
-        return jsonify({
-            'success': True,
-            'analysis': analysis_data,
-            'original_problem': problem_text,
-            'raw_response': analysis_raw,
-        })
+def build_generation_metadata(generation_request):
+    analysis_data = generation_request['analysis']
+    solution_method = generation_request['solution_method']
+    analysis_summary = generation_request['analysis_summary']
 
-    except Exception as e:
-        print(f"例題解析エラー: {e}")
-        traceback.print_exc()
-        return jsonify({'error': f'解析中にエラーが発生しました: {str(e)}'}), 500
+    metadata = {
+        'grade': analysis_data.get('grade'),
+        'unit': analysis_data.get('unit'),
+        'difficulty': generation_request['difficulty'],
+    }
+
+    notes_sections = []
+    if analysis_data.get('justification'):
+        notes_sections.append(str(analysis_data['justification']).strip())
+    if solution_method:
+        notes_sections.append(f"解法指定: {solution_method}")
+    if analysis_summary:
+        notes_sections.append(f"解析要約: {analysis_summary}")
+    if notes_sections:
+        metadata['notes'] = '\n'.join(notes_sections)
+    return metadata
+
+
+def store_generated_problems(generation_request, problems, prompt_template):
+    # 重複の印が付いた問題はバンクに入れない（入れると後で同じような問題が出題される）
+    problems = [problem for problem in problems or [] if not problem.get('duplicate')]
+    if not problems or not problem_bank_enabled():
+        return
+    analysis_data = generation_request['analysis']
+    with span('bank'):
+        store_problems(
+            problems,
+            grade=analysis_data.get('grade'),
+            unit=analysis_data.get('unit'),
+            difficulty=generation_request['difficulty'],
+            template_version=prompt_template.version,
+        )
+
+
+def load_problem_deduplicator():
+    # 重複検出は numpy を使うので、最初の類題生成のときに読み込む（解析だけのワーカーは読み込まない）
+    # (ProblemDeduplicator または None, モード) を返す
+    global _problem_dedup
+    if _problem_dedup is None:
+        with _problem_dedup_lock:
+            if _problem_dedup is None:
+                from src.services.problem_dedup import create_deduplicator_from_env, dedup_mode
+                _problem_dedup = (create_deduplicator_from_env(), dedup_mode())
+    return _problem_dedup
+
+
+def filter_duplicate_problems(problems, shared=False, action=None):
+    # (残す問題, 重複として除いた問題) を返す。flag のときは除かずに 'duplicate' を付ける
+    if not problems:
+        return problems, []
+    problem_dedup, mode = load_problem_deduplicator()
+    action = action or mode
+    if problem_dedup is None:
+        return problems, []
+    with span('dedup'):
+        duplicates, signatures = problem_dedup.find_duplicates(problems, check_recent=not shared)
+        kept = []
+        dropped = []
+        for index, problem in enumerate(problems):
+            match = duplicates.get(index)
+            if match is None:
+                kept.append(problem)
+                continue
+            similarity, source = match
+            record_duplicate_problem(source, action)
+            problem = {**problem, 'duplicate': {'source': source, 'similarity': round(similarity, 3)}}
+            (kept if action == 'flag' else dropped).append(problem)
+        if not shared:
+            problem_dedup.remember([signature for index, signature in enumerate(signatures) if index not in duplicates])
+    return kept, dropped
+
+
+def split_generation_count(count):
+    # 問題数をほぼ均等な分割に分ける（例: 12問・分割サイズ5 → 4問 x 3）
+    shards = max(1, -(-count // GENERATION_SHARD_SIZE))
+    return [count // shards + (1 if index < count % shards else 0) for index in range(shards)]
+
+
+def call_generation_llm(messages, **options):
+    response = client.chat.completions.create(
+        model="gpt-4.1-mini",
+        messages=messages,
+        request_kind='generate',
+        max_tokens=2000,
+        temperature=0.7,
+        **options
+    )
+    record_llm_usage('generate', response.usage)
+    choice = response.choices[0]
+    return choice.message.content or '', choice.finish_reason
+
+
+def request_generation(messages):
+    # 出力が max_tokens で切れた（finish_reason == 'length'）ときは、続きを出力させてつなげる
+    messages = list(messages)
+    parts = []
+    for _ in range(GENERATION_MAX_CONTINUATIONS + 1):
+        content, finish_reason = call_generation_llm(messages)
+        parts.append(content)
+        if finish_reason != 'length':
+            break
+        messages += [
+            {"role": "assistant", "content": content},
+            {"role": "user", "content": GENERATION_CONTINUE_PROMPT},
+        ]
+    else:
+        print(f"類題生成の出力が {GENERATION_MAX_CONTINUATIONS} 回続けても途中で切れています")
+    return ''.join(parts).strip()
+
+
+def request_json_generation(build_messages, count):
+    # JSON スキーマで縛った出力は続きを頼んでも新しい JSON が返るだけなので、続きは頼まない。
+    # 切れた出力からは閉じている問題だけを残し、足りない問題数で頼み直して1つの {"problems": [...]} にまとめる
+    items = []
+    remaining = count
+    for _ in range(GENERATION_MAX_CONTINUATIONS + 1):
+        content, finish_reason = call_generation_llm(
+            build_messages(remaining), response_format=GENERATION_RESPONSE_FORMAT,
+        )
+        if finish_reason != 'length' and not items:
+            # JSON でない応答は parse_generated_output で従来の形式として読めるよう、そのまま返す
+            return content.strip()
+        new_items = json_problem_items(content)
+        items += new_items
+        remaining -= len(new_items)
+        if finish_reason != 'length' or remaining <= 0:
+            break
+    else:
+        print(f"類題生成の出力が {GENERATION_MAX_CONTINUATIONS} 回頼み直しても途中で切れています")
+    return json.dumps({'problems': items}, ensure_ascii=False)
+
+
+def generate_with_llm(generation_request, prompt_template):
+    counts = split_generation_count(generation_request['count'])
+    json_output = json_output_enabled()
 
+    def build_shard_messages(shard_request):
+        return build_generation_messages(
+            prompt_template, build_generation_prompt(shard_request), json_output=json_output,
+        )
+
+    with span('prompt'):
+        shard_requests = []
+        for index, shard_count in enumerate(counts, start=1):
+            shard_request = {**generation_request, 'count': shard_count}
+            if len(counts) > 1:
+                shard_request['shard'] = (index, len(counts), generation_request['count'])
+            shard_requests.append((shard_request, build_shard_messages(shard_request)))
+
+    def generate_shard(shard):
+        shard_request, messages = shard
+        if json_output:
+            def call_llm():
+                return request_json_generation(
+                    lambda count: build_shard_messages({**shard_request, 'count': count}), shard_request['count'],
+                )
+        else:
+            def call_llm():
+                return request_generation(messages)
+        return coalesce_llm_request(
+            'generate:' + make_request_key(
+                "gpt-4.1-mini", messages, 2000, 0.7, GENERATION_MAX_CONTINUATIONS, json_output,
+            ),
+            call_llm,
+        )
+
+    try:
+        with span('llm'):
+            if len(shard_requests) == 1:
+                shard_results = [generate_shard(shard_requests[0])]
+            else:
+                # 分割した生成を並行して呼び出す（所要時間は問題数ではなく分割サイズで決まる）
+                timings = current_timings()
+                endpoint = timings.endpoint if timings is not None else 'generate'
+
+                def run_shard(shard):
+                    with track_background(endpoint):
+                        return generate_shard(shard)
+
+                workers = min(len(shard_requests), GENERATION_SHARD_CONCURRENCY)
+                with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='generate-shard') as executor:
+                    shard_results = list(executor.map(run_shard, shard_requests))
+    except APIConnectionError:
+        raise RequestFailed(API_CONNECTION_ERROR, 503)
+    except LLMBusyError:
+        raise RequestFailed(LLM_BUSY_ERROR, 503)
+
+    raw_output = '\n\n'.join(output for output, _ in shard_results if output)
+    shared = all(shared for _, shared in shard_results)
+    with span('parse'):
+        problems = []
+        for output, _ in shard_results:
+            problems += parse_generated_output(output, json_output=json_output)
+        if len(shard_results) > 1:
+            for number, problem in enumerate(problems, start=1):
+                problem['number'] = number
+    # 相乗りした場合は先に呼び出したリクエストが過去の問題との照合と保存をする
+    problems, dropped = filter_duplicate_problems(problems, shared=shared)
+    if not shared:
+        store_generated_problems(generation_request, problems, prompt_template)
+    return raw_output, problems, dropped
+
+
+def run_generation(generation_request):
+    prompt_template = load_prompt_template_or_fail()
+    bank_mode = generation_request['bank_mode']
+    count = generation_request['count']
+    analysis_data = generation_request['analysis']
+
+    bank_problems = []
+    if bank_mode != 'off':
+        with span('bank'):
+            bank_problems = take_bank_problems(
+                analysis_data.get('grade'), analysis_data.get('unit'), generation_request['difficulty'], count,
+            )
+        if bank_mode == 'only' and not bank_problems:
+            raise RequestFailed('問題バンクに条件に合う問題がありません', 404)
+
+    raw_outputs = []
+    generated = []
+    dropped = []
+    filled = []
+    remaining = count - len(bank_problems)
+    if remaining > 0 and bank_mode != 'only':
+        for _ in range(PROBLEM_DEDUP_RETRIES + 1):
+            raw_output, new_problems, new_dropped = generate_with_llm(
+                {**generation_request, 'count': remaining}, prompt_template,
+            )
+            raw_outputs.append(raw_output)
+            generated += new_problems
+            dropped += new_dropped
+            remaining -= len(new_problems)
+            # 重複として除いた分だけ生成し直す
+            if remaining <= 0 or not new_dropped:
+                break
+        if remaining > 0 and dropped:
+            # 生成し直しても足りないときは重複の印を付けたまま使う
+            filled = dropped[:remaining]
+            generated += filled
+    raw_output = '\n\n'.join(raw_outputs)
+
+    with span('parse'):
+        problems = [problem.to_problem(0) for problem in bank_problems] + generated
+        if bank_problems or dropped:
+            for number, problem in enumerate(problems, start=1):
+                problem['number'] = number
+        problems_text = build_problems_text(problems) if problems else raw_output
+
+    result = {
+        'success': True,
+        'problems': problems,
+        'problems_text': problems_text,
+        'metadata': build_generation_metadata(generation_request),
+        'raw_response': raw_output,
+        'template_version': prompt_template.version,
+    }
+    if bank_mode != 'off':
+        result['bank'] = {'served': len(bank_problems), 'generated': len(generated)}
+    flagged = sum(1 for problem in generated if problem.get('duplicate'))
+    if dropped or flagged:
+        result['dedup'] = {
+            'dropped': len(dropped) - len(filled),
+            'flagged': flagged,
+            'retries': len(raw_outputs) - 1,
+        }
+    return result
 
 
 @math_bp.route('/generate', methods=['POST'])
@@ -530,120 +906,327 @@ def generate_problems():
     """類題を生成"""
     try:
         data = request.get_json() or {}
-        analysis_data = data.get('analysis') or {}
-        original_problem = (data.get('original_problem') or analysis_data.get('problem_text') or '').strip()
+        generation_request = prepare_generation_request(data)
 
-        if not original_problem:
+        if generation_request is None:
             return jsonify({'error': '元の問題が指定されていません'}), 400
 
-        difficulty = data.get('difficulty') or analysis_data.get('difficulty') or 'Level 3'
-        count_raw = data.get('count') or analysis_data.get('count') or 3
         try:
-            count = max(1, int(count_raw))
-        except (TypeError, ValueError):
-            count = 3
+            result = run_generation(generation_request)
+        except RequestFailed as e:
+            return jsonify({'error': e.message}), e.status
 
-        solution_method = data.get('solution_method') or data.get('solution_hint') or ''
-        analysis_summary = data.get('analysis_summary') or analysis_data.get('summary') or ''
+        with span('serialize'):
+            return jsonify(result)
 
-        try:
-            prompt_template = load_prompt_template()
-        except Exception as e:
-            print(f"プロンプトテンプレート読み込みエラー: {e}")
-            return jsonify({'error': 'プロンプトテンプレートの読み込みに失敗しました'}), 500
-
-        context_lines = []
-        if analysis_data.get('grade'):
-            context_lines.append(f"学年: {analysis_data['grade']}")
-        if analysis_data.get('unit'):
-            context_lines.append(f"単元: {analysis_data['unit']}")
-        if analysis_data.get('difficulty'):
-            context_lines.append(f"解析難易度: {analysis_data['difficulty']}")
-        if analysis_summary:
-            context_lines.append(f"要約: {analysis_summary}")
-        if analysis_data.get('justification'):
-            context_lines.append(f"推定根拠: {analysis_data['justification']}")
-        if solution_method:
-            context_lines.append(f"解法指定: {solution_method}")
-
-        context_text = '\n'.join(context_lines) or '追加情報なし'
-
-        generation_prompt = f"""
-{prompt_template}
-
-以下の例題と解析情報をもとに、新しい数学の類題を{count}問作成してください。
+    except Exception as e:
+        traceback.print_exc()
+        return jsonify({'error': f'類題生成中にエラーが発生しました: {str(e)}'}), 500
 
-解析情報:
-{context_text}
 
-例題：
-{original_problem}
+def _ndjson_line(payload):
+    return json.dumps(payload, ensure_ascii=False) + '\n'
 
-出力形式（必ずこの形式を守ること）：
-【問題1】
-問題文
-【解答1】
-解答
-【解説1】
-解説
-（指定した問題数になるまで番号を増やして繰り返す）
-"""
 
-        generation_prompt += """
-追加ルール:
-- 指定された作問数 {count} 問を必ず生成してください。
-- ユーザーへの質問や確認は行わず、指定の形式のみで回答してください。
-- 各問題には必ず問題文・解答・解説を含めてください。
-"""
+@math_bp.route('/generate-stream', methods=['POST'])
+@math_bp.route('/generate-problems-stream', methods=['POST'])
+def generate_problems_stream():
+    """類題を生成し、完成した問題から順にNDJSONで返す"""
+    data = request.get_json() or {}
+    generation_request = prepare_generation_request(data)
+
+    if generation_request is None:
+        return jsonify({'error': '元の問題が指定されていません'}), 400
+
+    try:
+        prompt_template = load_prompt_template_or_fail()
+    except RequestFailed as e:
+        return jsonify({'error': e.message}), e.status
 
-        if analysis_summary:
-            generation_prompt += '\n各問題の解説には学習の要点を1文以上含めてください。'
+    generation_messages = build_generation_messages(prompt_template, build_generation_prompt(generation_request))
 
+    def generate():
+        stream_parser = ProblemStreamParser()
+        chunks = []
+        timings = current_timings()
+        llm_started = time.perf_counter()
         try:
-            response = client.chat.completions.create(
-                model="gpt-4.1-mini",
-                messages=[
-                    {"role": "system", "content": "あなたは数学問題作成の専門家です。"},
-                    {"role": "user", "content": generation_prompt}
-                ],
-                max_tokens=2000,
-                temperature=0.7
-            )
-        except APIConnectionError:
-            return jsonify({'error': 'OpenAI APIへの接続に失敗しました。ネットワーク環境とAPIキーを確認してください。'}), 503
+            try:
+                stream = client.chat.completions.create(
+                    model="gpt-4.1-mini",
+                    messages=generation_messages,
+                    request_kind='generate',
+                    max_tokens=2000,
+                    temperature=0.7,
+                    stream=True,
+                    stream_options={"include_usage": True},
+                )
+            except APIConnectionError:
+                yield _ndjson_line({'type': 'error', 'error': API_CONNECTION_ERROR})
+                return
+            except LLMBusyError:
+                yield _ndjson_line({'type': 'error', 'error': LLM_BUSY_ERROR})
+                return
+
+            for chunk in stream:
+                if not chunk.choices:
+                    # include_usage を指定すると最後のチャンクでトークン数が届く
+                    record_llm_usage('generate', getattr(chunk, 'usage', None))
+                    continue
+                delta = chunk.choices[0].delta.content or ''
+                if not delta:
+                    continue
+                if not chunks and timings is not None:
+                    timings.add_span('llm_first_token', time.perf_counter() - llm_started)
+                chunks.append(delta)
+                for problem in stream_parser.feed(delta):
+                    yield _ndjson_line({'type': 'problem', 'problem': problem})
+            for problem in stream_parser.close():
+                yield _ndjson_line({'type': 'problem', 'problem': problem})
+            if timings is not None:
+                # クライアントへの送信待ちも含む
+                timings.add_span('llm', time.perf_counter() - llm_started)
+
+            raw_output = ''.join(chunks).strip()
+            with span('parse'):
+                problems = parse_generated_problems(raw_output)
+                problems_text = build_problems_text(problems) if problems else raw_output
+            # 送信済みの問題は取り消せないので、重複には印を付けるだけにする
+            problems, _ = filter_duplicate_problems(problems, action='flag')
+            store_generated_problems(generation_request, problems, prompt_template)
+            yield _ndjson_line({
+                'type': 'done',
+                'success': True,
+                'problems': problems,
+                'problems_text': problems_text,
+                'metadata': build_generation_metadata(generation_request),
+                'raw_response': raw_output,
+                'template_version': prompt_template.version,
+            })
+        except Exception as e:
+            traceback.print_exc()
+            yield _ndjson_line({'type': 'error', 'error': f'類題生成中にエラーが発生しました: {str(e)}'})
 
-        raw_output = (response.choices[0].message.content or '').strip()
-        problems = parse_generated_problems(raw_output)
-        problems_text = build_problems_text(problems) if problems else raw_output
+    return Response(
+        stream_with_context(generate()),
+        mimetype='application/x-ndjson',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'},
+    )
 
-        metadata = {
-            'grade': analysis_data.get('grade'),
-            'unit': analysis_data.get('unit'),
-            'difficulty': difficulty,
-        }
 
-        notes_sections = []
-        if analysis_data.get('justification'):
-            notes_sections.append(str(analysis_data['justification']).strip())
-        if solution_method:
-            notes_sections.append(f"解法指定: {solution_method}")
-        if analysis_summary:
-            notes_sections.append(f"解析要約: {analysis_summary}")
-        if notes_sections:
-            metadata['notes'] = '\n'.join(notes_sections)
 
-        return jsonify({
-            'success': True,
-            'problems': problems,
-            'problems_text': problems_text,
-            'metadata': metadata,
-            'raw_response': raw_output,
+# 一括生成（BULK_MAX_ITEMS: 1リクエストの例題数の上限、BULK_CONCURRENCY: 同時に処理する例題数）
+BULK_MAX_ITEMS = max(1, _env_number('BULK_MAX_ITEMS', 30))
+BULK_CONCURRENCY = max(1, _env_number('BULK_CONCURRENCY', 4))
+BULK_DEFAULT_FIELDS = ('difficulty', 'count', 'solution_method', 'solution_hint', 'analysis_summary', 'bank')
+
+
+def prepare_bulk_items(data):
+    raw_items = data.get('items') or data.get('problems') or []
+    if not isinstance(raw_items, list):
+        return None
+    defaults = {field: data[field] for field in BULK_DEFAULT_FIELDS if data.get(field)}
+    items = []
+    for raw_item in raw_items:
+        # 文字列だけの要素は例題の問題文として扱い、共通の難易度・問題数を使う
+        if isinstance(raw_item, str):
+            item = {'problem_text': raw_item}
+        elif isinstance(raw_item, dict) or raw_item is None:
+            item = dict(raw_item or {})
+        else:
+            # 形式の正しくない要素はその例題だけエラーにして、他の例題は処理する
+            items.append({'invalid_item': True})
+            continue
+        items.append({**defaults, **item})
+    return items
+
+
+def prepare_bulk_export(data):
+    export_option = data.get('export')
+    if not export_option:
+        return None
+    if isinstance(export_option, str):
+        export_option = {'format': export_option}
+    export_format = str(export_option.get('format') or 'pdf').lower()
+    if export_format not in EXPORT_FORMATS:
+        raise RequestFailed(f'未対応の出力形式です: {export_format}', 400)
+    layout = export_layout_of(export_option)
+    if layout not in EXPORT_LAYOUTS:
+        raise RequestFailed(f'未対応のレイアウトです: {layout}', 400)
+    return {'format': export_format, 'layout': layout, 'metadata': export_option.get('metadata') or {}}
+
+
+def run_bulk_item(index, item, analyze):
+    # 例題1件の解析と類題生成。失敗しても他の例題に影響しないよう、例外は投げずに結果へエラーを入れて返す
+    problem_text = str(item.get('problem_text') or item.get('original_problem') or '').strip()
+    result = {'index': index, 'success': False, 'problem_text': problem_text}
+    stage = 'analysis'
+    try:
+        if item.get('invalid_item'):
+            raise RequestFailed('例題は問題文の文字列かオブジェクトで指定してください', 400)
+        if not problem_text:
+            raise RequestFailed('問題文が入力されていません', 400)
+
+        analysis_data = item.get('analysis')
+        if not analysis_data and analyze:
+            analysis_result = run_analysis(problem_text, bypass_cache=item.get('bypass_cache'))
+            analysis_data = analysis_result['analysis']
+            result['cached'] = analysis_result['cached']
+        result['analysis'] = analysis_data or {}
+
+        stage = 'generation'
+        generation_request = prepare_generation_request({
+            **item,
+            'analysis': analysis_data or {},
+            'original_problem': problem_text,
         })
+        generation_result = run_generation(generation_request)
+        result.update(
+            success=True,
+            problems=generation_result['problems'],
+            problems_text=generation_result['problems_text'],
+            metadata=generation_result['metadata'],
+        )
+    except RequestFailed as e:
+        result.update(stage=stage, error=e.message, status=e.status)
+    except Exception as e:
+        traceback.print_exc()
+        message = '解析中にエラーが発生しました' if stage == 'analysis' else '類題生成中にエラーが発生しました'
+        result.update(stage=stage, error=f'{message}: {str(e)}', status=500)
+    return result
+
+
+def merge_bulk_results(results, export_option):
+    problems = []
+    units = []
+    for result in results:
+        if not result or not result['success']:
+            continue
+        unit = (result.get('metadata') or {}).get('unit')
+        if unit and unit not in units:
+            units.append(unit)
+        for problem in result['problems']:
+            problems.append({**problem, 'number': len(problems) + 1})
+
+    metadata = dict(export_option['metadata'])
+    if not metadata.get('unit'):
+        metadata['unit'] = '・'.join(units) if units else '数学問題集'
+    return {'problems': problems, 'metadata': metadata}
+
+
+def submit_bulk_export(results, export_option):
+    data = merge_bulk_results(results, export_option)
+    export_data = EXPORT_FORMATS[export_option['format']]['prepare'](data)
+    if export_data is None:
+        return {'error': '出力する問題がありません'}
+    export_data['layout'] = export_option['layout']
+    return submit_export_job(export_option['format'], export_data)
+
+
+def bulk_summary(results):
+    succeeded = sum(1 for result in results if result and result['success'])
+    return {'success': succeeded > 0, 'succeeded': succeeded, 'failed': len(results) - succeeded}
+
+
+@math_bp.route('/bulk-generate', methods=['POST'])
+def bulk_generate():
+    """複数の例題をまとめて解析・類題生成し、必要なら1つのPDF/Wordにまとめる"""
+    try:
+        data = request.get_json() or {}
+        items = prepare_bulk_items(data)
+        if not items:
+            return jsonify({'error': '例題が指定されていません'}), 400
+        if len(items) > BULK_MAX_ITEMS:
+            return jsonify({'error': f'一度に指定できる例題は{BULK_MAX_ITEMS}件までです'}), 400
+        try:
+            export_option = prepare_bulk_export(data)
+        except RequestFailed as e:
+            return jsonify({'error': e.message}), e.status
+
+        analyze = data.get('analyze', True)
+        try:
+            concurrency = int(data.get('concurrency') or BULK_CONCURRENCY)
+        except (TypeError, ValueError):
+            concurrency = BULK_CONCURRENCY
+        concurrency = max(1, min(concurrency, BULK_CONCURRENCY, len(items)))
+
+        # 各例題はスレッドで処理するため、解析キャッシュ用のアプリケーションコンテキストをスレッドごとに作る
+        app = current_app._get_current_object()
+        timings = current_timings()
+        endpoint = timings.endpoint if timings is not None else 'bulk_generate'
+
+        def run_in_context(index, item):
+            with app.app_context(), track_background(endpoint):
+                return run_bulk_item(index, item, analyze)
+
+        executor = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='bulk-generate')
+        futures = [executor.submit(run_in_context, index, item) for index, item in enumerate(items)]
+        results = [None] * len(items)
+
+        if not data.get('stream'):
+            try:
+                with span('bulk'):
+                    for future in futures:
+                        result = future.result()
+                        results[result['index']] = result
+            finally:
+                executor.shutdown(wait=False, cancel_futures=True)
+            payload = {**bulk_summary(results), 'items': results}
+            if export_option:
+                payload['export'] = submit_bulk_export(results, export_option)
+            with span('serialize'):
+                return jsonify(payload)
+
+        def generate():
+            # 完了した例題から順に1行1JSONで返す（index で元の順番が分かる）
+            try:
+                for future in as_completed(futures):
+                    result = future.result()
+                    results[result['index']] = result
+                    yield _ndjson_line({'type': 'item', **result})
+                done = {'type': 'done', **bulk_summary(results)}
+                if export_option:
+                    done['export'] = submit_bulk_export(results, export_option)
+                yield _ndjson_line(done)
+            except Exception as e:
+                traceback.print_exc()
+                yield _ndjson_line({'type': 'error', 'error': f'一括生成中にエラーが発生しました: {str(e)}'})
+            finally:
+                # クライアントが途中で切断した場合は未着手の例題を取り消す
+                executor.shutdown(wait=False, cancel_futures=True)
+
+        return Response(
+            stream_with_context(generate()),
+            mimetype='application/x-ndjson',
+            headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'},
+        )
 
     except Exception as e:
         traceback.print_exc()
-        return jsonify({'error': f'類題生成中にエラーが発生しました: {str(e)}'}), 500
+        return jsonify({'error': f'一括生成中にエラーが発生しました: {str(e)}'}), 500
+
 
+@math_bp.route('/problem-bank/search', methods=['GET'])
+def search_problem_bank():
+    """問題バンクを学年・単元・難易度とキーワード（問題文・解答・解説の全文検索）で検索"""
+    try:
+        try:
+            limit = int(request.args.get('limit') or 20)
+        except ValueError:
+            limit = 20
+        with span('bank'):
+            problems = search_bank_problems(
+                keyword=request.args.get('q'),
+                grade=request.args.get('grade'),
+                unit=request.args.get('unit'),
+                difficulty=request.args.get('difficulty'),
+                limit=limit,
+            )
+        return jsonify({'success': True, 'problems': [problem.to_dict() for problem in problems]})
+
+    except Exception as e:
+        traceback.print_exc()
+        return jsonify({'error': f'問題バンクの検索中にエラーが発生しました: {str(e)}'}), 500
 
 
 @math_bp.route('/ocr-image', methods=['POST'])
@@ -656,154 +1239,191 @@ def ocr_image():
         image_file = request.files['image']
 
         image_data = image_file.read()
+        try:
+            from src.services.image_preprocess import preprocess_image
+            with span('preprocess'):
+                image_data, mime_type, image_stats = preprocess_image(image_data)
+        except Exception as e:
+            # 前処理できない形式はそのまま送る
+            print(f"画像の前処理に失敗しました: {e}")
+            mime_type = image_file.mimetype or 'image/jpeg'
+            image_stats = {'original_bytes': len(image_data), 'processed_bytes': len(image_data)}
         base64_image = base64.b64encode(image_data).decode('utf-8')
 
         try:
-            response = client.chat.completions.create(
-                model="gpt-4.1-mini",
-                messages=[
-                    {
-                        "role": "user",
-                        "content": [
-                            {
-                                "type": "text",
-                                "text": "この画像に含まれる数学問題のテキストを正確に読み取って、テキスト形式で出力してください。数式は適切な記法で表現してください。"
-                            },
-                            {
-                                "type": "image_url",
-                                "image_url": {
-                                    "url": f"data:image/jpeg;base64,{base64_image}"
+            with span('llm'):
+                response = client.chat.completions.create(
+                    model="gpt-4.1-mini",
+                    messages=[
+                        {
+                            "role": "user",
+                            "content": [
+                                {
+                                    "type": "text",
+                                    "text": "この画像に含まれる数学問題のテキストを正確に読み取って、テキスト形式で出力してください。数式は適切な記法で表現してください。"
+                                },
+                                {
+                                    "type": "image_url",
+                                    "image_url": {
+                                        "url": f"data:{mime_type};base64,{base64_image}"
+                                    }
                                 }
-                            }
-                        ]
-                    }
-                ],
-                max_tokens=1000
-            )
+                            ]
+                        }
+                    ],
+                    request_kind='ocr',
+                    max_tokens=1000
+                )
+            record_llm_usage('ocr', response.usage)
         except APIConnectionError:
-            return jsonify({'error': 'OpenAI APIへの接続に失敗しました。ネットワーク環境とAPIキーを確認してください。'}), 503
+            return jsonify({'error': API_CONNECTION_ERROR}), 503
+        except LLMBusyError:
+            return jsonify({'error': LLM_BUSY_ERROR}), 503
 
         extracted_text = response.choices[0].message.content
 
         return jsonify({
             'success': True,
-            'extracted_text': extracted_text
+            'extracted_text': extracted_text,
+            'image_stats': image_stats,
         })
 
     except Exception as e:
         return jsonify({'error': f'OCR処理中にエラーが発生しました: {str(e)}'}), 500
 
 
-@math_bp.route('/download/pdf', methods=['POST'])
-@math_bp.route('/export-pdf', methods=['POST'])
-@math_bp.route('/download/pdf', methods=['POST'])
-@math_bp.route('/export-pdf', methods=['POST'])
-def export_pdf():
-    """生成された問題をPDF形式でエクスポート"""
-    try:
-        data = request.get_json() or {}
-        metadata = data.get('metadata') or {}
-        problems = data.get('problems') or []
-        problems_text = strip_step_markers(data.get('problems_text') or '')
-        problems_text = normalize_latex_spacing(problems_text)
+def prepare_pdf_export(data):
+    metadata = data.get('metadata') or {}
+    problems = data.get('problems') or []
+    problems_text = strip_step_markers(data.get('problems_text') or '')
+    problems_text = normalize_latex_spacing(problems_text)
 
-        if not problems:
-            parsed = parse_generated_problems(problems_text)
-            if parsed:
-                problems = parsed
+    if not problems:
+        parsed = parse_generated_problems(problems_text)
+        if parsed:
+            problems = parsed
 
-        if problems and not problems_text:
-            problems_text = build_problems_text(problems)
+    if problems and not problems_text:
+        problems_text = build_problems_text(problems)
 
-        problems_text = strip_step_markers(normalize_problems_text(problems_text))
-        problems_text = normalize_latex_spacing(problems_text)
+    problems_text = strip_step_markers(normalize_problems_text(problems_text))
+    problems_text = normalize_latex_spacing(problems_text)
 
-        if not problems and not problems_text:
-            return jsonify({'error': '出力する問題がありません'}), 400
+    if not problems and not problems_text:
+        return None
+    return {
+        'metadata': metadata,
+        'problems_list': problems or parse_generated_problems(problems_text),
+        'problems_text': problems_text,
+    }
 
-        buffer = io.BytesIO()
-        doc = SimpleDocTemplate(buffer, pagesize=A4)
-        styles = getSampleStyleSheet()
 
-        title_style = ParagraphStyle(
-            'CustomTitle',
-            parent=styles['Heading1'],
-            fontName=DEFAULT_FONT_NAME,
-            fontSize=16,
-            spaceAfter=24,
-        )
+def prepare_word_export(data):
+    metadata = data.get('metadata') or {}
+    problems = data.get('problems') or []
+    problems_text = strip_step_markers(data.get('problems_text') or '')
+    problems_text = normalize_latex_spacing(problems_text)
 
-        section_title_style = ParagraphStyle(
-            'SectionTitle',
-            parent=styles['Heading2'],
-            fontName=DEFAULT_FONT_NAME,
-            fontSize=14,
-            spaceAfter=12,
-        )
+    if not problems:
+        parsed = parse_generated_problems(problems_text)
+        if parsed:
+            problems = parsed
 
-        problem_heading_style = ParagraphStyle(
-            'ProblemHeading',
-            parent=styles['Heading3'],
-            fontName=DEFAULT_FONT_NAME,
-            fontSize=13,
-            spaceAfter=6,
-        )
+    if problems and not problems_text:
+        problems_text = build_problems_text(problems)
 
-        label_style = ParagraphStyle(
-            'LabelStyle',
-            parent=styles['Normal'],
-            fontName=DEFAULT_FONT_NAME,
-            fontSize=12,
-            spaceAfter=4,
-        )
+    if not problems and not problems_text:
+        return None
+    return {
+        'metadata': metadata,
+        'problems_list': problems or parse_generated_problems(problems_text),
+        'problems_text': problems_text,
+    }
 
-        content_style = ParagraphStyle(
-            'CustomContent',
-            parent=styles['Normal'],
-            fontName=DEFAULT_FONT_NAME,
-            fontSize=12,
-            spaceAfter=6,
-        )
 
-        story = []
-        title_text = metadata.get('unit') or '数学問題集'
-        story.append(Paragraph(title_text, title_style))
-        story.append(Spacer(1, 12))
+EXPORT_FORMATS = {
+    'pdf': {
+        'prepare': prepare_pdf_export,
+        'build': 'build_pdf_document',
+        'download_name': 'math_problems.pdf',
+        'mimetype': 'application/pdf',
+    },
+    'word': {
+        'prepare': prepare_word_export,
+        'build': 'build_word_document',
+        'download_name': 'math_problems.docx',
+        'mimetype': 'application/vnd.openxmlformats-officedocument.wordprocessingml.document',
+    },
+}
+
+# 出力レイアウト（src/services/export_profiles.py の EXPORT_LAYOUTS と対応）
+EXPORT_LAYOUTS = ('standard', 'worksheet', 'answer_key')
 
-        problems_list = problems or parse_generated_problems(problems_text)
-        if not problems_list:
-            for line in problems_text.split('\n'):
-                append_text_with_math_to_story(story, line, content_style)
-        else:
-            story.append(Paragraph('問題一覧', section_title_style))
-            story.append(Spacer(1, 6))
-            for idx, item in enumerate(problems_list, start=1):
-                story.append(Paragraph(f'問題{idx}', problem_heading_style))
-                append_text_with_math_to_story(story, item.get('problem'), content_style)
-                story.append(Spacer(1, 12))
-
-            story.append(PageBreak())
-            story.append(Paragraph('解答・解説', section_title_style))
-            story.append(Spacer(1, 6))
-            for idx, item in enumerate(problems_list, start=1):
-                story.append(Paragraph(f'問題{idx}', problem_heading_style))
-                answer = item.get('answer')
-                explanation = item.get('explanation')
-                if answer:
-                    story.append(Paragraph('解答', label_style))
-                    append_text_with_math_to_story(story, answer, content_style)
-                if explanation:
-                    story.append(Paragraph('解説', label_style))
-                    append_text_with_math_to_story(story, explanation, content_style)
-                story.append(Spacer(1, 12))
-
-        doc.build(story)
-        buffer.seek(0)
+
+def export_layout_of(data):
+    return str(data.get('layout') or 'standard').lower()
+
+
+def export_download_name(export_format, layout):
+    download_name = EXPORT_FORMATS[export_format]['download_name']
+    if layout == 'standard':
+        return download_name
+    stem, ext = os.path.splitext(download_name)
+    return f'{stem}_{layout}{ext}'
+
+
+def run_export_job(job_id, export_format, export_data):
+    export_config = EXPORT_FORMATS[export_format]
+    with track_background(f'export_job_{export_format}'):
+        buffer = getattr(load_export_renderer(), export_config['build'])(export_data)
+    export_job_store.write_result(job_id, buffer.getvalue())
+
+
+def submit_export_job(export_format, export_data):
+    export_config = EXPORT_FORMATS[export_format]
+    job = export_job_store.create(
+        export_format,
+        download_name=export_download_name(export_format, export_data.get('layout', 'standard')),
+        mimetype=export_config['mimetype'],
+    )
+    export_job_runner.submit(job['job_id'], run_export_job, job['job_id'], export_format, export_data)
+    return {
+        'job_id': job['job_id'],
+        'status': job['status'],
+        'status_url': f"/api/export-jobs/{job['job_id']}",
+        'download_url': f"/api/export-jobs/{job['job_id']}/download",
+    }
+
+
+def enqueue_export_job(export_format, export_data):
+    return jsonify({'success': True, **submit_export_job(export_format, export_data)}), 202
+
+
+@math_bp.route('/download/pdf', methods=['POST'])
+@math_bp.route('/export-pdf', methods=['POST'])
+def export_pdf():
+    """生成された問題をPDF形式でエクスポート"""
+    try:
+        data = request.get_json() or {}
+        layout = export_layout_of(data)
+        if layout not in EXPORT_LAYOUTS:
+            return jsonify({'error': f'未対応のレイアウトです: {layout}'}), 400
+        with span('prepare'):
+            export_data = prepare_pdf_export(data)
+        if export_data is None:
+            return jsonify({'error': '出力する問題がありません'}), 400
+        export_data['layout'] = layout
+
+        # async 指定時はジョブIDだけ返し、描画はバックグラウンドで行う
+        if data.get('async'):
+            return enqueue_export_job('pdf', export_data)
+
+        buffer = load_export_renderer().build_pdf_document(export_data)
 
         return send_file(
             buffer,
             as_attachment=True,
-            download_name='math_problems.pdf',
+            download_name=export_download_name('pdf', layout),
             mimetype='application/pdf'
         )
 
@@ -818,59 +1438,24 @@ def export_word():
     """生成された問題をWord形式でエクスポート"""
     try:
         data = request.get_json() or {}
-        metadata = data.get('metadata') or {}
-        problems = data.get('problems') or []
-        problems_text = strip_step_markers(data.get('problems_text') or '')
-        problems_text = normalize_latex_spacing(problems_text)
-
-        if not problems:
-            parsed = parse_generated_problems(problems_text)
-            if parsed:
-                problems = parsed
-
-        if problems and not problems_text:
-            problems_text = build_problems_text(problems)
-
-        if not problems and not problems_text:
+        layout = export_layout_of(data)
+        if layout not in EXPORT_LAYOUTS:
+            return jsonify({'error': f'未対応のレイアウトです: {layout}'}), 400
+        with span('prepare'):
+            export_data = prepare_word_export(data)
+        if export_data is None:
             return jsonify({'error': '出力する問題がありません'}), 400
+        export_data['layout'] = layout
 
-        doc = Document()
-        title_text = metadata.get('unit') or '数学問題集'
-        doc.add_heading(title_text, 0)
+        if data.get('async'):
+            return enqueue_export_job('word', export_data)
 
-        problems_list = problems or parse_generated_problems(problems_text)
-        if not problems_list:
-            for line in strip_step_markers(problems_text or '').split('\n'):
-                add_paragraph_with_math(doc, line)
-        else:
-            doc.add_heading('問題一覧', level=1)
-            for idx, item in enumerate(problems_list, start=1):
-                doc.add_heading(f'問題{idx}', level=2)
-                add_paragraph_with_math(doc, item.get('problem'))
-                doc.add_paragraph('')
-
-            doc.add_page_break()
-            doc.add_heading('解答・解説', level=1)
-            for idx, item in enumerate(problems_list, start=1):
-                doc.add_heading(f'問題{idx}', level=2)
-                answer = item.get('answer')
-                explanation = item.get('explanation')
-                if answer:
-                    doc.add_heading('解答', level=3)
-                    add_paragraph_with_math(doc, answer)
-                if explanation:
-                    doc.add_heading('解説', level=3)
-                    add_paragraph_with_math(doc, explanation)
-                doc.add_paragraph('')
-
-        buffer = io.BytesIO()
-        doc.save(buffer)
-        buffer.seek(0)
+        buffer = load_export_renderer().build_word_document(export_data)
 
         return send_file(
             buffer,
             as_attachment=True,
-            download_name='math_problems.docx',
+            download_name=export_download_name('word', layout),
             mimetype='application/vnd.openxmlformats-officedocument.wordprocessingml.document'
         )
 
@@ -879,15 +1464,62 @@ def export_word():
         return jsonify({'error': f'Word出力中にエラーが発生しました: {str(e)}'}), 500
 
 
+@math_bp.route('/export-jobs', methods=['POST'])
+def create_export_job():
+    """PDF/Word出力ジョブを登録"""
+    try:
+        data = request.get_json() or {}
+        export_format = (data.get('format') or 'pdf').lower()
+        if export_format not in EXPORT_FORMATS:
+            return jsonify({'error': f'未対応の出力形式です: {export_format}'}), 400
 
+        layout = export_layout_of(data)
+        if layout not in EXPORT_LAYOUTS:
+            return jsonify({'error': f'未対応のレイアウトです: {layout}'}), 400
 
+        export_data = EXPORT_FORMATS[export_format]['prepare'](data)
+        if export_data is None:
+            return jsonify({'error': '出力する問題がありません'}), 400
+        export_data['layout'] = layout
+        return enqueue_export_job(export_format, export_data)
 
+    except Exception as e:
+        traceback.print_exc()
+        return jsonify({'error': f'出力ジョブの登録中にエラーが発生しました: {str(e)}'}), 500
+
+
+@math_bp.route('/export-jobs/<job_id>', methods=['GET'])
+def get_export_job(job_id):
+    """出力ジョブの状態を取得"""
+    job = export_job_store.get(job_id)
+    if job is None:
+        return jsonify({'error': '出力ジョブが見つかりません'}), 404
+    payload = dict(job)
+    if job['status'] == 'done':
+        payload['download_url'] = f'/api/export-jobs/{job_id}/download'
+    return jsonify({'success': True, 'job': payload})
+
+
+@math_bp.route('/export-jobs/<job_id>/download', methods=['GET'])
+def download_export_job(job_id):
+    """完了した出力ジョブのファイルをダウンロード"""
+    job = export_job_store.get(job_id)
+    if job is None:
+        return jsonify({'error': '出力ジョブが見つかりません'}), 404
+    if job['status'] != 'done':
+        return jsonify({'error': '出力ジョブはまだ完了していません', 'status': job['status']}), 409
+    result_path = export_job_store.result_path(job_id)
+    if not os.path.exists(result_path):
+        return jsonify({'error': '出力ファイルの保存期間が終了しました'}), 410
+    return send_file(
+        result_path,
+        as_attachment=True,
+        download_name=job['download_name'],
+        mimetype=job['mimetype'],
+    )
 
 
-
-
-
-
-
-
-
+@math_bp.route('/metrics', methods=['GET'])
+def metrics():
+    """処理時間のヒストグラムをPrometheus形式で返す"""
+    return Response(registry.render(), mimetype='text/plain; version=0.0.4; charset=utf-8')
@@ -0,0 +1,106 @@
+import hashlib
+import json
+import os
+import time
+
+from src.models.analysis_cache import AnalysisCacheEntry, db
+
+# 例題解析結果のキャッシュ（gunicornワーカー間で共有するためSQLiteに保存）
+# 入力された例題そのものは保存しない（キーはハッシュで、キャッシュヒット時はリクエストの例題を入れ直す）
+
+DEFAULT_TTL_SECONDS = 7 * 24 * 3600
+DEFAULT_MAX_ENTRIES = 5000
+# 古いエントリの削除はこの件数の書き込みごとに1回だけ行う
+EVICTION_INTERVAL = 50
+INPUT_FIELDS = ('problem_text', 'original_problem')
+
+_writes_since_eviction = 0
+
+
+def _env_number(name, default):
+    try:
+        return type(default)(os.environ.get(name, default))
+    except (TypeError, ValueError):
+        return default
+
+
+def analysis_cache_enabled():
+    return os.environ.get('ANALYSIS_CACHE_ENABLED', '1').lower() not in ('0', 'false', 'no', 'off')
+
+
+def make_analysis_cache_key(normalized_problem_text, template_version, model):
+    payload = json.dumps([normalized_problem_text, template_version, model], ensure_ascii=False)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+def get_cached_analysis(cache_key):
+    try:
+        entry = db.session.get(AnalysisCacheEntry, cache_key)
+        if entry is None:
+            return None
+        now = time.time()
+        if now - entry.created_at > _env_number('ANALYSIS_CACHE_TTL', DEFAULT_TTL_SECONDS):
+            db.session.delete(entry)
+            db.session.commit()
+            return None
+        entry.last_used_at = now
+        entry.hit_count = (entry.hit_count or 0) + 1
+        db.session.commit()
+        return json.loads(entry.analysis_json), entry.raw_response
+    except Exception as e:
+        db.session.rollback()
+        print(f"解析キャッシュの読み込みに失敗しました: {e}")
+        return None
+
+
+def store_cached_analysis(cache_key, template_version, model, analysis_data, raw_response):
+    global _writes_since_eviction
+    now = time.time()
+    try:
+        db.session.merge(AnalysisCacheEntry(
+            cache_key=cache_key,
+            template_version=template_version,
+            model=model,
+            analysis_json=json.dumps(
+                {key: value for key, value in analysis_data.items() if key not in INPUT_FIELDS}, ensure_ascii=False,
+            ),
+            raw_response=raw_response or '',
+            created_at=now,
+            last_used_at=now,
+            hit_count=0,
+        ))
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        print(f"解析キャッシュの書き込みに失敗しました: {e}")
+        return
+
+    _writes_since_eviction += 1
+    if _writes_since_eviction >= EVICTION_INTERVAL:
+        _writes_since_eviction = 0
+        evict_analysis_cache()
+
+
+def evict_analysis_cache():
+    try:
+        ttl_seconds = _env_number('ANALYSIS_CACHE_TTL', DEFAULT_TTL_SECONDS)
+        max_entries = _env_number('ANALYSIS_CACHE_MAX', DEFAULT_MAX_ENTRIES)
+        AnalysisCacheEntry.query.filter(
+            AnalysisCacheEntry.created_at < time.time() - ttl_seconds
+        ).delete(synchronize_session=False)
+        overflow = AnalysisCacheEntry.query.count() - max_entries
+        if overflow > 0:
+            # 最終利用が古いものから削除する
+            stale_keys = [
+                row.cache_key for row in AnalysisCacheEntry.query
+                .with_entities(AnalysisCacheEntry.cache_key)
+                .order_by(AnalysisCacheEntry.last_used_at.asc())
+                .limit(overflow)
+            ]
+            AnalysisCacheEntry.query.filter(
+                AnalysisCacheEntry.cache_key.in_(stale_keys)
+            ).delete(synchronize_session=False)
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        print(f"解析キャッシュの整理に失敗しました: {e}")
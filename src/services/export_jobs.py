@@ -0,0 +1,209 @@
+import json
+import os
+import re
+import tempfile
+import threading
+import time
+import traceback
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+# PDF/Word出力ジョブ
+# 状態と結果はディスクに保存し、どのgunicornワーカーからでもポーリング・ダウンロードできるようにする
+
+JOB_ID_PATTERN = re.compile(r'^[0-9a-f]{32}$')
+
+DEFAULT_TTL_SECONDS = 1800
+DEFAULT_MAX_JOBS = 200
+DEFAULT_MAX_BYTES = 500 * 1024 * 1024
+CLEANUP_INTERVAL_SECONDS = 30
+FINISHED_STATUSES = ('done', 'failed')
+# 待機中・処理中のまま更新が止まったジョブ（ワーカーの異常終了など）はこの秒数で削除する
+STALE_JOB_SECONDS = 6 * 3600
+
+
+class ExportJobStore:
+    def __init__(self, root_dir, ttl_seconds=DEFAULT_TTL_SECONDS, max_jobs=DEFAULT_MAX_JOBS, max_bytes=DEFAULT_MAX_BYTES):
+        self.root_dir = root_dir
+        self.ttl_seconds = ttl_seconds
+        self.max_jobs = max_jobs
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._last_cleanup = 0.0
+        os.makedirs(self.root_dir, exist_ok=True)
+
+    def create(self, export_format, **fields):
+        self.cleanup()
+        job = {
+            'job_id': uuid.uuid4().hex,
+            'format': export_format,
+            'status': 'queued',
+            'created_at': time.time(),
+            'updated_at': time.time(),
+            'error': None,
+            'size': None,
+        }
+        job.update(fields)
+        self._write_meta(job)
+        return job
+
+    def get(self, job_id):
+        if not JOB_ID_PATTERN.match(job_id or ''):
+            return None
+        job = self._read_meta(job_id)
+        if job is None:
+            return None
+        if self._is_expired(job, time.time()):
+            self.delete(job_id)
+            return None
+        return job
+
+    def update(self, job_id, **fields):
+        job = self.get(job_id)
+        if job is None:
+            return None
+        job.update(fields)
+        job['updated_at'] = time.time()
+        if job.get('status') in FINISHED_STATUSES and not job.get('finished_at'):
+            job['finished_at'] = job['updated_at']
+        self._write_meta(job)
+        return job
+
+    def write_result(self, job_id, data):
+        path = self.result_path(job_id)
+        fd, tmp_path = tempfile.mkstemp(dir=self.root_dir, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+        job = self.update(job_id, status='done', size=len(data))
+        if job is None:
+            # 書き込み中にジョブが削除されていたら、結果だけが残らないように消す
+            self._remove(path)
+        return job
+
+    def result_path(self, job_id):
+        return os.path.join(self.root_dir, f'{job_id}.bin')
+
+    def delete(self, job_id):
+        for path in (self._meta_path(job_id), self.result_path(job_id)):
+            self._remove(path)
+
+    def cleanup(self, force=False):
+        now = time.time()
+        with self._lock:
+            if not force and now - self._last_cleanup < CLEANUP_INTERVAL_SECONDS:
+                return
+            self._last_cleanup = now
+
+        names = os.listdir(self.root_dir)
+        job_ids = set()
+        for name in names:
+            job_id, ext = os.path.splitext(name)
+            if ext == '.json' and JOB_ID_PATTERN.match(job_id):
+                job_ids.add(job_id)
+
+        jobs = []
+        for job_id in job_ids:
+            job = self._read_meta(job_id)
+            if job is None:
+                continue
+            if self._is_expired(job, now):
+                self.delete(job_id)
+                continue
+            if job.get('status') not in FINISHED_STATUSES:
+                continue
+            try:
+                size = os.path.getsize(self.result_path(job_id))
+            except OSError:
+                size = 0
+            jobs.append((job.get('finished_at') or job.get('updated_at', 0), job_id, size))
+
+        # 状態ファイルのない結果と、異常終了などで残った書き込み途中の一時ファイルを削除する
+        for name in names:
+            job_id, ext = os.path.splitext(name)
+            path = os.path.join(self.root_dir, name)
+            if ext == '.bin' and job_id not in job_ids:
+                self._remove(path)
+            elif ext == '.tmp':
+                try:
+                    if now - os.path.getmtime(path) > self.ttl_seconds:
+                        self._remove(path)
+                except OSError:
+                    continue
+
+        # 件数・合計サイズの上限を超えた分は、完了・失敗したジョブを古いものから削除する（待機中・処理中は残す）
+        jobs.sort()
+        total_bytes = sum(size for _, _, size in jobs)
+        while jobs and (len(jobs) > self.max_jobs or total_bytes > self.max_bytes):
+            _, job_id, size = jobs.pop(0)
+            self.delete(job_id)
+            total_bytes -= size
+
+    def _meta_path(self, job_id):
+        return os.path.join(self.root_dir, f'{job_id}.json')
+
+    def _read_meta(self, job_id):
+        try:
+            with open(self._meta_path(job_id), 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _is_expired(self, job, now):
+        # 保持期間は完了・失敗した時刻から数える
+        if job.get('status') in FINISHED_STATUSES:
+            return now - (job.get('finished_at') or job.get('updated_at', 0)) > self.ttl_seconds
+        return now - job.get('updated_at', 0) > max(self.ttl_seconds, STALE_JOB_SECONDS)
+
+    @staticmethod
+    def _remove(path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            print(f"出力ジョブの削除に失敗しました: {e}")
+
+    def _write_meta(self, job):
+        fd, tmp_path = tempfile.mkstemp(dir=self.root_dir, suffix='.tmp')
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            json.dump(job, f, ensure_ascii=False)
+        os.replace(tmp_path, self._meta_path(job['job_id']))
+
+
+class ExportJobRunner:
+    def __init__(self, store, max_workers=2):
+        self.store = store
+        self.executor = ThreadPoolExecutor(max_workers=max(1, max_workers), thread_name_prefix='export-job')
+
+    def submit(self, job_id, func, *args):
+        return self.executor.submit(self._run, job_id, func, *args)
+
+    def _run(self, job_id, func, *args):
+        self.store.update(job_id, status='running')
+        try:
+            func(*args)
+        except Exception as e:
+            traceback.print_exc()
+            self.store.update(job_id, status='failed', error=str(e))
+
+
+def _env_number(name, default):
+    try:
+        return type(default)(os.environ.get(name, default))
+    except (TypeError, ValueError):
+        return default
+
+
+def create_job_store_from_env():
+    root_dir = os.environ.get('EXPORT_JOB_DIR') or os.path.join(tempfile.gettempdir(), 'math-export-jobs')
+    return ExportJobStore(
+        root_dir,
+        ttl_seconds=_env_number('EXPORT_JOB_TTL', DEFAULT_TTL_SECONDS),
+        max_jobs=_env_number('EXPORT_JOB_MAX', DEFAULT_MAX_JOBS),
+        max_bytes=_env_number('EXPORT_JOB_MAX_BYTES', DEFAULT_MAX_BYTES),
+    )
+
+
+def create_job_runner_from_env(store):
+    return ExportJobRunner(store, max_workers=_env_number('EXPORT_JOB_WORKERS', 2))
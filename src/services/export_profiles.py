@@ -0,0 +1,223 @@
+import copy
+import os
+import threading
+
+from docx import Document
+from docx.enum.section import WD_SECTION
+from docx.oxml.ns import qn
+from reportlab.lib.pagesizes import A4
+from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
+from reportlab.lib.units import inch
+from reportlab.pdfbase import pdfmetrics
+from reportlab.pdfbase.cidfonts import UnicodeCIDFont
+from reportlab.platypus import BaseDocTemplate, Frame, PageTemplate
+
+# PDF/Word出力のプロファイル
+# スタイル・フォント・ページテンプレート・Wordの雛形はプロセスごとに一度だけ作り、各リクエストで使い回す
+
+DEFAULT_FONT_NAME = 'HeiseiKakuGo-W5'
+try:
+    pdfmetrics.registerFont(UnicodeCIDFont(DEFAULT_FONT_NAME))
+except Exception:
+    DEFAULT_FONT_NAME = 'Helvetica'
+
+# 名前付きレイアウト
+# worksheet: 2段組の問題用紙（解答なし）、answer_key: 解答・解説のみ
+EXPORT_LAYOUTS = {
+    'standard': {'columns': 1, 'problems': True, 'answers': True},
+    'worksheet': {'columns': 2, 'problems': True, 'answers': False},
+    'answer_key': {'columns': 1, 'problems': False, 'answers': True},
+}
+DEFAULT_LAYOUT = 'standard'
+
+NAME_LINE = '　　年　　組　　番　名前＿＿＿＿＿＿＿＿＿＿＿＿'
+
+PAGE_SIZE = A4
+PAGE_MARGIN = inch
+FRAME_PADDING = 6
+COLUMN_GAP = 18
+TITLE_FRAME_HEIGHT = 72
+
+COLS_SUCCESSORS = {qn(f'w:{name}') for name in (
+    'formProt', 'vAlign', 'noEndnote', 'titlePg', 'textDirection', 'bidi', 'rtlGutter', 'docGrid',
+    'printerSettings', 'sectPrChange',
+)}
+
+
+def get_layout(name):
+    layout = EXPORT_LAYOUTS.get(name or DEFAULT_LAYOUT)
+    if layout is None:
+        raise ValueError(f'未対応のレイアウトです: {name}')
+    return layout
+
+
+def _build_pdf_styles():
+    styles = getSampleStyleSheet()
+    return {
+        'title': ParagraphStyle(
+            'CustomTitle',
+            parent=styles['Heading1'],
+            fontName=DEFAULT_FONT_NAME,
+            fontSize=16,
+            spaceAfter=24,
+        ),
+        'section_title': ParagraphStyle(
+            'SectionTitle',
+            parent=styles['Heading2'],
+            fontName=DEFAULT_FONT_NAME,
+            fontSize=14,
+            spaceAfter=12,
+        ),
+        'problem_heading': ParagraphStyle(
+            'ProblemHeading',
+            parent=styles['Heading3'],
+            fontName=DEFAULT_FONT_NAME,
+            fontSize=13,
+            spaceAfter=6,
+        ),
+        'label': ParagraphStyle(
+            'LabelStyle',
+            parent=styles['Normal'],
+            fontName=DEFAULT_FONT_NAME,
+            fontSize=12,
+            spaceAfter=4,
+        ),
+        'content': ParagraphStyle(
+            'CustomContent',
+            parent=styles['Normal'],
+            fontName=DEFAULT_FONT_NAME,
+            fontSize=12,
+            spaceAfter=6,
+        ),
+    }
+
+
+class PdfProfile:
+    def __init__(self):
+        self.styles = _build_pdf_styles()
+        page_width, page_height = PAGE_SIZE
+        self.body_width = page_width - 2 * PAGE_MARGIN
+        self.body_height = page_height - 2 * PAGE_MARGIN
+        self.column_width = (self.body_width - COLUMN_GAP) / 2
+        # Frame は描画中に位置を書き換えるため、ページテンプレートはスレッドごとに持つ
+        self._local = threading.local()
+
+    def content_width(self, layout):
+        if layout['columns'] > 1:
+            return self.column_width - 2 * FRAME_PADDING
+        return self.body_width - 2 * FRAME_PADDING
+
+    def create_document(self, buffer, layout):
+        doc = BaseDocTemplate(
+            buffer,
+            pagesize=PAGE_SIZE,
+            leftMargin=PAGE_MARGIN,
+            rightMargin=PAGE_MARGIN,
+            topMargin=PAGE_MARGIN,
+            bottomMargin=PAGE_MARGIN,
+        )
+        doc.addPageTemplates(self._page_templates(layout['columns']))
+        return doc
+
+    def _page_templates(self, columns):
+        templates = getattr(self._local, 'templates', None)
+        if templates is None:
+            templates = self._local.templates = {}
+        if columns not in templates:
+            templates[columns] = self._build_page_templates(columns)
+        return templates[columns]
+
+    def _build_page_templates(self, columns):
+        if columns == 1:
+            return [PageTemplate(id='single', frames=[
+                Frame(PAGE_MARGIN, PAGE_MARGIN, self.body_width, self.body_height, id='normal'),
+            ])]
+
+        def column_frames(height, prefix):
+            return [
+                Frame(PAGE_MARGIN + idx * (self.column_width + COLUMN_GAP), PAGE_MARGIN,
+                      self.column_width, height, id=f'{prefix}{idx + 1}')
+                for idx in range(2)
+            ]
+
+        # 1ページ目は上部にタイトル・名前欄、その下を2段組にする
+        title_frame = Frame(
+            PAGE_MARGIN, PAGE_MARGIN + self.body_height - TITLE_FRAME_HEIGHT,
+            self.body_width, TITLE_FRAME_HEIGHT, id='title',
+        )
+        first = PageTemplate(
+            id='first',
+            frames=[title_frame] + column_frames(self.body_height - TITLE_FRAME_HEIGHT, 'first-column'),
+            autoNextPageTemplate='columns',
+        )
+        rest = PageTemplate(id='columns', frames=column_frames(self.body_height, 'column'))
+        return [first, rest]
+
+
+_pdf_profile = None
+_word_template = None
+_profile_lock = threading.Lock()
+
+
+def get_pdf_profile():
+    global _pdf_profile
+    if _pdf_profile is None:
+        with _profile_lock:
+            if _pdf_profile is None:
+                _pdf_profile = PdfProfile()
+    return _pdf_profile
+
+
+def _load_word_template():
+    # EXPORT_WORD_TEMPLATE に学校ごとの .docx を指定すると、そのスタイル・ヘッダー・余白を使う（本文は使わない）
+    template_path = os.environ.get('EXPORT_WORD_TEMPLATE')
+    if template_path:
+        try:
+            document = Document(template_path)
+            body = document.element.body
+            for child in list(body):
+                if child.tag != qn('w:sectPr'):
+                    body.remove(child)
+            return document
+        except Exception as e:
+            print(f"Wordテンプレートの読み込みに失敗したため既定の雛形を使います: {e}")
+    return Document()
+
+
+def new_word_document():
+    # Document() は毎回パッケージを展開して XML を解析するため、読み込み済みの雛形を複製する
+    global _word_template
+    with _profile_lock:
+        if _word_template is None:
+            _word_template = _load_word_template()
+        return copy.deepcopy(_word_template)
+
+
+def start_word_columns(document, columns):
+    section = document.add_section(WD_SECTION.CONTINUOUS)
+    sect_pr = section._sectPr
+    cols = sect_pr.find(qn('w:cols'))
+    if cols is None:
+        # スキーマ上 w:cols は w:docGrid などより前に置く
+        cols = sect_pr.makeelement(qn('w:cols'), {})
+        successor = next((child for child in sect_pr if child.tag in COLS_SUCCESSORS), None)
+        if successor is not None:
+            successor.addprevious(cols)
+        else:
+            sect_pr.append(cols)
+    cols.set(qn('w:num'), str(columns))
+    cols.set(qn('w:space'), '425')
+    return section
+
+
+def word_content_width_pt(document, layout):
+    section = document.sections[-1]
+    width = (section.page_width - section.left_margin - section.right_margin) / 12700
+    if layout['columns'] > 1:
+        width = (width - 425 / 20 * (layout['columns'] - 1)) / layout['columns']
+    return width
+
+
+def warm_up():
+    get_pdf_profile()
+    new_word_document()
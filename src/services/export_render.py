@@ -0,0 +1,599 @@
+import atexit
+import hashlib
+import io
+import math
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from xml.sax.saxutils import escape
+
+from PIL import Image as PILImage
+from reportlab.platypus import Flowable, Paragraph, Spacer, PageBreak, FrameBreak, KeepTogether
+from reportlab.graphics import renderPDF
+from reportlab.graphics.shapes import Drawing, Path as RLPath, FILL_NON_ZERO
+from reportlab.lib import colors
+from reportlab.lib.utils import ImageReader
+from docx.shared import Pt
+import matplotlib
+from matplotlib import rcParams
+matplotlib.use('Agg')
+rcParams['mathtext.fontset'] = 'stix'
+rcParams['font.family'] = 'STIXGeneral'
+rcParams['mathtext.default'] = 'regular'
+from matplotlib.backends.backend_agg import RendererAgg
+from matplotlib.font_manager import FontProperties
+from matplotlib.path import Path as MplPath
+from matplotlib.textpath import text_to_path
+from matplotlib.transforms import Affine2D
+import numpy as np
+
+from src.services.math_cache import MathAsset, make_cache_key, normalize_expression, create_cache_from_env
+from src.services.math_text import split_text_with_math, normalize_latex_spacing, strip_step_markers
+from src.services.metrics import record_math_expressions, record_math_flowable, span
+from src.services import export_profiles
+from src.services.latex_omml import UnsupportedLatexError, latex_to_omml
+from src.services.export_profiles import NAME_LINE, get_layout, get_pdf_profile, new_word_document, start_word_columns, word_content_width_pt
+
+# PDF/Word出力と数式描画
+# matplotlib・reportlab・python-docx を読み込むため、最初の出力時に math_problem から遅延インポートされる
+
+MATH_FONT_SIZE = 16
+# 数式画像キャッシュ（MATH_CACHE_SIZE / MATH_CACHE_DIR で設定）
+math_asset_cache = create_cache_from_env()
+
+
+def _env_int(name, default):
+    try:
+        return int(os.environ.get(name, default))
+    except (TypeError, ValueError):
+        return default
+
+
+# エクスポート時の数式一括描画（MATH_RENDER_WORKERS=0 でプロセス内描画のみ）
+MATH_RENDER_WORKERS = _env_int('MATH_RENDER_WORKERS', min(4, (os.cpu_count() or 1) - 1))
+MATH_RENDER_BATCH_MIN = _env_int('MATH_RENDER_BATCH_MIN', 8)
+_math_render_pool = None
+_math_render_pool_lock = threading.Lock()
+_cached_drawing_lock = threading.Lock()
+# matplotlib の mathtext はスレッドセーフではないため、プロセス内での数式描画はスレッド間で直列化する
+_mathtext_lock = threading.Lock()
+
+# Word出力の数式（omml: Wordの数式として挿入し、未対応の記法だけ画像にする / png: すべて画像）
+WORD_MATH_FORMAT = (os.environ.get('EXPORT_WORD_MATH') or 'omml').lower()
+
+
+def _strip_math_delimiters(latex_expression):
+    expression = latex_expression.strip()
+    if expression.startswith('$$') and expression.endswith('$$') and len(expression) > 4:
+        expression = expression[2:-2].strip()
+    elif expression.startswith('$') and expression.endswith('$') and len(expression) > 2:
+        expression = expression[1:-1].strip()
+    if expression.startswith('\\(') and expression.endswith('\\)') and len(expression) > 4:
+        expression = expression[2:-2].strip()
+    if expression.startswith('\\[') and expression.endswith('\\]') and len(expression) > 4:
+        expression = expression[2:-2].strip()
+    return expression
+
+
+def _layout_math_expression(expression):
+    prop = FontProperties(size=MATH_FONT_SIZE, family='STIXGeneral')
+    math_string = '$' + expression + '$'
+    # TextToPath と同じ条件で1回だけ解析する（get_text_path は解析結果のキャッシュを再利用する）
+    layout_prop = prop.copy()
+    layout_prop.set_size(text_to_path.FONT_SCALE)
+    layout = text_to_path.mathtext_parser.parse(math_string, text_to_path.DPI, layout_prop)
+    verts, codes = text_to_path.get_text_path(prop, math_string, ismath=True)
+
+    scale = MATH_FONT_SIZE / text_to_path.FONT_SCALE
+    width_points = layout.width * scale
+    height_points = layout.height * scale
+    vertices = np.asarray(verts, dtype=float).reshape(-1, 2) * scale
+    # ベースラインが y=0 なので、ディセンダ分だけ持ち上げて左下を原点にする
+    vertices[:, 1] += layout.depth * scale
+    return width_points, height_points, vertices, np.asarray(codes, dtype=np.uint8)
+
+
+def _rasterize_math_path(vertices, codes, width_points, height_points, dpi):
+    width_px = max(1, int(math.ceil(width_points * dpi / 72)))
+    height_px = max(1, int(math.ceil(height_points * dpi / 72)))
+    renderer = RendererAgg(width_px, height_px, dpi)
+    if len(vertices):
+        gc = renderer.new_gc()
+        gc.set_linewidth(0)
+        renderer.draw_path(gc, MplPath(vertices, codes), Affine2D().scale(dpi / 72), rgbFace=(0, 0, 0, 1))
+        gc.restore()
+    # 黒の輝度と描画した部分のアルファだけを持つ 'LA' 画像にして、背景を透明のまま保存する
+    alpha = np.asarray(renderer.buffer_rgba())[:, :, 3]
+    png_buffer = io.BytesIO()
+    PILImage.fromarray(np.dstack((np.zeros_like(alpha), alpha))).save(png_buffer, format='PNG')
+    return png_buffer.getvalue()
+
+
+def _render_math_assets(expression, dpi):
+    width_points, height_points, vertices, codes = _layout_math_expression(expression)
+    png_bytes = _rasterize_math_path(vertices, codes, width_points, height_points, dpi)
+    vector_data = {
+        'vertices': np.round(vertices, 3).tolist(),
+        'codes': codes.tolist(),
+    }
+    return MathAsset(png_bytes, width_points, height_points, vector_data, None)
+
+
+def _render_math_assets_or_none(expression, dpi):
+    # mathtext で解釈できない数式は None を返し、呼び出し側で LaTeX のまま文字として出す
+    try:
+        return _render_math_assets(expression, dpi)
+    except ValueError as e:
+        print(f"数式を描画できなかったため文字のまま出力します: {expression}: {str(e).splitlines()[-1]}")
+        return None
+
+
+def _build_math_drawing(vector_data, width_points, height_points):
+    if not vector_data or not width_points or not height_points:
+        return None
+    vertices = vector_data.get('vertices') or []
+    codes = vector_data.get('codes') or []
+    path = RLPath(fillColor=colors.black, strokeColor=None, strokeWidth=0, fillMode=FILL_NON_ZERO)
+    current = start = (0.0, 0.0)
+    idx = 0
+    while idx < len(codes):
+        code = codes[idx]
+        if code == MplPath.MOVETO:
+            current = start = tuple(vertices[idx])
+            path.moveTo(*current)
+            idx += 1
+        elif code == MplPath.LINETO:
+            current = tuple(vertices[idx])
+            path.lineTo(*current)
+            idx += 1
+        elif code == MplPath.CURVE3:
+            # 2次ベジェは3次ベジェに変換して描く
+            (qx, qy), (ex, ey) = vertices[idx], vertices[idx + 1]
+            cx, cy = current
+            path.curveTo(
+                cx + 2 / 3 * (qx - cx), cy + 2 / 3 * (qy - cy),
+                ex + 2 / 3 * (qx - ex), ey + 2 / 3 * (qy - ey),
+                ex, ey,
+            )
+            current = (ex, ey)
+            idx += 2
+        elif code == MplPath.CURVE4:
+            (x1, y1), (x2, y2), (ex, ey) = vertices[idx], vertices[idx + 1], vertices[idx + 2]
+            path.curveTo(x1, y1, x2, y2, ex, ey)
+            current = (ex, ey)
+            idx += 3
+        elif code == MplPath.CLOSEPOLY:
+            path.closePath()
+            current = start
+            idx += 1
+        else:
+            idx += 1
+    drawing = Drawing(width_points, height_points)
+    drawing.add(path)
+    drawing.hAlign = 'LEFT'
+    return drawing
+
+
+def math_asset_key(latex_expression, dpi=300):
+    return make_cache_key(normalize_expression(_strip_math_delimiters(latex_expression)), dpi, MATH_FONT_SIZE, 'png+path')
+
+
+def generate_math_assets(latex_expression, display=False, dpi=300):
+    expression = normalize_expression(_strip_math_delimiters(latex_expression))
+    if not expression:
+        return None
+    cache_key = make_cache_key(expression, dpi, MATH_FONT_SIZE, 'png+path')
+    asset = math_asset_cache.get(cache_key)
+    if asset is None:
+        with _mathtext_lock:
+            asset = _render_math_assets_or_none(expression, dpi)
+        if asset is None:
+            return None
+        asset = asset._replace(drawing=_build_math_drawing(asset.vector_data, asset.width_pt, asset.height_pt))
+        math_asset_cache.put(cache_key, asset)
+    elif asset.drawing is None and asset.vector_data:
+        # ディスク層から読み込んだ場合は描画オブジェクトだけ再構築してメモリに保持する
+        asset = asset._replace(drawing=_build_math_drawing(asset.vector_data, asset.width_pt, asset.height_pt))
+        math_asset_cache.put(cache_key, asset, persist=False)
+    return io.BytesIO(asset.png_bytes), asset.width_pt, asset.height_pt, asset.drawing
+
+
+def render_math_to_image(latex_expression, display=False, dpi=300):
+    assets = generate_math_assets(latex_expression, display=display, dpi=dpi)
+    if not assets:
+        return None
+    png_buffer, width_points, height_points, _ = assets
+    png_buffer.seek(0)
+    return png_buffer, width_points, height_points
+
+
+def _get_math_render_pool():
+    global _math_render_pool
+    if MATH_RENDER_WORKERS <= 0:
+        return None
+    with _math_render_pool_lock:
+        if _math_render_pool is None:
+            # gunicorn のスレッド状態を引き継がないよう spawn で起動する
+            _math_render_pool = ProcessPoolExecutor(
+                max_workers=MATH_RENDER_WORKERS,
+                mp_context=multiprocessing.get_context('spawn'),
+            )
+            atexit.register(_math_render_pool.shutdown, wait=False, cancel_futures=True)
+        return _math_render_pool
+
+
+def _reset_math_render_pool():
+    global _math_render_pool
+    with _math_render_pool_lock:
+        pool, _math_render_pool = _math_render_pool, None
+    if pool is not None:
+        pool.shutdown(wait=False, cancel_futures=True)
+
+
+def collect_math_expressions(texts):
+    expressions = {}
+    for text in texts:
+        if not text:
+            continue
+        text = strip_step_markers(text)
+        for line in str(text).splitlines():
+            for kind, value, _ in split_text_with_math(normalize_latex_spacing(line)):
+                if kind != 'math':
+                    continue
+                expression = normalize_expression(_strip_math_delimiters(value))
+                if expression:
+                    expressions.setdefault(expression, None)
+    return list(expressions)
+
+
+def render_math_batch(expressions, dpi=300):
+    pending = []
+    unique_expressions = list(dict.fromkeys(expressions))
+    for expression in unique_expressions:
+        cache_key = make_cache_key(expression, dpi, MATH_FONT_SIZE, 'png+path')
+        if math_asset_cache.get(cache_key) is None:
+            pending.append((expression, cache_key))
+    record_math_expressions(cached=len(unique_expressions) - len(pending), rendered=len(pending))
+    if not pending:
+        return 0
+
+    results = None
+    pool = _get_math_render_pool() if len(pending) >= MATH_RENDER_BATCH_MIN else None
+    if pool is not None:
+        try:
+            chunksize = max(1, len(pending) // (MATH_RENDER_WORKERS * 4))
+            results = list(pool.map(
+                _render_math_assets_or_none,
+                [expression for expression, _ in pending],
+                [dpi] * len(pending),
+                chunksize=chunksize,
+            ))
+        except Exception as e:
+            print(f"数式の並列レンダリングに失敗したためプロセス内で描画します: {e}")
+            _reset_math_render_pool()
+            results = None
+    if results is None:
+        with _mathtext_lock:
+            results = [_render_math_assets_or_none(expression, dpi) for expression, _ in pending]
+
+    for (_, cache_key), asset in zip(pending, results):
+        if asset is None:
+            continue
+        asset = asset._replace(drawing=_build_math_drawing(asset.vector_data, asset.width_pt, asset.height_pt))
+        math_asset_cache.put(cache_key, asset)
+    return len(pending)
+
+
+def prerender_problem_math(problems_list, problems_text=None, dpi=300, needs_image=None):
+    texts = []
+    for item in problems_list or []:
+        texts.extend([item.get('problem'), item.get('answer'), item.get('explanation')])
+    if not problems_list and problems_text:
+        texts.append(problems_text)
+    try:
+        with span('math'):
+            expressions = collect_math_expressions(texts)
+            if needs_image is not None:
+                expressions = [expression for expression in expressions if needs_image(expression)]
+            return render_math_batch(expressions, dpi=dpi)
+    except Exception as e:
+        # 事前描画に失敗しても各数式は文書生成時に個別に描画される
+        print(f"数式の事前描画に失敗しました: {e}")
+        return 0
+
+
+class MathFormFlowable(Flowable):
+    """文書内で2回以上使う数式は1つのフォームXObjectとして書き出し、各所からはそれを参照する"""
+
+    def __init__(self, form_name, width, height, draw_form, max_width=None, h_align='LEFT', form_uses=None):
+        Flowable.__init__(self)
+        self.form_name = form_name
+        # 1回しか使わない数式はフォームにすると辞書やストリームの分だけかえって大きくなるため、その場に描く
+        self.form_uses = form_uses
+        if form_uses is not None:
+            form_uses[form_name] = form_uses.get(form_name, 0) + 1
+        self.form_width = width
+        self.form_height = height
+        self.draw_form = draw_form
+        # 段組で列幅を超える数式は縦横比を保って縮小する
+        self.scale = max_width / width if max_width and width > max_width else 1.0
+        self.width = width * self.scale
+        self.height = height * self.scale
+        self.hAlign = h_align
+
+    def wrap(self, available_width, available_height):
+        return self.width, self.height
+
+    def draw(self):
+        canvas = self.canv
+        if self.form_uses is not None and self.form_uses[self.form_name] < 2:
+            if self.scale != 1.0:
+                canvas.saveState()
+                canvas.scale(self.scale, self.scale)
+                self.draw_form(canvas)
+                canvas.restoreState()
+            else:
+                self.draw_form(canvas)
+            return
+        if not canvas.hasForm(self.form_name):
+            canvas.beginForm(self.form_name, 0, 0, self.form_width, self.form_height)
+            self.draw_form(canvas)
+            canvas.endForm()
+        if self.scale != 1.0:
+            canvas.saveState()
+            canvas.scale(self.scale, self.scale)
+            canvas.doForm(self.form_name)
+            canvas.restoreState()
+        else:
+            canvas.doForm(self.form_name)
+
+
+def _vector_form(drawing):
+    def draw_form(canvas):
+        # キャッシュ済みの図形は出力中の全文書で共有され、reportlab は描画中に図形へ属性を書き込むため、
+        # 同じ数式を含む文書を複数スレッドで同時に出力しても壊れないよう描画だけ直列化する
+        with _cached_drawing_lock:
+            renderPDF.draw(drawing, canvas, 0, 0)
+    return draw_form
+
+
+def _png_form(png_bytes, width_pt, height_pt):
+    def draw_form(canvas):
+        canvas.drawImage(ImageReader(io.BytesIO(png_bytes)), 0, 0, width_pt, height_pt, mask='auto')
+    return draw_form
+
+
+def append_text_with_math_to_story(story, text, style, max_width=None, form_uses=None):
+    if text is None:
+        return
+    text = strip_step_markers(text)
+    lines = str(text).splitlines() or ['']
+    for line in lines:
+        line = normalize_latex_spacing(line)
+        segments = split_text_with_math(line)
+        if not segments:
+            story.append(Spacer(1, 6))
+            continue
+        flow_items = []
+        for kind, value, display in segments:
+            if kind == 'text':
+                clean_text = value.strip()
+                if clean_text:
+                    flow_items.append(Paragraph(escape(clean_text), style))
+            elif kind == 'math':
+                assets = generate_math_assets(value, display=display)
+                if assets:
+                    png_buffer, width_pt, height_pt, drawing = assets
+                    if drawing is not None:
+                        record_math_flowable('pdf', 'vector')
+                        form_name = 'Math' + math_asset_key(value)[:32]
+                        flow_items.append(MathFormFlowable(
+                            form_name, drawing.width, drawing.height, _vector_form(drawing), max_width,
+                            form_uses=form_uses,
+                        ))
+                    else:
+                        # PNG は内容のハッシュで同じ画像を1つにまとめる
+                        record_math_flowable('pdf', 'png')
+                        png_bytes = png_buffer.getvalue()
+                        form_name = 'MathPng' + hashlib.sha256(png_bytes).hexdigest()[:32]
+                        flow_items.append(MathFormFlowable(
+                            form_name, width_pt, height_pt, _png_form(png_bytes, width_pt, height_pt), max_width,
+                            h_align='CENTER', form_uses=form_uses,
+                        ))
+                elif normalize_expression(_strip_math_delimiters(value)):
+                    # 描画できない数式は LaTeX のまま文字で出し、他の部分の出力は続ける
+                    record_math_flowable('pdf', 'text')
+                    flow_items.append(Paragraph(escape(value.strip()), style))
+                else:
+                    record_math_flowable('pdf', 'missing')
+        if flow_items:
+            story.append(KeepTogether(flow_items))
+            story.append(Spacer(1, 6))
+
+
+def word_math_element(latex_expression, display=False):
+    if WORD_MATH_FORMAT != 'omml':
+        return None
+    expression = normalize_expression(_strip_math_delimiters(latex_expression))
+    if not expression:
+        return None
+    try:
+        return latex_to_omml(expression, display=display)
+    except UnsupportedLatexError:
+        return None
+
+
+def _needs_word_image(expression):
+    return word_math_element(expression) is None
+
+
+def add_paragraph_with_math(document, text, style_name=None, max_width_pt=None):
+    if text is None:
+        return
+    text = strip_step_markers(text)
+    lines = str(text).splitlines() or ['']
+    for line in lines:
+        line = normalize_latex_spacing(line)
+        segments = split_text_with_math(line)
+        if not segments:
+            continue
+        paragraph = document.add_paragraph()
+        if style_name:
+            paragraph.style = style_name
+        # 行が数式だけのときはディスプレイ数式（段落数式）として置く
+        standalone = sum(1 for kind, value, _ in segments if kind == 'math' or value.strip()) == 1
+        for kind, value, display in segments:
+            if kind == 'text':
+                clean_text = value.strip()
+                if clean_text:
+                    paragraph.add_run(clean_text)
+            elif kind == 'math':
+                omml = word_math_element(value, display=display and standalone)
+                if omml is not None:
+                    record_math_flowable('word', 'omml')
+                    if display:
+                        paragraph.alignment = 1
+                    paragraph._p.append(omml)
+                    continue
+                rendered = render_math_to_image(value, display=display)
+                if rendered:
+                    record_math_flowable('word', 'png')
+                    img_buffer, width_pt, height_pt = rendered
+                    if display:
+                        paragraph.alignment = 1
+                    picture_width = width_pt * 0.9
+                    if max_width_pt:
+                        picture_width = min(picture_width, max_width_pt)
+                    run = paragraph.add_run()
+                    run.add_picture(img_buffer, width=Pt(picture_width))
+                elif normalize_expression(_strip_math_delimiters(value)):
+                    record_math_flowable('word', 'text')
+                    paragraph.add_run(value.strip())
+
+
+def build_pdf_document(export_data):
+    metadata = export_data['metadata']
+    problems_text = export_data['problems_text']
+    layout = get_layout(export_data.get('layout'))
+    profile = get_pdf_profile()
+    styles = profile.styles
+    # 標準レイアウトは従来どおり縮小しない
+    max_width = profile.content_width(layout) if layout['columns'] > 1 else None
+
+    buffer = io.BytesIO()
+    doc = profile.create_document(buffer, layout)
+
+    story = []
+    title_text = metadata.get('unit') or '数学問題集'
+    if not layout['problems']:
+        title_text = f'{title_text} 解答・解説'
+    story.append(Paragraph(escape(title_text), styles['title']))
+    if layout['columns'] > 1:
+        story.append(Paragraph(NAME_LINE, styles['label']))
+        story.append(FrameBreak())
+    else:
+        story.append(Spacer(1, 12))
+
+    problems_list = export_data['problems_list']
+    prerender_problem_math(problems_list, problems_text)
+    # 数式ごとの使用回数。繰り返し出てくる数式だけを共有フォームにする
+    form_uses = {}
+    with span('layout'):
+        if not problems_list:
+            for line in problems_text.split('\n'):
+                append_text_with_math_to_story(story, line, styles['content'], max_width, form_uses)
+        else:
+            if layout['problems']:
+                story.append(Paragraph('問題一覧', styles['section_title']))
+                story.append(Spacer(1, 6))
+                for idx, item in enumerate(problems_list, start=1):
+                    story.append(Paragraph(f'問題{idx}', styles['problem_heading']))
+                    append_text_with_math_to_story(story, item.get('problem'), styles['content'], max_width, form_uses)
+                    story.append(Spacer(1, 12))
+
+            if layout['answers']:
+                if layout['problems']:
+                    story.append(PageBreak())
+                story.append(Paragraph('解答・解説', styles['section_title']))
+                story.append(Spacer(1, 6))
+                for idx, item in enumerate(problems_list, start=1):
+                    story.append(Paragraph(f'問題{idx}', styles['problem_heading']))
+                    answer = item.get('answer')
+                    explanation = item.get('explanation')
+                    if answer:
+                        story.append(Paragraph('解答', styles['label']))
+                        append_text_with_math_to_story(story, answer, styles['content'], max_width, form_uses)
+                    if explanation:
+                        story.append(Paragraph('解説', styles['label']))
+                        append_text_with_math_to_story(story, explanation, styles['content'], max_width, form_uses)
+                    story.append(Spacer(1, 12))
+
+    with span('build'):
+        doc.build(story)
+    buffer.seek(0)
+    return buffer
+
+
+def build_word_document(export_data):
+    metadata = export_data['metadata']
+    problems_text = export_data['problems_text']
+    layout = get_layout(export_data.get('layout'))
+
+    doc = new_word_document()
+    title_text = metadata.get('unit') or '数学問題集'
+    if not layout['problems']:
+        title_text = f'{title_text} 解答・解説'
+    doc.add_heading(title_text, 0)
+    max_width_pt = None
+    if layout['columns'] > 1:
+        doc.add_paragraph(NAME_LINE)
+        start_word_columns(doc, layout['columns'])
+        max_width_pt = word_content_width_pt(doc, layout)
+
+    problems_list = export_data['problems_list']
+    # Wordの数式に変換できない数式だけ画像を用意する
+    prerender_problem_math(problems_list, problems_text, needs_image=_needs_word_image)
+    with span('layout'):
+        if not problems_list:
+            for line in strip_step_markers(problems_text or '').split('\n'):
+                add_paragraph_with_math(doc, line, max_width_pt=max_width_pt)
+        else:
+            if layout['problems']:
+                doc.add_heading('問題一覧', level=1)
+                for idx, item in enumerate(problems_list, start=1):
+                    doc.add_heading(f'問題{idx}', level=2)
+                    add_paragraph_with_math(doc, item.get('problem'), max_width_pt=max_width_pt)
+                    doc.add_paragraph('')
+
+            if layout['answers']:
+                if layout['problems']:
+                    doc.add_page_break()
+                doc.add_heading('解答・解説', level=1)
+                for idx, item in enumerate(problems_list, start=1):
+                    doc.add_heading(f'問題{idx}', level=2)
+                    answer = item.get('answer')
+                    explanation = item.get('explanation')
+                    if answer:
+                        doc.add_heading('解答', level=3)
+                        add_paragraph_with_math(doc, answer, max_width_pt=max_width_pt)
+                    if explanation:
+                        doc.add_heading('解説', level=3)
+                        add_paragraph_with_math(doc, explanation, max_width_pt=max_width_pt)
+                    doc.add_paragraph('')
+
+    buffer = io.BytesIO()
+    with span('build'):
+        doc.save(buffer)
+    buffer.seek(0)
+    return buffer
+
+
+def warm_up(start_pool=False):
+    # フォント・mathtext の初期化を済ませ、最初の出力リクエストの待ち時間を減らす
+    generate_math_assets('x^2 + \\frac{1}{2}')
+    export_profiles.warm_up()
+    if start_pool:
+        pool = _get_math_render_pool()
+        if pool is not None:
+            list(pool.map(_render_math_assets, ['x'] * MATH_RENDER_WORKERS, [72] * MATH_RENDER_WORKERS))
@@ -0,0 +1,93 @@
+import io
+import os
+import time
+
+from PIL import ExifTags, Image, ImageChops, ImageOps
+
+# OCR前の画像前処理
+# 向き補正 → グレースケール化 → 余白の自動トリミング → 縮小 → 再エンコード
+
+DEFAULT_MAX_EDGE = 1600
+DEFAULT_JPEG_QUALITY = 80
+# 背景とみなす明るさからの差。これより小さい差はトリミング時に無視する
+CROP_THRESHOLD = 40
+CROP_MARGIN = 16
+
+
+def _env_int(name, default):
+    try:
+        return int(os.environ.get(name, default))
+    except (TypeError, ValueError):
+        return default
+
+
+def _autocrop(image):
+    # 四隅の明るさの最大値を背景色とみなし、それより十分暗い画素を含む範囲だけ残す
+    width, height = image.size
+    corners = [image.getpixel((0, 0)), image.getpixel((width - 1, 0)),
+               image.getpixel((0, height - 1)), image.getpixel((width - 1, height - 1))]
+    background = Image.new('L', image.size, max(corners))
+    diff = ImageChops.difference(image, background).point(lambda value: 255 if value > CROP_THRESHOLD else 0)
+    bbox = diff.getbbox()
+    if not bbox:
+        return image
+    left, top, right, bottom = bbox
+    bbox = (
+        max(0, left - CROP_MARGIN),
+        max(0, top - CROP_MARGIN),
+        min(width, right + CROP_MARGIN),
+        min(height, bottom + CROP_MARGIN),
+    )
+    if bbox == (0, 0, width, height):
+        return image
+    return image.crop(bbox)
+
+
+def preprocess_image(image_bytes, max_edge=None, jpeg_quality=None):
+    max_edge = max_edge or _env_int('OCR_MAX_EDGE', DEFAULT_MAX_EDGE)
+    jpeg_quality = jpeg_quality or _env_int('OCR_JPEG_QUALITY', DEFAULT_JPEG_QUALITY)
+    start = time.perf_counter()
+
+    with Image.open(io.BytesIO(image_bytes)) as source:
+        source_format = (source.format or '').upper()
+        original_size = source.size
+        # EXIF の向き情報だけで回転している写真（スマートフォンなど）は、元画像のままだと横向きで読まれる
+        reoriented = source.getexif().get(ExifTags.Base.Orientation, 1) not in (0, 1)
+        image = ImageOps.exif_transpose(source)
+        if image.mode in ('RGBA', 'LA', 'P'):
+            # 透過部分は白背景として扱う
+            image = image.convert('RGBA')
+            flattened = Image.new('RGBA', image.size, (255, 255, 255, 255))
+            flattened.alpha_composite(image)
+            image = flattened
+        image = image.convert('L')
+
+    image = _autocrop(image)
+    if max(image.size) > max_edge:
+        image.thumbnail((max_edge, max_edge), Image.LANCZOS)
+
+    output = io.BytesIO()
+    # 線画やスクリーンショット（PNG）はPNGのまま、写真はJPEGで保存する
+    if source_format in ('PNG', 'GIF', 'BMP'):
+        image.save(output, format='PNG', optimize=True)
+        mime_type = 'image/png'
+    else:
+        image.save(output, format='JPEG', quality=jpeg_quality, optimize=True)
+        mime_type = 'image/jpeg'
+    processed_bytes = output.getvalue()
+    processed_size = image.size
+
+    # 元より大きくなった場合は元画像をそのまま送る（向きを補正した場合は補正後の画像を送る）
+    if (not reoriented and len(processed_bytes) >= len(image_bytes)
+            and source_format in ('JPEG', 'PNG', 'GIF', 'WEBP')):
+        processed_bytes = image_bytes
+        processed_size = original_size
+        mime_type = Image.MIME.get(source_format, mime_type)
+
+    return processed_bytes, mime_type, {
+        'original_bytes': len(image_bytes),
+        'processed_bytes': len(processed_bytes),
+        'original_size': list(original_size),
+        'processed_size': list(processed_size),
+        'preprocess_ms': round((time.perf_counter() - start) * 1000, 1),
+    }
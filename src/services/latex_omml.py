@@ -0,0 +1,295 @@
+import re
+
+from docx.oxml import OxmlElement
+from docx.oxml.ns import qn
+
+# LaTeX から Word の数式（OMML）への変換
+# prompt_template.txt で使う範囲（分数・根号・累乗・添字・三角関数・ギリシャ文字・Σ/∫ など）だけに対応し、
+# それ以外の記法は UnsupportedLatexError を送出して呼び出し側で PNG に切り替える
+
+
+class UnsupportedLatexError(ValueError):
+    pass
+
+
+TOKEN_PATTERN = re.compile(r'\\([A-Za-z]+)|\\(.)|(\s+)|(.)', re.S)
+
+GREEK = {
+    'alpha': 'α', 'beta': 'β', 'gamma': 'γ', 'delta': 'δ', 'epsilon': 'ϵ', 'varepsilon': 'ε',
+    'zeta': 'ζ', 'eta': 'η', 'theta': 'θ', 'vartheta': 'ϑ', 'iota': 'ι', 'kappa': 'κ',
+    'lambda': 'λ', 'mu': 'μ', 'nu': 'ν', 'xi': 'ξ', 'pi': 'π', 'rho': 'ρ', 'sigma': 'σ',
+    'tau': 'τ', 'upsilon': 'υ', 'phi': 'ϕ', 'varphi': 'φ', 'chi': 'χ', 'psi': 'ψ', 'omega': 'ω',
+    'Gamma': 'Γ', 'Delta': 'Δ', 'Theta': 'Θ', 'Lambda': 'Λ', 'Xi': 'Ξ', 'Pi': 'Π',
+    'Sigma': 'Σ', 'Phi': 'Φ', 'Psi': 'Ψ', 'Omega': 'Ω',
+}
+
+SYMBOLS = {
+    'pm': '±', 'mp': '∓', 'times': '×', 'div': '÷', 'cdot': '⋅', 'ast': '∗',
+    'le': '≤', 'leq': '≤', 'leqq': '≦', 'ge': '≥', 'geq': '≥', 'geqq': '≧', 'ne': '≠', 'neq': '≠',
+    'lt': '<', 'gt': '>', 'approx': '≈', 'equiv': '≡', 'sim': '∼', 'propto': '∝',
+    'infty': '∞', 'to': '→', 'rightarrow': '→', 'leftarrow': '←', 'Rightarrow': '⇒',
+    'Leftarrow': '⇐', 'Leftrightarrow': '⇔', 'iff': '⇔', 'cdots': '⋯', 'ldots': '…', 'dots': '…',
+    'angle': '∠', 'triangle': '△', 'perp': '⊥', 'parallel': '∥', 'circ': '∘', 'degree': '°',
+    'prime': '′', 'mid': '∣', 'vert': '|', 'partial': '∂', 'therefore': '∴', 'because': '∵',
+    'lbrace': '{', 'rbrace': '}', 'langle': '⟨', 'rangle': '⟩', 'lvert': '|', 'rvert': '|',
+}
+
+FUNCTIONS = {
+    'sin', 'cos', 'tan', 'sec', 'csc', 'cot', 'arcsin', 'arccos', 'arctan', 'sinh', 'cosh', 'tanh',
+    'log', 'ln', 'exp', 'lim', 'max', 'min', 'det', 'gcd',
+}
+# 添字を下に置く関数（\lim_{x \to 0} など）
+LIMIT_FUNCTIONS = {'lim', 'max', 'min'}
+
+NARY = {'sum': '∑', 'prod': '∏', 'int': '∫', 'iint': '∬', 'oint': '∮'}
+FRACTIONS = {'frac', 'dfrac', 'tfrac', 'cfrac'}
+TEXT_COMMANDS = {'text', 'mathrm', 'textrm', 'operatorname', 'mbox'}
+ACCENTS = {'vec': '⃗', 'hat': '̂', 'dot': '̇', 'tilde': '̃'}
+SPACES = {',': '\u2009', ':': '\u2005', ';': '\u2005', ' ': ' ', 'quad': '\u2003', 'qquad': '\u2003\u2003'}
+IGNORED = {'displaystyle', 'textstyle', 'limits', 'nolimits', '!'}
+ESCAPED = {'{', '}', '%', '$', '#', '_', '|'}
+CHARACTERS = {'-': '\u2212', '*': '\u2217', "'": '\u2032', '~': '\u00a0'}
+DELIMITERS = {'(', ')', '[', ']', '|', '.', '{', '}', '⟨', '⟩'}
+
+
+def _element(tag, *children, **attrs):
+    element = OxmlElement(tag)
+    for name, value in attrs.items():
+        element.set(qn(f'm:{name}'), value)
+    for child in children:
+        if isinstance(child, list):
+            element.extend(child)
+        elif child is not None:
+            element.append(child)
+    return element
+
+
+def _run(text, style=None):
+    run = _element('m:r')
+    if style:
+        run.append(_element('m:rPr', _element('m:sty', val=style)))
+    t = _element('m:t')
+    t.text = text
+    if text != text.strip():
+        t.set(qn('xml:space'), 'preserve')
+    run.append(t)
+    return run
+
+
+def _tokenize(latex):
+    tokens = []
+    for match in TOKEN_PATTERN.finditer(latex):
+        command, symbol, space, char = match.groups()
+        if command:
+            tokens.append(('cmd', command))
+        elif symbol is not None:
+            tokens.append(('cmd', symbol))
+        elif space:
+            tokens.append(('space', space))
+        else:
+            tokens.append(('char', char))
+    return tokens
+
+
+class _Parser:
+    def __init__(self, latex):
+        self.tokens = _tokenize(latex)
+        self.pos = 0
+
+    def peek(self, skip_space=True):
+        if skip_space:
+            while self.pos < len(self.tokens) and self.tokens[self.pos][0] == 'space':
+                self.pos += 1
+        return self.tokens[self.pos] if self.pos < len(self.tokens) else None
+
+    def take(self):
+        token = self.peek()
+        if token is None:
+            raise UnsupportedLatexError('数式が途中で終わっています')
+        self.pos += 1
+        return token
+
+    def parse_sequence(self, stop=None):
+        elements = []
+        while True:
+            token = self.peek()
+            if token is None:
+                if stop is not None:
+                    raise UnsupportedLatexError('括弧が閉じていません')
+                return elements
+            if token == stop:
+                self.pos += 1
+                return elements
+            if token[0] == 'cmd' and token[1] in NARY:
+                # Σ・∫ の本体は同じ括弧内の残り全体とする
+                self.pos += 1
+                sub, sup = self.parse_scripts()
+                elements.append(self.build_nary(token[1], sub, sup, self.parse_sequence(stop)))
+                return elements
+            elements.extend(self.parse_scripted())
+
+    def parse_scripts(self):
+        sub = sup = None
+        while True:
+            token = self.peek()
+            if token == ('char', '_') and sub is None:
+                self.pos += 1
+                sub = self.parse_argument()
+            elif token == ('char', '^') and sup is None:
+                self.pos += 1
+                sup = self.parse_argument()
+            elif token in (('cmd', 'limits'), ('cmd', 'nolimits')):
+                self.pos += 1
+            else:
+                return sub, sup
+
+    def parse_scripted(self):
+        token = self.peek()
+        base = self.parse_atom()
+        sub, sup = self.parse_scripts()
+        if sub is None and sup is None:
+            return base
+        if token[0] == 'cmd' and token[1] in LIMIT_FUNCTIONS and sub is not None:
+            base = [_element('m:limLow', _element('m:e', base), _element('m:lim', sub))]
+            if sup is None:
+                return base
+            return [_element('m:sSup', _element('m:e', base), _element('m:sup', sup))]
+        if sub is not None and sup is not None:
+            return [_element('m:sSubSup', _element('m:e', base), _element('m:sub', sub), _element('m:sup', sup))]
+        if sup is not None:
+            return [_element('m:sSup', _element('m:e', base), _element('m:sup', sup))]
+        return [_element('m:sSub', _element('m:e', base), _element('m:sub', sub))]
+
+    def parse_argument(self):
+        token = self.take()
+        if token == ('char', '{'):
+            return self.parse_sequence(('char', '}'))
+        if token[0] == 'char':
+            return self.char_atom(token[1])
+        self.pos -= 1
+        return self.parse_atom()
+
+    def parse_atom(self):
+        kind, value = self.take()
+        if kind == 'char':
+            if value == '{':
+                return self.parse_sequence(('char', '}'))
+            if value.isdigit() or value == '.':
+                # 連続する数字は1つのまとまりにする（添字の x^10 は parse_argument 側で1文字ずつ）
+                digits = [value]
+                while self.pos < len(self.tokens) and self.tokens[self.pos][0] == 'char' \
+                        and (self.tokens[self.pos][1].isdigit() or self.tokens[self.pos][1] == '.'):
+                    digits.append(self.tokens[self.pos][1])
+                    self.pos += 1
+                return [_run(''.join(digits))]
+            return self.char_atom(value)
+        return self.command_atom(value)
+
+    def char_atom(self, char):
+        if char in ('}', '&', '^', '_'):
+            raise UnsupportedLatexError(f'未対応の記号です: {char}')
+        if char.isascii() and char.isalnum():
+            return [_run(char)]
+        if not char.isascii():
+            # 日本語などはそのまま立体で出す
+            return [_run(char, style='p')]
+        return [_run(CHARACTERS.get(char, char), style='p')]
+
+    def command_atom(self, name):
+        if name in FRACTIONS:
+            numerator = self.parse_argument()
+            denominator = self.parse_argument()
+            return [_element('m:f', _element('m:num', numerator), _element('m:den', denominator))]
+        if name == 'sqrt':
+            degree = None
+            if self.peek() == ('char', '['):
+                self.pos += 1
+                degree = self.parse_sequence(('char', ']'))
+            radicand = self.parse_argument()
+            if degree is None:
+                return [_element(
+                    'm:rad',
+                    _element('m:radPr', _element('m:degHide', val='1')),
+                    _element('m:deg'),
+                    _element('m:e', radicand),
+                )]
+            return [_element('m:rad', _element('m:deg', degree), _element('m:e', radicand))]
+        if name in FUNCTIONS:
+            return [_run(name, style='p')]
+        if name in GREEK:
+            return [_run(GREEK[name])]
+        if name in SYMBOLS:
+            return [_run(SYMBOLS[name], style='p')]
+        if name in SPACES:
+            return [_run(SPACES[name], style='p')]
+        if name in IGNORED:
+            return []
+        if name in ESCAPED:
+            return [_run(name, style='p')]
+        if name in TEXT_COMMANDS:
+            return [_run(self.read_text_argument(), style='p')]
+        if name in ACCENTS:
+            return [_element('m:acc', _element('m:accPr', _element('m:chr', val=ACCENTS[name])), _element('m:e', self.parse_argument()))]
+        if name in ('overline', 'bar'):
+            return [_element('m:bar', _element('m:barPr', _element('m:pos', val='top')), _element('m:e', self.parse_argument()))]
+        if name == 'left':
+            opening = self.read_delimiter()
+            inner = self.parse_sequence(('cmd', 'right'))
+            closing = self.read_delimiter()
+            return [_element(
+                'm:d',
+                _element('m:dPr', _element('m:begChr', val=opening), _element('m:endChr', val=closing)),
+                _element('m:e', inner),
+            )]
+        raise UnsupportedLatexError(f'未対応のコマンドです: \\{name}')
+
+    def read_delimiter(self):
+        kind, value = self.take()
+        if kind == 'cmd':
+            value = SYMBOLS.get(value, value)
+        if value not in DELIMITERS:
+            raise UnsupportedLatexError(f'未対応の括弧です: {value}')
+        return '' if value == '.' else value
+
+    def read_text_argument(self):
+        if self.take() != ('char', '{'):
+            raise UnsupportedLatexError('\\text の引数がありません')
+        parts = []
+        depth = 0
+        while self.pos < len(self.tokens):
+            kind, value = self.tokens[self.pos]
+            self.pos += 1
+            if kind == 'char' and value == '{':
+                depth += 1
+            elif kind == 'char' and value == '}':
+                if depth == 0:
+                    return ''.join(parts)
+                depth -= 1
+            parts.append(value if kind != 'cmd' else ('' if value in SPACES else '\\' + value))
+        raise UnsupportedLatexError('括弧が閉じていません')
+
+    def build_nary(self, name, sub, sup, body):
+        properties = [_element('m:chr', val=NARY[name])]
+        properties.append(_element('m:limLoc', val='subSup' if name.endswith('int') else 'undOvr'))
+        if sub is None:
+            properties.append(_element('m:subHide', val='1'))
+        if sup is None:
+            properties.append(_element('m:supHide', val='1'))
+        return _element(
+            'm:nary',
+            _element('m:naryPr', properties),
+            _element('m:sub', sub or []),
+            _element('m:sup', sup or []),
+            _element('m:e', body),
+        )
+
+
+def latex_to_omml(latex, display=False):
+    """LaTeX（区切り記号なし）を m:oMath（display=True なら m:oMathPara）に変換する"""
+    elements = _Parser(latex).parse_sequence()
+    if not elements:
+        raise UnsupportedLatexError('空の数式です')
+    math = _element('m:oMath', elements)
+    if display:
+        return _element('m:oMathPara', math)
+    return math
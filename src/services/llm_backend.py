@@ -0,0 +1,434 @@
+import itertools
+import json
+import os
+import random
+import re
+import threading
+import time
+from types import SimpleNamespace
+
+# LLMバックエンドの切り替え
+# LLM_BACKEND=openai（既定）で OpenAI API、LLM_BACKEND=fake で記録済み応答を返すローカル実装を使う
+
+GENERATION_COUNT_PATTERN = re.compile(r'類題を(\d+)問作成')
+GENERATION_SHARD_PATTERN = re.compile(r'全(\d+)問を(\d+)回に分けて作成しており、これは(\d+)回目')
+
+DEFAULT_ANALYSIS_RESPONSE = """学年: 中3
+単元: 二次方程式
+難易度: Level 2 (標準)
+推定根拠: 因数分解で解ける二次方程式のため
+要約: 左辺を因数分解し、積が0になる条件から解を求める。
+次のステップ: 解の公式を使う問題に進む"""
+
+# fake バックエンドが覚えておくメッセージ列の先頭部分の数（プロンプトキャッシュの模擬用）
+MAX_SEEN_PREFIXES = 10000
+
+DEFAULT_ANALYSIS_JSON = {
+    'grade': '中3',
+    'unit': '二次方程式',
+    'difficulty': 'Level 2 (標準)',
+    'justification': '因数分解で解ける二次方程式のため',
+    'summary': '左辺を因数分解し、積が0になる条件から解を求める。',
+    'next_action_prompt': '解の公式を使う問題に進む',
+}
+
+DEFAULT_OCR_RESPONSE = '次の方程式を解け。 $x^2 - 5x + 6 = 0$'
+
+
+def _synthetic_problems(count, offset=0, json_output=False):
+    problems = []
+    for idx in range(1, count + 1):
+        a, b = offset + idx + 1, offset + idx + 2
+        problems.append({
+            'title': '',
+            'problem': f'次の方程式を解け。 $x^2 - {a + b}x + {a * b} = 0$',
+            'answer': f'$x = {a}, {b}$',
+            'explanation': f'左辺を因数分解すると $$(x - {a})(x - {b}) = 0$$ となるので、$x = {a}$ または $x = {b}$ である。',
+        })
+    if json_output:
+        return json.dumps({'problems': problems}, ensure_ascii=False)
+    return '\n'.join(
+        f'【問題{idx}】\n{problem["problem"]}\n【解答{idx}】\n{problem["answer"]}\n【解説{idx}】\n{problem["explanation"]}'
+        for idx, problem in enumerate(problems, start=1)
+    )
+
+
+def _message_text(messages):
+    parts = []
+    for message in messages or []:
+        content = message.get('content')
+        if isinstance(content, str):
+            parts.append(content)
+        elif isinstance(content, list):
+            for item in content:
+                if item.get('type') == 'text':
+                    parts.append(item.get('text') or '')
+                elif item.get('type') == 'image_url':
+                    parts.append('[image]')
+    return '\n'.join(parts)
+
+
+def detect_request_kind(messages):
+    # 呼び出し側が request_kind を渡さなかった場合に限り、メッセージの内容から種類を推定する
+    text = _message_text(messages)
+    if '[image]' in text:
+        return 'ocr'
+    if '【問題1】' in text or GENERATION_COUNT_PATTERN.search(text):
+        return 'generate'
+    return 'analyze'
+
+
+def _usage(prompt_text, completion_text, cached_chars=0):
+    # トークン数は文字数からの概算
+    prompt_tokens = max(1, len(prompt_text) // 2)
+    completion_tokens = max(1, len(completion_text) // 2)
+    return SimpleNamespace(
+        prompt_tokens=prompt_tokens,
+        completion_tokens=completion_tokens,
+        total_tokens=prompt_tokens + completion_tokens,
+        prompt_tokens_details=SimpleNamespace(cached_tokens=min(prompt_tokens, cached_chars // 2)),
+    )
+
+
+class FakeChatCompletions:
+    accepts_request_kind = True
+
+    def __init__(self, recordings=None, latency_ms=0, jitter_ms=0, chunk_size=16):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.chunk_size = max(1, chunk_size)
+        self._recordings = {}
+        self._cursors = {}
+        self._seen_prefixes = set()
+        self._lock = threading.Lock()
+        for record in recordings or []:
+            kind = record.get('kind') or 'analyze'
+            self._recordings.setdefault(kind, []).append(record)
+        for kind, records in self._recordings.items():
+            self._cursors[kind] = itertools.cycle(records)
+
+    def create(self, model=None, messages=None, stream=False, max_tokens=None, response_format=None,
+               request_kind=None, **kwargs):
+        kind = request_kind or detect_request_kind(messages)
+        # response_format で JSON を指定された場合は、合成する応答も JSON にする
+        json_output = (response_format or {}).get('type') in ('json_schema', 'json_object')
+        content, finish_reason = self._next_response(kind, messages, json_output)
+        if max_tokens and len(content) > max_tokens * 2:
+            content, finish_reason = content[:max_tokens * 2], 'length'
+        delay = self._delay_seconds()
+        if stream:
+            return self._stream(content, finish_reason, delay)
+        if delay:
+            time.sleep(delay)
+        return SimpleNamespace(
+            id='fake-completion',
+            model=model,
+            choices=[SimpleNamespace(
+                index=0,
+                message=SimpleNamespace(role='assistant', content=content),
+                finish_reason=finish_reason,
+            )],
+            usage=_usage(_message_text(messages), content, self._cached_chars(messages)),
+        )
+
+    def _cached_chars(self, messages):
+        # 上流のプロンプトキャッシュを模して、以前に送られたメッセージ列と先頭から一致する部分の文字数を返す
+        prefix = ()
+        length = 0
+        cached = 0
+        with self._lock:
+            for message in messages or []:
+                content = message.get('content')
+                if not isinstance(content, str):
+                    break
+                prefix += ((message.get('role'), content),)
+                length += len(content)
+                key = hash(prefix)
+                if key in self._seen_prefixes:
+                    cached = length
+                    continue
+                if len(self._seen_prefixes) >= MAX_SEEN_PREFIXES:
+                    self._seen_prefixes.clear()
+                self._seen_prefixes.add(key)
+        return cached
+
+    def _next_response(self, kind, messages, json_output=False):
+        text = _message_text(messages)
+        with self._lock:
+            for record in self._recordings.get(kind, []):
+                if record.get('match') and record['match'] in text:
+                    return record.get('content') or '', record.get('finish_reason') or 'stop'
+            cursor = self._cursors.get(kind)
+            if cursor is not None:
+                record = next(cursor)
+                return record.get('content') or '', record.get('finish_reason') or 'stop'
+        if kind == 'generate':
+            match = GENERATION_COUNT_PATTERN.search(text)
+            count = int(match.group(1)) if match else 3
+            # 分割生成では回ごとに別の問題にする（前の回までの問題数だけ数値をずらす）
+            shard = GENERATION_SHARD_PATTERN.search(text)
+            offset = (int(shard.group(3)) - 1) * -(-int(shard.group(1)) // int(shard.group(2))) if shard else 0
+            content = _synthetic_problems(count, offset, json_output)
+            # 途中で切れた出力の続きを求められた場合は、残りの部分だけを返す。
+            # JSON スキーマで縛った出力では、実際の API と同じく毎回新しい完全な JSON を返す
+            partial = ''.join(
+                message.get('content') or '' for message in messages or [] if message.get('role') == 'assistant'
+            )
+            if partial and not json_output and content.startswith(partial):
+                content = content[len(partial):]
+            return content, 'stop'
+        if kind == 'ocr':
+            return DEFAULT_OCR_RESPONSE, 'stop'
+        if json_output:
+            return json.dumps(DEFAULT_ANALYSIS_JSON, ensure_ascii=False), 'stop'
+        return DEFAULT_ANALYSIS_RESPONSE, 'stop'
+
+    def _delay_seconds(self):
+        delay_ms = self.latency_ms
+        if self.jitter_ms:
+            delay_ms += random.uniform(0, self.jitter_ms)
+        return max(0.0, delay_ms / 1000)
+
+    def _stream(self, content, finish_reason, delay):
+        pieces = [content[i:i + self.chunk_size] for i in range(0, len(content), self.chunk_size)] or ['']
+        per_chunk_delay = delay / len(pieces)
+        for idx, piece in enumerate(pieces):
+            if per_chunk_delay:
+                time.sleep(per_chunk_delay)
+            yield SimpleNamespace(
+                choices=[SimpleNamespace(
+                    index=0,
+                    delta=SimpleNamespace(role='assistant', content=piece),
+                    finish_reason=finish_reason if idx == len(pieces) - 1 else None,
+                )],
+                usage=None,
+            )
+
+
+class FakeLLMClient:
+    """OpenAI クライアントと同じ chat.completions.create を持つ、ネットワークを使わない実装"""
+
+    def __init__(self, recordings=None, latency_ms=0, jitter_ms=0):
+        self.chat = SimpleNamespace(
+            completions=FakeChatCompletions(recordings, latency_ms=latency_ms, jitter_ms=jitter_ms)
+        )
+
+
+def _forward_create(completions, kind, kwargs):
+    # request_kind はこのモジュールのラッパーと fake だけが受け取る。OpenAI の API にはそのまま渡さない
+    if getattr(completions, 'accepts_request_kind', False):
+        return completions.create(request_kind=kind, **kwargs)
+    return completions.create(**kwargs)
+
+
+class RecordingChatCompletions:
+    accepts_request_kind = True
+
+    def __init__(self, completions, record_path):
+        self._completions = completions
+        self._record_path = record_path
+        self._lock = threading.Lock()
+
+    def create(self, request_kind=None, **kwargs):
+        kind = request_kind or detect_request_kind(kwargs.get('messages'))
+        response = _forward_create(self._completions, kind, kwargs)
+        if kwargs.get('stream'):
+            return response
+        choice = response.choices[0]
+        self._append({
+            'kind': kind,
+            'content': choice.message.content or '',
+            'finish_reason': choice.finish_reason,
+        })
+        return response
+
+    def _append(self, record):
+        try:
+            with self._lock, open(self._record_path, 'a', encoding='utf-8') as f:
+                f.write(json.dumps(record, ensure_ascii=False) + '\n')
+        except OSError as e:
+            print(f"LLM応答の記録に失敗しました: {e}")
+
+
+class RecordingLLMClient:
+    """実際の応答を LLM_RECORD_PATH に書き出し、fake バックエンドで再生できるようにする"""
+
+    def __init__(self, client, record_path):
+        self._client = client
+        self.chat = SimpleNamespace(completions=RecordingChatCompletions(client.chat.completions, record_path))
+
+    def __getattr__(self, name):
+        return getattr(self._client, name)
+
+
+class LLMBusyError(Exception):
+    """同時に呼び出せる数の上限に達し、待ち時間内に空きが出なかった"""
+
+
+class LimitedChatCompletions:
+    def __init__(self, completions, max_concurrency=0, kind_concurrency=None, kind_timeouts=None, queue_timeout=30):
+        self._completions = completions
+        self._global_slots = threading.BoundedSemaphore(max_concurrency) if max_concurrency > 0 else None
+        self._kind_slots = {
+            kind: threading.BoundedSemaphore(limit)
+            for kind, limit in (kind_concurrency or {}).items() if limit > 0
+        }
+        self._kind_timeouts = {kind: timeout for kind, timeout in (kind_timeouts or {}).items() if timeout > 0}
+        self.queue_timeout = queue_timeout
+
+    def create(self, request_kind=None, **kwargs):
+        kind = request_kind or detect_request_kind(kwargs.get('messages'))
+        if kind in self._kind_timeouts and 'timeout' not in kwargs:
+            kwargs['timeout'] = self._kind_timeouts[kind]
+        # 種類ごとの枠を先に取り、全体の枠は実際に呼び出す直前まで取らない
+        slots = self._acquire([self._kind_slots.get(kind), self._global_slots], kind)
+        try:
+            response = _forward_create(self._completions, kind, kwargs)
+        except BaseException:
+            self._release(slots)
+            raise
+        if kwargs.get('stream'):
+            # ストリーミングは最後のチャンクを受け取るまで枠を使い続ける
+            return SlotReleasingStream(response, lambda: self._release(slots))
+        self._release(slots)
+        return response
+
+    def _acquire(self, slots, kind):
+        deadline = time.monotonic() + self.queue_timeout
+        acquired = []
+        for slot in slots:
+            if slot is None:
+                continue
+            if not slot.acquire(timeout=max(0.0, deadline - time.monotonic())):
+                self._release(acquired)
+                raise LLMBusyError(f'LLMの同時呼び出し数が上限に達しています（{kind}）')
+            acquired.append(slot)
+        return acquired
+
+    @staticmethod
+    def _release(slots):
+        for slot in reversed(slots):
+            slot.release()
+
+
+class SlotReleasingStream:
+    def __init__(self, response, release):
+        self._response = response
+        self._release = release
+        self._closed = False
+
+    def __iter__(self):
+        try:
+            yield from self._response
+        finally:
+            self.close()
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        try:
+            close = getattr(self._response, 'close', None)
+            if close is not None:
+                close()
+        finally:
+            self._release()
+
+    def __del__(self):
+        # 読み切られずに捨てられた場合も枠を返す
+        self.close()
+
+
+class LimitedLLMClient:
+    """chat.completions.create の同時実行数（全体・解析/生成/OCRごと）と種類ごとのタイムアウトを制限する"""
+
+    def __init__(self, client, **limits):
+        self._client = client
+        self.chat = SimpleNamespace(completions=LimitedChatCompletions(client.chat.completions, **limits))
+
+    def __getattr__(self, name):
+        return getattr(self._client, name)
+
+
+def load_recordings(path):
+    recordings = []
+    if not path:
+        return recordings
+    with open(path, 'r', encoding='utf-8') as f:
+        for line_number, line in enumerate(f, start=1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError as e:
+                print(f"記録済み応答の{line_number}行目を読み飛ばしました: {e}")
+                continue
+            if isinstance(record, dict) and record.get('content'):
+                recordings.append(record)
+    return recordings
+
+
+def _env_float(name, default):
+    try:
+        return float(os.environ.get(name, default))
+    except (TypeError, ValueError):
+        return default
+
+
+def _env_int(name, default):
+    try:
+        return int(os.environ.get(name, default))
+    except (TypeError, ValueError):
+        return default
+
+
+REQUEST_KINDS = ('analyze', 'generate', 'ocr')
+
+
+def llm_limits_from_env():
+    # LLM_MAX_CONCURRENCY: プロセス全体の同時呼び出し数、LLM_MAX_CONCURRENCY_<種類>: 種類ごとの上限（0 で制限なし）
+    # LLM_QUEUE_TIMEOUT: 空きを待つ秒数、LLM_TIMEOUT_<種類>: 種類ごとの応答タイムアウト（0 で LLM_TIMEOUT）
+    return {
+        'max_concurrency': _env_int('LLM_MAX_CONCURRENCY', 64),
+        'kind_concurrency': {kind: _env_int(f'LLM_MAX_CONCURRENCY_{kind.upper()}', 0) for kind in REQUEST_KINDS},
+        'kind_timeouts': {kind: _env_float(f'LLM_TIMEOUT_{kind.upper()}', 0) for kind in REQUEST_KINDS},
+        'queue_timeout': _env_float('LLM_QUEUE_TIMEOUT', 30),
+    }
+
+
+def create_openai_client(max_connections):
+    import httpx
+    from openai import DefaultHttpxClient, OpenAI
+
+    # 接続はプロセス内で共有し、keep-alive で TLS ハンドシェイクを使い回す
+    timeout = httpx.Timeout(_env_float('LLM_TIMEOUT', 60), connect=_env_float('LLM_CONNECT_TIMEOUT', 5))
+    http_client = DefaultHttpxClient(
+        limits=httpx.Limits(
+            max_connections=max_connections or None,
+            max_keepalive_connections=max_connections or None,
+            keepalive_expiry=30,
+        ),
+        timeout=timeout,
+    )
+    return OpenAI(http_client=http_client, timeout=timeout, max_retries=_env_int('LLM_MAX_RETRIES', 2))
+
+
+def create_llm_client():
+    backend = (os.environ.get('LLM_BACKEND') or 'openai').lower()
+    limits = llm_limits_from_env()
+    if backend == 'fake':
+        client = FakeLLMClient(
+            recordings=load_recordings(os.environ.get('LLM_FAKE_RESPONSES')),
+            latency_ms=_env_float('LLM_FAKE_LATENCY_MS', 0),
+            jitter_ms=_env_float('LLM_FAKE_JITTER_MS', 0),
+        )
+        return LimitedLLMClient(client, **limits)
+    if backend != 'openai':
+        raise ValueError(f'未対応のLLMバックエンドです: {backend}')
+
+    client = create_openai_client(limits['max_concurrency'])
+    record_path = os.environ.get('LLM_RECORD_PATH')
+    if record_path:
+        client = RecordingLLMClient(client, record_path)
+    return LimitedLLMClient(client, **limits)
@@ -0,0 +1,212 @@
+import base64
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+from collections import OrderedDict, namedtuple
+
+# 数式画像キャッシュ
+# メモリ上のLRUと、任意でgunicornワーカー間で共有するディスク層の2段構成
+
+MathAsset = namedtuple('MathAsset', ['png_bytes', 'width_pt', 'height_pt', 'vector_data', 'drawing'])
+
+DEFAULT_MAX_ENTRIES = 512
+DEFAULT_DISK_MAX_ENTRIES = 20000
+DEFAULT_DISK_MAX_BYTES = 200 * 1024 * 1024
+DISK_CLEANUP_INTERVAL_SECONDS = 60
+
+
+def normalize_expression(expression):
+    if not expression:
+        return ''
+    return ' '.join(str(expression).split())
+
+
+def make_cache_key(expression, dpi, font_size, fmt):
+    payload = json.dumps(
+        [normalize_expression(expression), int(dpi), float(font_size), str(fmt)],
+        ensure_ascii=False,
+    )
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+class MathAssetCache:
+    def __init__(self, max_entries=DEFAULT_MAX_ENTRIES, disk_dir=None,
+                 disk_max_entries=DEFAULT_DISK_MAX_ENTRIES, disk_max_bytes=DEFAULT_DISK_MAX_BYTES):
+        self.max_entries = max(1, int(max_entries))
+        self.disk_dir = disk_dir or None
+        self.disk_max_entries = disk_max_entries
+        self.disk_max_bytes = disk_max_bytes
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._last_disk_cleanup = 0.0
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        if self.disk_dir:
+            try:
+                os.makedirs(self.disk_dir, exist_ok=True)
+            except OSError as e:
+                print(f"数式キャッシュディレクトリの作成に失敗しました: {e}")
+                self.disk_dir = None
+
+    def get(self, key):
+        with self._lock:
+            asset = self._entries.get(key)
+            if asset is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return asset
+        asset = self._read_disk(key)
+        with self._lock:
+            if asset is not None:
+                self.disk_hits += 1
+                self._store(key, asset)
+            else:
+                self.misses += 1
+        return asset
+
+    def put(self, key, asset, persist=True):
+        with self._lock:
+            self._store(key, asset)
+        if persist:
+            self._write_disk(key, asset)
+            self.cleanup_disk()
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.disk_hits = 0
+            self.misses = 0
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.disk_hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'max_entries': self.max_entries,
+                'hits': self.hits,
+                'disk_hits': self.disk_hits,
+                'misses': self.misses,
+                'hit_ratio': (self.hits + self.disk_hits) / lookups if lookups else 0.0,
+                'disk_dir': self.disk_dir,
+            }
+
+    def cleanup_disk(self, force=False):
+        if not self.disk_dir:
+            return
+        now = time.time()
+        with self._lock:
+            if not force and now - self._last_disk_cleanup < DISK_CLEANUP_INTERVAL_SECONDS:
+                return
+            self._last_disk_cleanup = now
+
+        files = []
+        try:
+            shards = [entry.path for entry in os.scandir(self.disk_dir) if entry.is_dir()]
+        except OSError as e:
+            print(f"数式キャッシュの整理に失敗しました: {e}")
+            return
+        for shard in shards:
+            try:
+                entries = list(os.scandir(shard))
+            except OSError:
+                continue
+            for entry in entries:
+                if not entry.name.endswith('.json'):
+                    continue
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                files.append((stat.st_mtime, entry.path, stat.st_size))
+
+        # 件数・合計サイズの上限を超えた分は最後に使われたのが古いものから削除する
+        files.sort()
+        remaining = len(files)
+        total_bytes = sum(size for _, _, size in files)
+        for _, path, size in files:
+            if remaining <= self.disk_max_entries and total_bytes <= self.disk_max_bytes:
+                break
+            remaining -= 1
+            total_bytes -= size
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                print(f"数式キャッシュの削除に失敗しました: {e}")
+
+    def _store(self, key, asset):
+        self._entries[key] = asset
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def _disk_path(self, key):
+        return os.path.join(self.disk_dir, key[:2], f'{key}.json')
+
+    def _read_disk(self, key):
+        if not self.disk_dir:
+            return None
+        path = self._disk_path(key)
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                payload = json.load(f)
+            asset = MathAsset(
+                png_bytes=base64.b64decode(payload['png']),
+                width_pt=float(payload['width_pt']),
+                height_pt=float(payload['height_pt']),
+                vector_data=payload.get('vector'),
+                drawing=None,
+            )
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError, KeyError) as e:
+            print(f"数式キャッシュの読み込みに失敗しました: {e}")
+            return None
+        try:
+            # 更新日時を最後に使われた時刻として、上限を超えたときの整理に使う
+            os.utime(path)
+        except OSError:
+            pass
+        return asset
+
+    def _write_disk(self, key, asset):
+        if not self.disk_dir:
+            return
+        path = self._disk_path(key)
+        payload = {
+            'width_pt': asset.width_pt,
+            'height_pt': asset.height_pt,
+            'png': base64.b64encode(asset.png_bytes).decode('ascii'),
+            'vector': asset.vector_data,
+        }
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # 別ワーカーが途中のファイルを読まないよう一時ファイル経由で置き換える
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                json.dump(payload, f)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            print(f"数式キャッシュの書き込みに失敗しました: {e}")
+
+
+def _env_number(name, default):
+    try:
+        return type(default)(os.environ.get(name, default))
+    except (TypeError, ValueError):
+        return default
+
+
+def create_cache_from_env():
+    return MathAssetCache(
+        max_entries=_env_number('MATH_CACHE_SIZE', DEFAULT_MAX_ENTRIES),
+        disk_dir=os.environ.get('MATH_CACHE_DIR'),
+        disk_max_entries=_env_number('MATH_CACHE_DISK_MAX', DEFAULT_DISK_MAX_ENTRIES),
+        disk_max_bytes=_env_number('MATH_CACHE_DISK_MAX_BYTES', DEFAULT_DISK_MAX_BYTES),
+    )
@@ -0,0 +1,92 @@
+import re
+
+# 数式を含むテキストの分割・正規化（ルートと出力処理の両方から使う軽量モジュール）
+
+MATH_PATTERN = re.compile(
+    r'(?<!\\)(?:\$\$.*?(?<!\\)\$\$|\$(?!\s).*?(?<!\\)\$|\\\(.*?(?<!\\)\\\)|\\\[.*?(?<!\\)\\\])',
+    re.DOTALL,
+)
+
+
+def split_text_with_math(value):
+    segments = []
+    if not value:
+        return segments
+    last = 0
+    for match in MATH_PATTERN.finditer(value):
+        start_idx, end_idx = match.span()
+        if start_idx > last:
+            segments.append(('text', value[last:start_idx], False))
+        expr = match.group()
+        display = False
+        content = expr
+        if expr.startswith('$$') and expr.endswith('$$'):
+            content = expr[2:-2]
+            display = True
+        elif expr.startswith('$') and expr.endswith('$'):
+            content = expr[1:-1]
+            display = False
+        elif expr.startswith(r'\[') and expr.endswith(r'\]'):
+            content = expr[2:-2]
+            display = True
+        elif expr.startswith(r'\(') and expr.endswith(r'\)'):
+            content = expr[2:-2]
+            display = False
+        content = content.strip()
+        if content:
+            segments.append(('math', content, display))
+        last = end_idx
+    if last < len(value):
+        segments.append(('text', value[last:], False))
+    return segments
+
+
+DISPLAY_MATH_SPACING_PATTERN = re.compile(r'\\\[\s*(.*?)\s*\\\]', re.S)
+INLINE_MATH_SPACING_PATTERN = re.compile(r'\\\(\s*(.*?)\s*\\\)', re.S)
+ESCAPED_DELIMITER_SPACING_PATTERN = re.compile(r'\\\s+([\\()\\[\\]])')
+COMMAND_SPACING_PATTERN = re.compile(r'\\\s+([A-Za-z]+)')
+
+
+def _collapse_display(match):
+    inner = match.group(1).strip()
+    inner = ' '.join(inner.split())
+    return r'\[' + inner + r'\]'
+
+
+def _collapse_inline(match):
+    inner = match.group(1).strip()
+    inner = ' '.join(inner.split())
+    return r'\(' + inner + r'\)'
+
+
+def normalize_latex_spacing(text):
+    if not text:
+        return text
+    text = str(text)
+    # どの置換もバックスラッシュを含む箇所にしか作用しない
+    if '\\' not in text:
+        return text
+
+    text = DISPLAY_MATH_SPACING_PATTERN.sub(_collapse_display, text)
+    text = INLINE_MATH_SPACING_PATTERN.sub(_collapse_inline, text)
+    text = ESCAPED_DELIMITER_SPACING_PATTERN.sub(lambda m: '\\' + m.group(1), text)
+    text = COMMAND_SPACING_PATTERN.sub(r'\\\1', text)
+    return text
+
+
+STEP_MARKERS = ('主要ステップ', '最終解')
+
+
+def strip_step_markers(text):
+    if not text:
+        return text
+    text = str(text)
+    if not any(marker in text for marker in STEP_MARKERS):
+        return '\n'.join(text.splitlines()).strip()
+    filtered_lines = []
+    for line in text.splitlines():
+        stripped = line.strip()
+        if stripped.startswith(STEP_MARKERS):
+            continue
+        filtered_lines.append(line)
+    return '\n'.join(filtered_lines).strip()
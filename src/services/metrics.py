@@ -0,0 +1,283 @@
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+from flask import g, has_app_context
+
+# リクエスト内の処理時間の計測
+# 区間（LLM呼び出し・解析・数式描画・文書生成など）ごとの時間をヒストグラムに集計し、/api/metrics で Prometheus 形式で返す
+# 値はワーカープロセスごとに保持される
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+COUNT_BUCKETS = (1, 5, 10, 25, 50, 100, 250, 500, 1000)
+
+
+def _escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(names, values, extra=None):
+    pairs = [f'{name}="{_escape_label(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _format_number(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(str(labels.get(name, '')) for name in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} counter']
+        with self._lock:
+            items = sorted(self._values.items())
+        for key, value in items:
+            lines.append(f'{self.name}{_format_labels(self.labelnames, key)} {_format_number(value)}')
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(str(labels.get(name, '')) for name in self.labelnames)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+            for idx, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state[0][idx] += 1
+                    break
+            state[1] += value
+            state[2] += 1
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} histogram']
+        with self._lock:
+            items = sorted((key, (list(counts), total, count)) for key, (counts, total, count) in self._values.items())
+        for key, (counts, total, count) in items:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                le = f'le="{_format_number(bound)}"'
+                lines.append(f'{self.name}_bucket{_format_labels(self.labelnames, key, le)} {cumulative}')
+            lines.append(f'{self.name}_sum{_format_labels(self.labelnames, key)} {_format_number(total)}')
+            lines.append(f'{self.name}_count{_format_labels(self.labelnames, key)} {count}')
+        return lines
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics = []
+
+    def counter(self, name, documentation, labelnames=()):
+        metric = Counter(name, documentation, labelnames)
+        self._metrics.append(metric)
+        return metric
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        metric = Histogram(name, documentation, labelnames, buckets)
+        self._metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+registry = MetricsRegistry()
+
+REQUEST_SECONDS = registry.histogram(
+    'mathgen_request_duration_seconds',
+    'Time spent handling an API request (streaming responses until the last chunk).',
+    ('endpoint', 'method', 'status'),
+)
+SPAN_SECONDS = registry.histogram(
+    'mathgen_span_duration_seconds',
+    'Time spent in each stage of an API request.',
+    ('endpoint', 'span'),
+)
+MATH_EXPRESSIONS = registry.counter(
+    'mathgen_math_expressions_total',
+    'Unique math expressions needed by exports, by whether they were cached or rendered.',
+    ('endpoint', 'result'),
+)
+MATH_EXPRESSIONS_PER_EXPORT = registry.histogram(
+    'mathgen_math_expressions_per_export',
+    'Unique math expressions per exported document.',
+    ('endpoint',),
+    buckets=COUNT_BUCKETS,
+)
+MATH_FLOWABLES = registry.counter(
+    'mathgen_math_flowables_total',
+    'Math expressions placed in exported documents, by format and output kind (vector, omml, png, text for unrenderable LaTeX, or missing).',
+    ('format', 'kind'),
+)
+LLM_COALESCED = registry.counter(
+    'mathgen_llm_coalesced_total',
+    'LLM requests answered by an identical in-flight request, by where it ran (thread or worker).',
+    ('endpoint', 'source'),
+)
+LLM_TOKENS = registry.counter(
+    'mathgen_llm_tokens_total',
+    'Tokens reported in LLM API usage, by call kind and token type (prompt, cached_prompt or completion).',
+    ('endpoint', 'kind', 'type'),
+)
+DUPLICATE_PROBLEMS = registry.counter(
+    'mathgen_duplicate_problems_total',
+    'Generated problems detected as near-duplicates, by match source (batch or recent) and action (drop or flag).',
+    ('source', 'action'),
+)
+
+
+class RequestTimings:
+    def __init__(self, endpoint):
+        self.endpoint = endpoint
+        self.started = time.perf_counter()
+        self.spans = []
+        self.counts = {}
+
+    def add_span(self, name, seconds):
+        self.spans.append((name, seconds))
+        SPAN_SECONDS.observe(seconds, endpoint=self.endpoint, span=name)
+
+    def add_count(self, name, amount):
+        self.counts[name] = self.counts.get(name, 0) + amount
+
+    def server_timing(self):
+        # 同じ名前の区間は合計して1項目にまとめる
+        totals = {}
+        for name, seconds in self.spans:
+            totals[name] = totals.get(name, 0.0) + seconds
+        entries = []
+        for name, seconds in totals.items():
+            entry = f'{name};dur={seconds * 1000:.1f}'
+            if name == 'math' and 'math_expressions' in self.counts:
+                entry += f';desc="{self.counts["math_expressions"]} expressions"'
+            if name == 'llm' and 'llm_prompt_tokens' in self.counts:
+                entry += (f';desc="{self.counts.get("llm_cached_tokens", 0)}/{self.counts["llm_prompt_tokens"]}'
+                          ' prompt tokens cached"')
+            entries.append(entry)
+        entries.append(f'total;dur={(time.perf_counter() - self.started) * 1000:.1f}')
+        return ', '.join(entries)
+
+
+_local = threading.local()
+
+
+def server_timing_enabled():
+    return os.environ.get('SERVER_TIMING', '0').lower() in ('1', 'true', 'yes', 'on')
+
+
+def start_request(endpoint):
+    timings = RequestTimings(endpoint or 'unknown')
+    if has_app_context():
+        g.request_timings = timings
+    else:
+        _local.timings = timings
+    return timings
+
+
+def current_timings():
+    if has_app_context():
+        timings = g.get('request_timings')
+        if timings is not None:
+            return timings
+    return getattr(_local, 'timings', None)
+
+
+@contextmanager
+def track_background(endpoint):
+    # 出力ジョブなどリクエスト外の処理でも区間を記録する
+    previous = getattr(_local, 'timings', None)
+    _local.timings = RequestTimings(endpoint)
+    try:
+        yield _local.timings
+    finally:
+        _local.timings = previous
+
+
+@contextmanager
+def span(name):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings = current_timings()
+        elapsed = time.perf_counter() - start
+        if timings is not None:
+            timings.add_span(name, elapsed)
+        else:
+            SPAN_SECONDS.observe(elapsed, endpoint='none', span=name)
+
+
+def record_math_expressions(cached, rendered):
+    timings = current_timings()
+    endpoint = timings.endpoint if timings is not None else 'none'
+    if cached:
+        MATH_EXPRESSIONS.inc(cached, endpoint=endpoint, result='cached')
+    if rendered:
+        MATH_EXPRESSIONS.inc(rendered, endpoint=endpoint, result='rendered')
+    MATH_EXPRESSIONS_PER_EXPORT.observe(cached + rendered, endpoint=endpoint)
+    if timings is not None:
+        timings.add_count('math_expressions', cached + rendered)
+        timings.add_count('math_rendered', rendered)
+
+
+def record_math_flowable(export_format, kind):
+    MATH_FLOWABLES.inc(format=export_format, kind=kind)
+
+
+def record_coalesced(source):
+    timings = current_timings()
+    LLM_COALESCED.inc(endpoint=timings.endpoint if timings is not None else 'none', source=source)
+
+
+def record_llm_usage(kind, usage):
+    # API の usage からプロンプト・キャッシュ済みプロンプト・出力のトークン数を記録する
+    if usage is None:
+        return
+    prompt_tokens = getattr(usage, 'prompt_tokens', None) or 0
+    completion_tokens = getattr(usage, 'completion_tokens', None) or 0
+    cached_tokens = getattr(getattr(usage, 'prompt_tokens_details', None), 'cached_tokens', None) or 0
+    timings = current_timings()
+    endpoint = timings.endpoint if timings is not None else 'none'
+    LLM_TOKENS.inc(prompt_tokens, endpoint=endpoint, kind=kind, type='prompt')
+    LLM_TOKENS.inc(cached_tokens, endpoint=endpoint, kind=kind, type='cached_prompt')
+    LLM_TOKENS.inc(completion_tokens, endpoint=endpoint, kind=kind, type='completion')
+    if timings is not None:
+        timings.add_count('llm_prompt_tokens', prompt_tokens)
+        timings.add_count('llm_cached_tokens', cached_tokens)
+
+
+def record_duplicate_problem(source, action):
+    DUPLICATE_PROBLEMS.inc(source=source, action=action)
+
+
+def finish_request(timings, method, status):
+    REQUEST_SECONDS.observe(time.perf_counter() - timings.started, endpoint=timings.endpoint, method=method, status=status)
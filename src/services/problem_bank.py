@@ -0,0 +1,191 @@
+import hashlib
+import json
+import os
+import re
+import time
+
+from sqlalchemy import text
+from sqlalchemy.exc import IntegrityError
+
+from src.models.problem_bank import BankProblem, db
+
+# 問題バンク
+# LLMで生成した問題を学年・単元・難易度ごとに保存し、同じ条件の生成リクエストにはバンクから出題する
+# 例題（入力データ）は保存しない。SQLite では問題文・解答・解説の全文検索用に FTS5（trigram）の索引を作る
+
+FTS_TABLE = 'problem_bank_fts'
+DIFFICULTY_LEVEL_PATTERN = re.compile(r'(?:level|lv|l)\s*\.?\s*([1-5])', re.IGNORECASE)
+BANK_MODES = ('off', 'prefer', 'only')
+
+FTS_SCHEMA = (
+    f"""CREATE VIRTUAL TABLE IF NOT EXISTS {FTS_TABLE} USING fts5(
+        problem, answer, explanation, content='problem_bank', content_rowid='id', tokenize='trigram'
+    )""",
+    f"""CREATE TRIGGER IF NOT EXISTS problem_bank_ai AFTER INSERT ON problem_bank BEGIN
+        INSERT INTO {FTS_TABLE}(rowid, problem, answer, explanation)
+        VALUES (new.id, new.problem, new.answer, new.explanation);
+    END""",
+    f"""CREATE TRIGGER IF NOT EXISTS problem_bank_ad AFTER DELETE ON problem_bank BEGIN
+        INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, problem, answer, explanation)
+        VALUES ('delete', old.id, old.problem, old.answer, old.explanation);
+    END""",
+    f"""CREATE TRIGGER IF NOT EXISTS problem_bank_au AFTER UPDATE OF problem, answer, explanation ON problem_bank BEGIN
+        INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, problem, answer, explanation)
+        VALUES ('delete', old.id, old.problem, old.answer, old.explanation);
+        INSERT INTO {FTS_TABLE}(rowid, problem, answer, explanation)
+        VALUES (new.id, new.problem, new.answer, new.explanation);
+    END""",
+)
+
+
+def problem_bank_enabled():
+    return os.environ.get('PROBLEM_BANK_ENABLED', '1').lower() not in ('0', 'false', 'no', 'off')
+
+
+def default_bank_mode():
+    mode = (os.environ.get('PROBLEM_BANK_MODE') or 'off').lower()
+    return mode if mode in BANK_MODES else 'off'
+
+
+def normalize_bank_mode(value):
+    if value is None or value == '':
+        return default_bank_mode()
+    if value is True:
+        return 'prefer'
+    if value is False:
+        return 'off'
+    mode = str(value).lower()
+    return mode if mode in BANK_MODES else 'off'
+
+
+def _normalize_field(value):
+    return ' '.join(str(value or '').split())
+
+
+def normalize_difficulty(value):
+    # 「Level 3」「L3」「Level 3 (標準)」などの表記揺れをそろえる
+    value = _normalize_field(value)
+    match = DIFFICULTY_LEVEL_PATTERN.search(value)
+    return f'L{match.group(1)}' if match else value
+
+
+def problem_content_hash(problem):
+    payload = json.dumps(
+        [_normalize_field(problem.get(field)) for field in ('problem', 'answer', 'explanation')],
+        ensure_ascii=False,
+    )
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+def init_problem_bank_index():
+    # SQLite のときだけ全文検索の索引を作る（既存の問題があれば索引を作り直す）
+    if db.engine.dialect.name != 'sqlite':
+        return False
+    with db.engine.begin() as conn:
+        exists = conn.execute(
+            text("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = :name"), {'name': FTS_TABLE}
+        ).first()
+        for statement in FTS_SCHEMA:
+            conn.exec_driver_sql(statement)
+        if not exists:
+            conn.exec_driver_sql(f"INSERT INTO {FTS_TABLE}({FTS_TABLE}) VALUES ('rebuild')")
+    return True
+
+
+def store_problems(problems, grade=None, unit=None, difficulty=None, template_version=None):
+    candidates = {}
+    for problem in problems or []:
+        if not problem.get('problem'):
+            continue
+        candidates.setdefault(problem_content_hash(problem), problem)
+    if not candidates:
+        return 0
+    try:
+        existing = {
+            row.content_hash for row in BankProblem.query
+            .with_entities(BankProblem.content_hash)
+            .filter(BankProblem.content_hash.in_(list(candidates)))
+        }
+        now = time.time()
+        stored = 0
+        for content_hash, problem in candidates.items():
+            if content_hash in existing:
+                continue
+            # 別のリクエストが同じ問題を先に保存していた場合は、その1件だけを取り消して残りは保存する
+            try:
+                with db.session.begin_nested():
+                    db.session.add(BankProblem(
+                        content_hash=content_hash,
+                        grade=_normalize_field(grade),
+                        unit=_normalize_field(unit),
+                        difficulty=normalize_difficulty(difficulty),
+                        title=problem.get('title'),
+                        problem=problem['problem'],
+                        answer=problem.get('answer'),
+                        explanation=problem.get('explanation'),
+                        template_version=template_version,
+                        created_at=now,
+                    ))
+            except IntegrityError:
+                continue
+            stored += 1
+        db.session.commit()
+        return stored
+    except Exception as e:
+        db.session.rollback()
+        print(f"問題バンクへの保存に失敗しました: {e}")
+        return 0
+
+
+def take_bank_problems(grade, unit, difficulty, count):
+    # 出題回数の少ないものから順に使い、同じ問題ばかり出ないようにする
+    unit = _normalize_field(unit)
+    if not unit or count <= 0:
+        return []
+    try:
+        query = BankProblem.query.filter(
+            BankProblem.unit == unit,
+            BankProblem.difficulty == normalize_difficulty(difficulty),
+        )
+        grade = _normalize_field(grade)
+        if grade:
+            query = query.filter(BankProblem.grade == grade)
+        problems = query.order_by(
+            BankProblem.served_count.asc(), BankProblem.last_served_at.asc(), BankProblem.id.asc()
+        ).limit(count).all()
+        now = time.time()
+        for problem in problems:
+            problem.served_count = (problem.served_count or 0) + 1
+            problem.last_served_at = now
+        db.session.commit()
+        return problems
+    except Exception as e:
+        db.session.rollback()
+        print(f"問題バンクの読み込みに失敗しました: {e}")
+        return []
+
+
+def search_bank_problems(keyword=None, grade=None, unit=None, difficulty=None, limit=20):
+    query = BankProblem.query
+    if grade:
+        query = query.filter(BankProblem.grade == _normalize_field(grade))
+    if unit:
+        query = query.filter(BankProblem.unit == _normalize_field(unit))
+    if difficulty:
+        query = query.filter(BankProblem.difficulty == normalize_difficulty(difficulty))
+    keyword = _normalize_field(keyword)
+    if keyword:
+        # trigram 索引は3文字以上の語で使える。短い語と SQLite 以外は部分一致で探す
+        if len(keyword) >= 3 and db.engine.dialect.name == 'sqlite':
+            phrase = '"' + keyword.replace('"', '""') + '"'
+            matched_ids = text(f'SELECT rowid FROM {FTS_TABLE} WHERE {FTS_TABLE} MATCH :phrase')
+            matched_ids = matched_ids.bindparams(phrase=phrase).columns(db.column('rowid', db.Integer))
+            query = query.filter(BankProblem.id.in_(matched_ids))
+        else:
+            pattern = f'%{keyword}%'
+            query = query.filter(db.or_(
+                BankProblem.problem.like(pattern),
+                BankProblem.answer.like(pattern),
+                BankProblem.explanation.like(pattern),
+            ))
+    return query.order_by(BankProblem.id.desc()).limit(max(1, min(int(limit), 100))).all()
@@ -0,0 +1,194 @@
+import os
+import threading
+import unicodedata
+
+import numpy as np
+
+# 生成された問題の重複検出（MinHash + LSH）
+# 問題文を正規化して文字 n-gram（shingle）に分け、MinHash の署名を NumPy 配列で持つ
+# 同じ問題セット内はまとめて総当たりで比較し、過去に生成した問題は LSH の索引で候補を絞ってから比較する
+
+PRIME = (1 << 31) - 1
+SHINGLE_BASE = 1_000_003
+DEFAULT_NUM_PERM = 96
+# 16バンド x 6行: 類似度 0.8 の組は 99% 以上の確率で候補になり、0.6 未満の組はほとんど候補に入らない
+DEFAULT_BANDS = 16
+DEFAULT_SHINGLE_SIZE = 5
+DEFAULT_THRESHOLD = 0.8
+DEFAULT_CAPACITY = 100_000
+DEDUP_MODES = ('drop', 'flag', 'off')
+# 未整列の追加分が REBUILD_MIN_PENDING 件か索引の 1/REBUILD_FRACTION を超えたらソートし直す
+REBUILD_MIN_PENDING = 1024
+REBUILD_FRACTION = 16
+
+
+def normalize_problem_for_dedup(text):
+    # 全角・半角や大文字・小文字、空白の違いは同じものとして扱う
+    text = unicodedata.normalize('NFKC', str(text or '')).lower()
+    return ''.join(text.split())
+
+
+def shingle_hashes(text, size=DEFAULT_SHINGLE_SIZE):
+    codes = np.frombuffer(text.encode('utf-32-le'), dtype=np.uint32).astype(np.uint64)
+    if len(codes) == 0:
+        return np.zeros(1, dtype=np.uint64)
+    if len(codes) < size:
+        size = len(codes)
+    count = len(codes) - size + 1
+    hashes = np.zeros(count, dtype=np.uint64)
+    for offset in range(size):
+        hashes = (hashes * SHINGLE_BASE + codes[offset:offset + count]) % PRIME
+    return np.unique(hashes)
+
+
+class MinHashIndex:
+    # 各バンドの署名をまとめた値（バンドハッシュ）をバンドごとにソートした NumPy 配列で持ち、searchsorted で候補を探す
+    # 追加した分（リングバッファ上で直前の _pending 件）はソートし直すまで直接比較し、一定数たまったらまとめてソートし直す
+    # 上書きされたスロットの古いバンドハッシュは、候補を現在のバンドハッシュと照らし合わせて除く
+
+    def __init__(self, num_perm=DEFAULT_NUM_PERM, bands=DEFAULT_BANDS, capacity=DEFAULT_CAPACITY):
+        if num_perm % bands:
+            raise ValueError('num_perm は bands で割り切れる必要があります')
+        self.num_perm = num_perm
+        self.bands = bands
+        self.rows = num_perm // bands
+        self.capacity = max(1, int(capacity))
+        self.signatures = np.zeros((self.capacity, num_perm), dtype=np.uint32)
+        self.band_hashes = np.zeros((self.capacity, bands), dtype=np.uint64)
+        self.size = 0
+        self._next_slot = 0
+        self._weights = np.random.default_rng(0).integers(1, 1 << 63, size=self.rows, dtype=np.uint64) | 1
+        self._sorted_hashes = np.zeros((bands, 0), dtype=np.uint64)
+        self._sorted_slots = np.zeros((bands, 0), dtype=np.int32)
+        self._pending = 0
+        self._lock = threading.Lock()
+
+    def _band_hashes_of(self, signatures):
+        # (n, num_perm) の署名を (n, bands) のバンドハッシュにする（uint64 の桁あふれはそのまま使う）
+        rows = signatures.reshape(len(signatures), self.bands, self.rows).astype(np.uint64)
+        return (rows * self._weights).sum(axis=2, dtype=np.uint64)
+
+    def _rebuild(self):
+        hashes = self.band_hashes[:self.size].T
+        order = np.argsort(hashes, axis=1)
+        self._sorted_hashes = np.take_along_axis(hashes, order, axis=1)
+        self._sorted_slots = order.astype(np.int32)
+        self._pending = 0
+
+    def add_many(self, signatures):
+        signatures = np.asarray(signatures, dtype=np.uint32).reshape(-1, self.num_perm)
+        if not len(signatures):
+            return
+        band_hashes = self._band_hashes_of(signatures)
+        with self._lock:
+            for signature, band_hash in zip(signatures, band_hashes):
+                # いっぱいになったら古いものから上書きする
+                slot = self._next_slot
+                self.signatures[slot] = signature
+                self.band_hashes[slot] = band_hash
+                self._pending += 1
+                self.size = min(self.size + 1, self.capacity)
+                self._next_slot = (slot + 1) % self.capacity
+            if self._pending >= min(self.capacity, max(REBUILD_MIN_PENDING, self.size // REBUILD_FRACTION)):
+                self._rebuild()
+
+    def add(self, signature):
+        self.add_many([signature])
+
+    def _pending_matches(self, band_hash):
+        # ソートし直していない追加分はリングバッファ上で連続しているので、コピーせずに比較する
+        end = self._next_slot
+        start = end - self._pending
+        ranges = [(start, end)] if start >= 0 else [(start + self.capacity, self.capacity), (0, end)]
+        matches = [
+            np.flatnonzero((self.band_hashes[low:high] == band_hash).any(axis=1)).astype(np.int32) + low
+            for low, high in ranges
+        ]
+        return np.concatenate(matches)
+
+    def best_match(self, signature):
+        # (推定Jaccard類似度, スロット) を返す。候補がなければ (0.0, None)
+        signature = np.asarray(signature, dtype=np.uint32)
+        band_hash = self._band_hashes_of(signature.reshape(1, -1))[0]
+        with self._lock:
+            parts = [self._pending_matches(band_hash)]
+            if self._sorted_hashes.shape[1]:
+                for band in range(self.bands):
+                    row = self._sorted_hashes[band]
+                    low = np.searchsorted(row, band_hash[band], side='left')
+                    high = np.searchsorted(row, band_hash[band], side='right')
+                    if high > low:
+                        parts.append(self._sorted_slots[band, low:high])
+            slots = np.unique(np.concatenate(parts))
+            # ソート後に上書きされたスロットを除く
+            slots = slots[(self.band_hashes[slots] == band_hash).any(axis=1)]
+            if not len(slots):
+                return 0.0, None
+            similarities = (self.signatures[slots] == signature).mean(axis=1)
+        best = int(similarities.argmax())
+        return float(similarities[best]), int(slots[best])
+
+
+class ProblemDeduplicator:
+    def __init__(self, threshold=DEFAULT_THRESHOLD, num_perm=DEFAULT_NUM_PERM, bands=DEFAULT_BANDS,
+                 capacity=DEFAULT_CAPACITY, shingle_size=DEFAULT_SHINGLE_SIZE, seed=1):
+        self.threshold = threshold
+        self.shingle_size = shingle_size
+        rng = np.random.default_rng(seed)
+        self._a = rng.integers(1, PRIME, size=num_perm, dtype=np.uint64)
+        self._b = rng.integers(0, PRIME, size=num_perm, dtype=np.uint64)
+        self.recent = MinHashIndex(num_perm=num_perm, bands=bands, capacity=capacity)
+
+    def signature(self, text):
+        hashes = shingle_hashes(normalize_problem_for_dedup(text), self.shingle_size)
+        return ((self._a[:, None] * hashes[None, :] + self._b[:, None]) % PRIME).min(axis=1).astype(np.uint32)
+
+    def signatures(self, texts):
+        if not texts:
+            return np.zeros((0, len(self._a)), dtype=np.uint32)
+        return np.stack([self.signature(text) for text in texts])
+
+    def find_duplicates(self, problems, check_recent=True):
+        # 重複と判定した問題の {index: (類似度, 'batch' / 'recent')} と署名を返す
+        signatures = self.signatures([problem.get('problem') or '' for problem in problems])
+        duplicates = {}
+        if len(signatures) > 1:
+            # 問題セット内は全組み合わせをまとめて比較し、先に出てきた問題を残す
+            similarity = (signatures[:, None, :] == signatures[None, :, :]).mean(axis=2)
+            for index in range(1, len(signatures)):
+                kept = [earlier for earlier in range(index) if earlier not in duplicates]
+                if kept:
+                    best = max(similarity[index, kept])
+                    if best >= self.threshold:
+                        duplicates[index] = (float(best), 'batch')
+        if check_recent:
+            for index, signature in enumerate(signatures):
+                if index in duplicates:
+                    continue
+                best, _ = self.recent.best_match(signature)
+                if best >= self.threshold:
+                    duplicates[index] = (best, 'recent')
+        return duplicates, signatures
+
+    def remember(self, signatures):
+        self.recent.add_many(signatures)
+
+
+def dedup_mode():
+    # 既定は印を付けるだけ。除いて生成し直す（LLM の呼び出しが増える）のは PROBLEM_DEDUP=drop のときだけ
+    mode = (os.environ.get('PROBLEM_DEDUP') or 'flag').lower()
+    return mode if mode in DEDUP_MODES else 'flag'
+
+
+def create_deduplicator_from_env():
+    if dedup_mode() == 'off':
+        return None
+    try:
+        threshold = float(os.environ.get('PROBLEM_DEDUP_THRESHOLD', DEFAULT_THRESHOLD))
+    except (TypeError, ValueError):
+        threshold = DEFAULT_THRESHOLD
+    try:
+        capacity = int(os.environ.get('PROBLEM_DEDUP_INDEX_SIZE', DEFAULT_CAPACITY))
+    except (TypeError, ValueError):
+        capacity = DEFAULT_CAPACITY
+    return ProblemDeduplicator(threshold=threshold, capacity=capacity)
@@ -0,0 +1,179 @@
+import hashlib
+import os
+import threading
+from collections import namedtuple
+
+# プロンプトテンプレート（prompt_template.txt）の管理
+# 一度読み込んだ内容と版（内容のハッシュ）を保持し、ファイルの更新時刻・サイズが変わったときだけ読み直す
+# メッセージは「テンプレート（全呼び出しで同一）→ 解析・生成ごとの固定の指示 → 例題など毎回変わる内容」の順に並べ、
+# OpenAI のプロンプトキャッシュ（先頭が一致する部分を再利用する）が効くようにする
+
+PromptTemplate = namedtuple('PromptTemplate', ['text', 'version', 'system_message'])
+
+DEFAULT_TEMPLATE_PATH = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.dirname(__file__))), 'prompt_template.txt'
+)
+
+ANALYSIS_ROLE = 'あなたは数学教育の専門家です。'
+GENERATION_ROLE = 'あなたは数学問題作成の専門家です。'
+
+ANALYSIS_INSTRUCTIONS = '以下の例題を解析してください。解答は求めず、次の項目だけを順番を変えずに日本語で出力してください。'
+
+ANALYSIS_OUTPUT_FORMAT = """
+出力形式（見出し名を変更しないこと）：
+学年: [中1/中2/中3/数I/数A/数II/数B/数III/数C]
+単元: [具体的な単元名]
+難易度: [Level 1 (基礎) 〜 Level 5 (難関) などの表記]
+推定根拠: [簡潔な説明]
+要約: [解法の要点を1〜2文で]
+次のステップ: [学習者への次の学習提案]
+"""
+
+# 類題生成の出力形式。「{count}」は置き換えずにそのまま送っている（問題数は例題とともに最後のメッセージで指定する）
+GENERATION_OUTPUT_FORMAT = """
+出力形式（必ずこの形式を守ること）：
+【問題1】
+問題文
+【解答1】
+解答
+【解説1】
+解説
+（指定した問題数になるまで番号を増やして繰り返す）
+
+追加ルール:
+- 指定された作問数 {count} 問を必ず生成してください。
+- ユーザーへの質問や確認は行わず、指定の形式のみで回答してください。
+- 各問題には必ず問題文・解答・解説を含めてください。
+"""
+
+
+# LLM_JSON_OUTPUT=1 のときの出力形式。JSON スキーマで出力を縛り（response_format）、json.loads だけで読む
+ANALYSIS_JSON_OUTPUT_FORMAT = """
+出力形式：次のキーを持つJSONオブジェクトだけを出力すること
+grade: 学年（中1/中2/中3/数I/数A/数II/数B/数III/数C）
+unit: 具体的な単元名
+difficulty: Level 1 (基礎) 〜 Level 5 (難関) などの表記
+justification: 推定根拠（簡潔な説明）
+summary: 解法の要点を1〜2文で
+next_action_prompt: 学習者への次の学習提案
+"""
+
+GENERATION_JSON_OUTPUT_FORMAT = """
+出力形式：{"problems": [...]} の形のJSONオブジェクトだけを出力すること。
+problems の各要素は title（見出し。不要なら空文字）・problem（問題文）・answer（解答）・explanation（解説）を持つ。
+数式は LaTeX で書き、JSON の文字列として正しくエスケープすること。
+
+追加ルール:
+- 指定された作問数 {count} 問を必ず生成してください。
+- ユーザーへの質問や確認は行わず、指定の形式のみで回答してください。
+- 各問題には必ず問題文・解答・解説を含めてください。
+"""
+
+
+def _json_schema_format(name, properties, required=None):
+    schema = {
+        'type': 'object',
+        'properties': properties,
+        'required': required or list(properties),
+        'additionalProperties': False,
+    }
+    return {'type': 'json_schema', 'json_schema': {'name': name, 'strict': True, 'schema': schema}}
+
+
+ANALYSIS_FIELDS = ('grade', 'unit', 'difficulty', 'justification', 'summary', 'next_action_prompt')
+PROBLEM_FIELDS = ('title', 'problem', 'answer', 'explanation')
+
+ANALYSIS_RESPONSE_FORMAT = _json_schema_format(
+    'problem_analysis', {field: {'type': 'string'} for field in ANALYSIS_FIELDS},
+)
+GENERATION_RESPONSE_FORMAT = _json_schema_format('generated_problems', {
+    'problems': {
+        'type': 'array',
+        'items': {
+            'type': 'object',
+            'properties': {field: {'type': 'string'} for field in PROBLEM_FIELDS},
+            'required': list(PROBLEM_FIELDS),
+            'additionalProperties': False,
+        },
+    },
+})
+
+
+def json_output_enabled():
+    return os.environ.get('LLM_JSON_OUTPUT', '0').lower() in ('1', 'true', 'yes', 'on')
+
+
+def template_version_of(prompt_template):
+    return hashlib.sha256((prompt_template or '').encode('utf-8')).hexdigest()[:16]
+
+
+def build_prompt_template(text):
+    return PromptTemplate(
+        text=text,
+        version=template_version_of(text),
+        system_message={"role": "system", "content": text.strip()},
+    )
+
+
+def _instruction_message(role, instructions):
+    return {"role": "system", "content": f'{role}\n\n{instructions}'}
+
+
+# 解析・生成ごとの固定の指示（出力形式を含む）。JSON 出力モードかどうかで2通り
+ANALYSIS_INSTRUCTION_MESSAGES = {
+    False: _instruction_message(ANALYSIS_ROLE, f'{ANALYSIS_INSTRUCTIONS}\n{ANALYSIS_OUTPUT_FORMAT}'),
+    True: _instruction_message(ANALYSIS_ROLE, f'{ANALYSIS_INSTRUCTIONS}\n{ANALYSIS_JSON_OUTPUT_FORMAT}'),
+}
+GENERATION_INSTRUCTION_MESSAGES = {
+    False: _instruction_message(GENERATION_ROLE, GENERATION_OUTPUT_FORMAT.lstrip()),
+    True: _instruction_message(GENERATION_ROLE, GENERATION_JSON_OUTPUT_FORMAT.lstrip()),
+}
+
+
+def build_analysis_messages(prompt_template, problem_text, json_output=False):
+    return [
+        prompt_template.system_message,
+        ANALYSIS_INSTRUCTION_MESSAGES[bool(json_output)],
+        {"role": "user", "content": f'例題：\n{problem_text}'},
+    ]
+
+
+def build_generation_messages(prompt_template, generation_prompt, json_output=False):
+    return [
+        prompt_template.system_message,
+        GENERATION_INSTRUCTION_MESSAGES[bool(json_output)],
+        {"role": "user", "content": generation_prompt},
+    ]
+
+
+class PromptTemplateManager:
+    def __init__(self, path=DEFAULT_TEMPLATE_PATH):
+        self.path = path
+        self._template = None
+        self._signature = None
+        self._lock = threading.Lock()
+        self.reloads = 0
+
+    def get(self):
+        try:
+            stat = os.stat(self.path)
+        except OSError as e:
+            # 読み込み済みなら、ファイルを置き換えている最中などの一時的な失敗では前の内容を使い続ける
+            if self._template is not None:
+                print(f"プロンプトテンプレートの確認に失敗したため読み込み済みの内容を使います: {e}")
+                return self._template
+            raise
+        signature = (stat.st_mtime_ns, stat.st_size)
+        template = self._template
+        if template is not None and signature == self._signature:
+            return template
+        with self._lock:
+            if self._template is None or signature != self._signature:
+                with open(self.path, 'r', encoding='utf-8') as f:
+                    text = f.read()
+                if self._template is not None and self._template.version != template_version_of(text):
+                    print(f"プロンプトテンプレートを再読み込みしました: {self._template.version} -> {template_version_of(text)}")
+                self._template = build_prompt_template(text)
+                self._signature = signature
+                self.reloads += 1
+            return self._template
@@ -0,0 +1,179 @@
+import hashlib
+import json
+import os
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError:  # Windows ではワーカー間の共有は使わない
+    fcntl = None
+
+# 同じ内容のLLMリクエストの相乗り
+# 処理中のリクエストと同じキーのリクエストは新たにAPIを呼ばず、先に始めたリクエストの結果を受け取る
+# 同じワーカー内のスレッド間は常に、LLM_COALESCE_DIR を指定するとファイルロックでワーカー間でも相乗りする
+
+DEFAULT_WAIT_SECONDS = 120
+POLL_INTERVAL = 0.05
+# ワーカー間で受け渡した結果ファイルは、この秒数を過ぎたら削除する
+RESULT_TTL_SECONDS = 300
+CLEANUP_INTERVAL = 50
+
+
+def make_request_key(*parts):
+    payload = json.dumps(parts, ensure_ascii=False, sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+class _Flight:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class RequestCoalescer:
+    def __init__(self, lock_dir=None, wait_seconds=DEFAULT_WAIT_SECONDS):
+        self.lock_dir = lock_dir if fcntl is not None else None
+        self.wait_seconds = wait_seconds
+        self._flights = {}
+        self._lock = threading.Lock()
+        self._writes_since_cleanup = 0
+        if self.lock_dir:
+            try:
+                os.makedirs(self.lock_dir, exist_ok=True)
+            except OSError as e:
+                print(f"リクエスト相乗り用ディレクトリの作成に失敗しました: {e}")
+                self.lock_dir = None
+
+    def run(self, key, func):
+        # (結果, 相乗りした場合は 'thread' / 'worker'、自分で呼び出した場合は None) を返す
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+        if not leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.result, 'thread'
+
+        try:
+            if self.lock_dir:
+                result, shared = self._run_across_workers(key, func)
+            else:
+                result, shared = func(), None
+            flight.result = result
+            return result, shared
+        except BaseException as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                self._flights.pop(key, None)
+            flight.done.set()
+
+    def _run_across_workers(self, key, func):
+        lock_path = os.path.join(self.lock_dir, f'{key}.lock')
+        result_path = os.path.join(self.lock_dir, f'{key}.json')
+        started = time.time()
+        try:
+            fd = os.open(lock_path, os.O_RDWR | os.O_CREAT, 0o644)
+        except OSError as e:
+            print(f"リクエスト相乗り用ロックを作成できませんでした: {e}")
+            return func(), None
+        try:
+            if not self._try_lock(fd):
+                # 他のワーカーが同じリクエストを処理中。終わるまで待ってその結果を使う
+                if self._wait_for_lock(fd):
+                    result = self._read_result(result_path, started)
+                    if result is not None:
+                        return result, 'worker'
+                # 相手が失敗した場合（結果なし）はロックを持ったまま自分で呼び出し、待ち時間を超えた場合はロックなしで呼び出す
+            result = func()
+            self._write_result(result_path, result)
+            return result, None
+        finally:
+            os.close(fd)
+
+    @staticmethod
+    def _try_lock(fd):
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return True
+        except BlockingIOError:
+            return False
+
+    def _wait_for_lock(self, fd):
+        deadline = time.monotonic() + self.wait_seconds
+        while time.monotonic() < deadline:
+            time.sleep(POLL_INTERVAL)
+            if self._try_lock(fd):
+                return True
+        return False
+
+    @staticmethod
+    def _read_result(result_path, started):
+        try:
+            with open(result_path, 'r', encoding='utf-8') as f:
+                payload = json.load(f)
+        except (OSError, ValueError):
+            return None
+        # 待ち始める前に終わっていた古い結果は使わない
+        if payload.get('finished_at', 0) < started:
+            return None
+        return payload.get('result')
+
+    def _write_result(self, result_path, result):
+        tmp_path = f'{result_path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        try:
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump({'finished_at': time.time(), 'result': result}, f, ensure_ascii=False)
+            os.replace(tmp_path, result_path)
+        except (OSError, TypeError, ValueError) as e:
+            print(f"相乗り用の結果の書き込みに失敗しました: {e}")
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            return
+        self._writes_since_cleanup += 1
+        if self._writes_since_cleanup >= CLEANUP_INTERVAL:
+            self._writes_since_cleanup = 0
+            self.cleanup()
+
+    def cleanup(self):
+        cutoff = time.time() - RESULT_TTL_SECONDS
+        try:
+            names = os.listdir(self.lock_dir)
+        except OSError:
+            return
+        for name in names:
+            path = os.path.join(self.lock_dir, name)
+            try:
+                if os.path.getmtime(path) >= cutoff:
+                    continue
+                if name.endswith('.lock'):
+                    # 処理中のワーカーが持っているロックは消さない
+                    fd = os.open(path, os.O_RDWR)
+                    try:
+                        if self._try_lock(fd):
+                            os.remove(path)
+                    finally:
+                        os.close(fd)
+                else:
+                    os.remove(path)
+            except OSError:
+                continue
+
+
+def create_coalescer_from_env():
+    # LLM_COALESCE=0 で相乗りしない
+    if os.environ.get('LLM_COALESCE', '1').lower() in ('0', 'false', 'no', 'off'):
+        return None
+    try:
+        wait_seconds = float(os.environ.get('LLM_COALESCE_WAIT', DEFAULT_WAIT_SECONDS))
+    except (TypeError, ValueError):
+        wait_seconds = DEFAULT_WAIT_SECONDS
+    return RequestCoalescer(lock_dir=os.environ.get('LLM_COALESCE_DIR') or None, wait_seconds=wait_seconds)
@@ -0,0 +1,105 @@
+import hashlib
+import mimetypes
+import os
+import re
+from collections import namedtuple
+
+from flask import send_file
+
+# フロントエンドの静的ファイル配信
+# 起動時に static フォルダを走査して一覧・ETag・圧縮済みファイル（.br / .gz）を記録し、リクエストごとのファイル確認をなくす
+# Vite が内容のハッシュを付けて出力する assets/ 配下のファイルは1年間キャッシュさせ、それ以外は毎回 ETag で確認させる
+
+StaticFile = namedtuple('StaticFile', ['path', 'mimetype', 'etag', 'immutable', 'encodings'])
+
+IMMUTABLE_MAX_AGE = 365 * 24 * 60 * 60
+HASHED_ASSET_PATTERN = re.compile(r'^assets/.+-[A-Za-z0-9_-]{8,}\.[A-Za-z0-9]+$')
+# 優先順（Accept-Encoding で両方受け付けるときは brotli を使う）
+PRECOMPRESSED_SUFFIXES = (('br', '.br'), ('gzip', '.gz'))
+
+
+def _file_digest(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(65536), b''):
+            digest.update(chunk)
+    return digest.hexdigest()[:20]
+
+
+def accepted_encodings(accept_encoding):
+    accepted = set()
+    for item in (accept_encoding or '').split(','):
+        token, _, params = item.strip().partition(';')
+        token = token.strip().lower()
+        if not token:
+            continue
+        quality = params.strip()
+        if quality.startswith('q='):
+            try:
+                if float(quality[2:]) <= 0:
+                    continue
+            except ValueError:
+                pass
+        accepted.add(token)
+    return accepted
+
+
+class StaticIndex:
+    def __init__(self, root):
+        self.root = root
+        self.files = {}
+        self.refresh()
+
+    def refresh(self):
+        files = {}
+        if self.root and os.path.isdir(self.root):
+            for dirpath, _, filenames in os.walk(self.root):
+                for filename in filenames:
+                    path = os.path.join(dirpath, filename)
+                    name = os.path.relpath(path, self.root).replace(os.sep, '/')
+                    if name.endswith(tuple(suffix for _, suffix in PRECOMPRESSED_SUFFIXES)):
+                        continue
+                    encodings = {
+                        encoding: path + suffix
+                        for encoding, suffix in PRECOMPRESSED_SUFFIXES
+                        if os.path.isfile(path + suffix)
+                    }
+                    files[name] = StaticFile(
+                        path=path,
+                        mimetype=mimetypes.guess_type(filename)[0] or 'application/octet-stream',
+                        etag=_file_digest(path),
+                        immutable=bool(HASHED_ASSET_PATTERN.match(name)),
+                        encodings=encodings,
+                    )
+        self.files = files
+        return len(files)
+
+    def get(self, name):
+        return self.files.get(name)
+
+    def send(self, static_file, accept_encoding=None):
+        path = static_file.path
+        etag = static_file.etag
+        encoding = None
+        if static_file.encodings:
+            accepted = accepted_encodings(accept_encoding)
+            encoding = next((enc for enc, _ in PRECOMPRESSED_SUFFIXES
+                             if enc in static_file.encodings and enc in accepted), None)
+            if encoding:
+                path = static_file.encodings[encoding]
+                # 圧縮形式ごとに別の ETag にする
+                etag = f'{etag}-{encoding}'
+
+        response = send_file(path, mimetype=static_file.mimetype, etag=etag, conditional=True, max_age=None)
+        if encoding:
+            response.headers['Content-Encoding'] = encoding
+        if static_file.encodings:
+            response.vary.add('Accept-Encoding')
+        if static_file.immutable:
+            response.cache_control.no_cache = None
+            response.cache_control.public = True
+            response.cache_control.max_age = IMMUTABLE_MAX_AGE
+            response.cache_control.immutable = True
+        else:
+            response.cache_control.no_cache = True
+        return response